@@ -1,15 +1,21 @@
-from . import (archivefs, base, errors, localfs, mongofs)
+from . import (archivefs, base, cachedfs, copyfs, errors, localfs, mongofs,
+               shardedfs, workers)
 
 __all__ = sum(
-    [m.__all__ for m in [archivefs, base, errors, localfs, mongofs]],
+    [m.__all__ for m in [archivefs, base, cachedfs, copyfs, errors, localfs,
+                         mongofs, shardedfs, workers]],
     []
 )
 
 from .archivefs import *
 from .base import *
+from .cachedfs import *
+from .copyfs import *
 from .errors import *
 from .localfs import *
 from .mongofs import *
+from .shardedfs import *
+from .workers import *
 
 try:
     from . import dataflow
@@ -17,3 +23,10 @@ try:
     __all__ += dataflow.__all__
 except ImportError:  # pragma: no cover
     pass
+
+try:
+    from . import asyncfs
+    from .asyncfs import *
+    __all__ += asyncfs.__all__
+except ImportError:  # pragma: no cover
+    pass
@@ -1,20 +1,32 @@
+import codecs
+import json
+import mmap
 import os
+import struct
 import tarfile
 import zipfile
+from io import BytesIO
 
-from mlsnippet.utils import ActiveFiles, maybe_close
+from mlsnippet.utils import ActiveFiles, maybe_close, write_file_atomic
 from .base import *
+from .base import _sample_from_names
 from .errors import UnsupportedOperation, InvalidOpenMode, DataFileNotExist
 
 __all__ = ['TarArchiveFS', 'ZipArchiveFS']
 
+# indices of the name and extra field lengths in the zip local file header
+_ZIP_FH_FILENAME_LENGTH = 10
+_ZIP_FH_EXTRA_FIELD_LENGTH = 11
+
 
 class _ArchiveFS(DataFS):
     """Base class for archive file based :class:`DataFS`."""
 
     def __init__(self, archive_file, strict):
         super(_ArchiveFS, self).__init__(
-            capacity=DataFSCapacity.READ_DATA,
+            capacity=(DataFSCapacity.READ_DATA |
+                      DataFSCapacity.QUICK_COUNT |
+                      DataFSCapacity.RANDOM_SAMPLE),
             strict=strict
         )
 
@@ -22,6 +34,8 @@ class _ArchiveFS(DataFS):
         if not os.path.isfile(archive_file):
             raise IOError('Not a file: {!r}'.format(archive_file))
         self._archive_file = archive_file
+        self._mmap = None  # type: mmap.mmap
+        self._active_files = ActiveFiles()
 
     @property
     def archive_file(self):
@@ -34,8 +48,158 @@ class _ArchiveFS(DataFS):
     def _canonical_path(self, path):
         return path.replace('\\', '/')
 
+    def _open_mmap(self):
+        # the mmap object holds a duplicated file descriptor, thus the
+        # file object can be closed immediately
+        with open(self.archive_file, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # some memoryview obtained by ``zero_copy = True`` is still
+                # alive, leave the map to be closed by garbage collection
+                pass
+            self._mmap = None
+
+    def _get_member(self, filename):
+        """Get the member info of a file, or None if not exist."""
+        raise NotImplementedError()
+
+    def _member_offset(self, member_info):
+        """Get the offset of a member in the archive file."""
+        raise NotImplementedError()
+
+    def _member_range(self, member_info):
+        """
+        Get the range ``(start, end)`` of the member data in the archive
+        file, or None if the data cannot be sliced from the memory-mapped
+        archive file (e.g., it is compressed).
+        """
+        return None
+
+    def _open_member(self, member_info):
+        """Open a stream to read the content of a member."""
+        raise NotImplementedError()
+
+    def _read_member(self, member_info, zero_copy=False):
+        r = self._member_range(member_info)
+        if r is not None:
+            if zero_copy:
+                return memoryview(self._mmap)[r[0]: r[1]]
+            return self._mmap[r[0]: r[1]]
+        with maybe_close(self._open_member(member_info)) as f:
+            return f.read()
+
+    def retrieve(self, filename, meta_keys=None, zero_copy=False):
+        """
+        Retrieve the content and maybe meta data of a file.
+
+        Args:
+            filename (str): The name of the file to be retrieved.
+            meta_keys (None or Iterable[str]): The keys of the meta data
+                to be retrieved. (default :obj:`None`)
+            zero_copy (bool): If :obj:`True`, return a :class:`memoryview`
+                into the memory-mapped archive file instead of copying the
+                content into :class:`bytes`, if the content is stored
+                without compression.  (default :obj:`False`)
+
+        Returns:
+            bytes or memoryview or (bytes or memoryview,): The content, or
+                a tuple containing the content if ``meta_keys`` is not None.
+
+        Raises:
+            UnsupportedOperation: If ``meta_keys`` is not empty.
+            DataFileNotExist: If `filename` does not exist.
+        """
+        if meta_keys is not None and tuple(meta_keys):
+            raise UnsupportedOperation()
+        self.init()
+        member_info = self._get_member(filename)
+        if member_info is None:
+            raise DataFileNotExist(filename)
+        data = self._read_member(member_info, zero_copy=zero_copy)
+        return data if meta_keys is None else (data,)
+
+    def batch_retrieve(self, filenames, meta_keys=None, zero_copy=False):
+        """
+        Retrieve the content and maybe meta data of files.
+
+        Args:
+            filenames (Iterable[str]): The names of the files.
+            meta_keys (None or Iterable[str]): The keys of the meta data
+                to be retrieved. (default :obj:`None`)
+            zero_copy (bool): If :obj:`True`, return :class:`memoryview`
+                objects into the memory-mapped archive file instead of
+                copying the contents into :class:`bytes`, for the files
+                stored without compression.  (default :obj:`False`)
+
+        Returns:
+            list[bytes or memoryview or (bytes or memoryview,) or None]:
+                A list of results, each being the content, or a tuple
+                containing the content if ``meta_keys`` is not None, or
+                :obj:`None` if the corresponding file does not exist.
+
+        Raises:
+            UnsupportedOperation: If ``meta_keys`` is not empty.
+        """
+        if meta_keys is not None and tuple(meta_keys):
+            raise UnsupportedOperation()
+        self.init()
+        filenames = tuple(filenames)
+        members = [self._get_member(name) for name in filenames]
+        ret = [None] * len(filenames)
+
+        # read the members in the order of their offsets, such that
+        # the archive file is scanned forward only
+        indices = sorted(
+            (i for i, mi in enumerate(members) if mi is not None),
+            key=lambda i: self._member_offset(members[i])
+        )
+        for i in indices:
+            data = self._read_member(members[i], zero_copy=zero_copy)
+            ret[i] = data if meta_keys is None else (data,)
+        return ret
+
+    def open(self, filename, mode):
+        self.init()
+        if mode != 'r':
+            raise InvalidOpenMode(mode)
+        member_info = self._get_member(filename)
+        if member_info is None:
+            raise DataFileNotExist(filename)
+        r = self._member_range(member_info)
+        if r is not None:
+            f = BytesIO(self._mmap[r[0]: r[1]])
+        else:
+            f = self._open_member(member_info)
+        return self._active_files.add(f)
+
+    def isfile(self, filename):
+        self.init()
+        return self._get_member(filename) is not None
+
+    def _get_names(self):
+        """Get the in-memory list of file names."""
+        raise NotImplementedError()
+
+    def count(self):
+        self.init()
+        return len(self._get_names())
+
+    def iter_names(self):
+        self.init()
+        return iter(self._get_names())
+
+    def list_names(self):
+        self.init()
+        return list(self._get_names())
+
     def sample_names(self, n_samples):
-        raise UnsupportedOperation()
+        self.init()
+        return _sample_from_names(self._get_names(), n_samples)
 
     def list_meta(self, filename):
         raise UnsupportedOperation()
@@ -50,10 +214,99 @@ class _ArchiveFS(DataFS):
         raise UnsupportedOperation()
 
 
-class TarArchiveFS(_ArchiveFS):
-    """Tar archive file based :class:`DataFS`."""
+class _TarIndex(object):
+    """
+    The member index of a tar archive, mapping names to data offsets.
+
+    Each non-directory member of the archive is recorded as an entry
+    ``(offset, size, regular)``, where ``offset`` is the offset of the
+    member data in the (uncompressed) tar stream, ``size`` is the size of
+    the data, and ``regular`` indicates whether or not the data can be
+    read directly from ``offset`` (i.e., the member is a regular file).
+    """
+
+    VERSION = 1
+
+    def __init__(self, names, entries, archive_stat):
+        self.names = names  # type: list[str]
+        self.entries = entries  # type: list[tuple[int, int, bool]]
+        self.archive_stat = archive_stat  # type: tuple[int, float]
+        self.lookup = {n: i for i, n in enumerate(names)}
+
+    @staticmethod
+    def stat_archive(archive_file):
+        st = os.stat(archive_file)
+        return st.st_size, st.st_mtime
+
+    @classmethod
+    def build(cls, archive_file, canonical_path):
+        """Build the index by scanning through the archive file."""
+        archive_stat = cls.stat_archive(archive_file)
+        names = []
+        entries = []
+        with tarfile.open(archive_file, 'r') as tf:
+            for mi in tf:
+                if not mi.isdir():
+                    names.append(canonical_path(mi.name))
+                    entries.append((mi.offset_data, mi.size,
+                                    mi.isreg() and not mi.issparse()))
+        return cls(names, entries, archive_stat)
+
+    @classmethod
+    def load(cls, index_file, archive_file):
+        """
+        Load the index from `index_file`.
 
-    def __init__(self, archive_file, strict=False):
+        Returns:
+            _TarIndex or None: The loaded index, or :obj:`None` if the index
+                file does not exist, or is not built for the current
+                version of `archive_file`.
+        """
+        try:
+            with codecs.open(index_file, 'rb', 'utf-8') as f:
+                obj = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        archive_stat = cls.stat_archive(archive_file)
+        if obj.get('version') != cls.VERSION or \
+                tuple(obj.get('archive_stat', ())) != archive_stat:
+            return None
+        return cls(obj['names'], [tuple(e) for e in obj['entries']],
+                   archive_stat)
+
+    def save(self, index_file):
+        """
+        Save the index to `index_file`.
+
+        Failures (e.g., the directory is read-only) are silently ignored.
+        """
+        data = json.dumps({'version': self.VERSION,
+                           'archive_stat': list(self.archive_stat),
+                           'names': self.names,
+                           'entries': self.entries})
+        try:
+            write_file_atomic(index_file, data.encode('utf-8'))
+        except (IOError, OSError):
+            pass
+
+
+class TarArchiveFS(_ArchiveFS):
+    """
+    Tar archive file based :class:`DataFS`.
+
+    Locating a member of a tar archive requires scanning through the whole
+    archive, thus :class:`TarArchiveFS` builds an index of the members at
+    its first use, which maps the names to their data offsets.  The index
+    is saved in a side-car file along with the archive, and is reused as
+    long as the archive is not modified.
+
+    For uncompressed tar archives, the data of members are read directly
+    from a memory-mapped view of the archive file, according to the index.
+    For compressed ones, the data are read via :mod:`tarfile`.
+    """
+
+    def __init__(self, archive_file, strict=False, index_file=None,
+                 save_index=True):
         """
         Construct a new :class:`TarArchiveFS`.
 
@@ -61,55 +314,122 @@ class TarArchiveFS(_ArchiveFS):
             archive_file (str): Path of the archive file.
             strict (bool): Whether or not this :class:`DataFS` works in
                 strict mode?  (default :obj:`False`)
+            index_file (None or str): Path of the side-car index file.
+                (default :obj:`None`, ``archive_file + '.index'``)
+            save_index (bool): Whether or not to save the index to
+                `index_file`, if it is newly built?  (default :obj:`True`)
         """
         super(TarArchiveFS, self).__init__(archive_file, strict=strict)
+        if index_file is None:
+            index_file = self.archive_file + '.index'
+        self._index_file = os.path.abspath(index_file)
+        self._save_index = save_index
+        self._index = None  # type: _TarIndex
         self._file_obj = None  # type: tarfile.TarFile
-        self._active_files = ActiveFiles()
+
+    @property
+    def index_file(self):
+        """Get the absolute path of the side-car index file."""
+        return self._index_file
+
+    @property
+    def save_index(self):
+        """Whether or not to save the index, if it is newly built?"""
+        return self._save_index
+
+    def clone(self):
+        return TarArchiveFS(self.archive_file, strict=self.strict,
+                            index_file=self.index_file,
+                            save_index=self.save_index)
 
     def _init(self):
-        self._file_obj = tarfile.open(self.archive_file, 'r')
+        index = _TarIndex.load(self.index_file, self.archive_file)
+        if index is None:
+            index = _TarIndex.build(self.archive_file, self._canonical_path)
+            if self.save_index:
+                index.save(self.index_file)
+        self._index = index
+
+        # memory-map the archive if it is not compressed
+        try:
+            with tarfile.open(self.archive_file, 'r:'):
+                pass
+        except tarfile.ReadError:
+            pass
+        else:
+            self._open_mmap()
 
     def _close(self):
-        self._active_files.close_all()
-        self._file_obj.close()
-
-    def iter_names(self):
-        self.init()
-        for mi in self._file_obj:
-            if not mi.isdir():
-                yield self._canonical_path(mi.name)
+        try:
+            self._active_files.close_all()
+            if self._file_obj is not None:
+                self._file_obj.close()
+        finally:
+            self._close_mmap()
+            self._index = None
+            self._file_obj = None
+
+    def _get_file_obj(self):
+        if self._file_obj is None:
+            self._file_obj = tarfile.open(self.archive_file, 'r')
+        return self._file_obj
+
+    def _get_names(self):
+        return self._index.names
 
     def iter_files(self, meta_keys=None):
         if meta_keys:
             raise UnsupportedOperation()
         self.init()
-        for mi in self._file_obj:
-            if not mi.isdir():
-                with maybe_close(self._file_obj.extractfile(mi)) as f:
-                    cnt = f.read()
-                    yield self._canonical_path(mi.name), cnt
-
-    def open(self, filename, mode):
-        self.init()
-        if mode != 'r':
-            raise InvalidOpenMode(mode)
-        try:
-            mi = self._file_obj.getmember(filename)
-        except KeyError:
-            raise DataFileNotExist(filename)
+        if self._mmap is not None:
+            for name, entry in zip(self._index.names, self._index.entries):
+                yield name, self._read_member((name, entry))
         else:
-            return self._active_files.add(self._file_obj.extractfile(mi))
-
-    def isfile(self, filename):
-        try:
-            mi = self._file_obj.getmember(filename)
-            return not mi.isdir()
-        except KeyError:
-            return False
+            # for compressed archives, scanning through the stream is much
+            # cheaper than seeking to each member
+            with tarfile.open(self.archive_file, 'r') as tf:
+                for mi in tf:
+                    if not mi.isdir():
+                        with maybe_close(tf.extractfile(mi)) as f:
+                            cnt = f.read()
+                            yield self._canonical_path(mi.name), cnt
+
+    def _get_member(self, filename):
+        name = self._canonical_path(filename)
+        i = self._index.lookup.get(name)
+        if i is not None:
+            return name, self._index.entries[i]
+
+    def _member_offset(self, member_info):
+        return member_info[1][0]
+
+    def _member_range(self, member_info):
+        name, (offset, size, regular) = member_info
+        if self._mmap is not None and regular:
+            return offset, offset + size
+
+    def _open_member(self, member_info):
+        name, (offset, size, regular) = member_info
+        tf = self._get_file_obj()
+        if regular:
+            # reconstruct the member info from the index, such that
+            # `tarfile` would not scan through the archive to find it
+            mi = tarfile.TarInfo(name)
+            mi.offset_data = offset
+            mi.size = size
+        else:
+            mi = tf.getmember(name)
+        return tf.extractfile(mi)
 
 
 class ZipArchiveFS(_ArchiveFS):
-    """Zip archive file based :class:`DataFS`."""
+    """
+    Zip archive file based :class:`DataFS`.
+
+    The data of members stored without compression (``ZIP_STORED``) are
+    read directly from a memory-mapped view of the archive file, while
+    the compressed members are read via :mod:`zipfile`.
+    """
 
     def __init__(self, archive_file, strict=False):
         """
@@ -122,23 +442,29 @@ class ZipArchiveFS(_ArchiveFS):
         """
         super(ZipArchiveFS, self).__init__(archive_file, strict=strict)
         self._file_obj = None  # type: zipfile.ZipFile
-        self._active_files = ActiveFiles()
+        self._names = None  # type: list[str]
 
     def _init(self):
         self._file_obj = zipfile.ZipFile(self.archive_file, 'r')
+        self._names = [self._canonical_path(mi.filename)
+                       for mi in self._file_obj.infolist()
+                       if not self._isdir(mi)]
+        self._open_mmap()
 
     def _close(self):
-        self._active_files.close_all()
-        self._file_obj.close()
+        try:
+            self._active_files.close_all()
+            self._file_obj.close()
+        finally:
+            self._close_mmap()
+            self._file_obj = None
+            self._names = None
 
     def _isdir(self, member_info):
         return member_info.filename[-1] == '/'
 
-    def iter_names(self):
-        self.init()
-        for mi in self._file_obj.infolist():
-            if not self._isdir(mi):
-                yield self._canonical_path(mi.filename)
+    def _get_names(self):
+        return self._names
 
     def iter_files(self, meta_keys=None):
         if meta_keys:
@@ -146,23 +472,37 @@ class ZipArchiveFS(_ArchiveFS):
         self.init()
         for mi in self._file_obj.infolist():
             if not self._isdir(mi):
-                with maybe_close(self._file_obj.open(mi)) as f:
-                    cnt = f.read()
-                    yield self._canonical_path(mi.filename), cnt
+                yield self._canonical_path(mi.filename), self._read_member(mi)
 
-    def open(self, filename, mode):
-        self.init()
-        if mode != 'r':
-            raise InvalidOpenMode(mode)
-        try:
-            return self._active_files.add(
-                self._file_obj.open(filename, mode=mode))
-        except KeyError:
-            raise DataFileNotExist(filename)
-
-    def isfile(self, filename):
+    def _get_member(self, filename):
         try:
             mi = self._file_obj.getinfo(filename)
-            return not self._isdir(mi)
         except KeyError:
-            return False
+            return None
+        if not self._isdir(mi):
+            return mi
+
+    def _member_offset(self, member_info):
+        return member_info.header_offset
+
+    def _member_range(self, member_info):
+        # encrypted members (flag bit 0) cannot be read directly
+        if member_info.compress_type != zipfile.ZIP_STORED or \
+                member_info.flag_bits & 0x1:
+            return None
+
+        # the data follows the local file header, whose name and extra
+        # fields may differ in length from those in the central directory
+        offset = member_info.header_offset
+        header = self._mmap[offset: offset + zipfile.sizeFileHeader]
+        if len(header) != zipfile.sizeFileHeader or \
+                header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile('Bad magic number for file header')
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        start = (offset + zipfile.sizeFileHeader +
+                 fields[_ZIP_FH_FILENAME_LENGTH] +
+                 fields[_ZIP_FH_EXTRA_FIELD_LENGTH])
+        return start, start + member_info.compress_size
+
+    def _open_member(self, member_info):
+        return self._file_obj.open(member_info)
@@ -0,0 +1,321 @@
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from mlsnippet.utils import AutoInitAndCloseable
+from .base import DataFS
+from .workers import DataFSWorkerPool
+
+__all__ = ['AsyncDataFS']
+
+
+class AsyncDataFS(AutoInitAndCloseable):
+    """
+    An asyncio interface for :class:`DataFS`.
+
+    The blocking methods of the wrapped :class:`DataFS` are executed in a
+    :class:`DataFSWorkerPool`, and the results are delivered as asyncio
+    awaitables.  Since the pool has a fixed number of worker threads, any
+    number of concurrent requests can be issued without creating one
+    thread per request: the requests are queued and executed by the
+    workers one after another.
+
+    Usage::
+
+        with AsyncDataFS(fs, num_workers=16) as afs:
+            async def main():
+                data = await asyncio.gather(
+                    *[afs.get_data(name) for name in names])
+                async for name, data in afs.iter_files():
+                    ...
+
+            loop.run_until_complete(main())
+
+    Note that the operating systems do not provide asynchronous APIs for
+    regular files, thus even :class:`LocalFS` are read by the workers.
+    """
+
+    def __init__(self, fs, num_workers=8, iter_batch_size=64):
+        """
+        Construct a new :class:`AsyncDataFS`.
+
+        Args:
+            fs (DataFS): The wrapped :class:`DataFS` instance.  The workers
+                will use clones of this instance instead of itself.
+            num_workers (int): The number of worker threads, i.e., the
+                maximum number of concurrently running requests.
+                (default 8)
+            iter_batch_size (int): The number of items to fetch from the
+                underlying iterator at a time, in :meth:`iter_names` and
+                :meth:`iter_files`.  (default 64)
+        """
+        iter_batch_size = int(iter_batch_size)
+        if iter_batch_size < 1:
+            raise ValueError('`iter_batch_size` must be positive.')
+        self._fs = fs  # type: DataFS
+        self._pool = DataFSWorkerPool(fs, num_workers)
+        self._iter_batch_size = iter_batch_size
+
+    @property
+    def fs(self):
+        """Get the wrapped :class:`DataFS` instance."""
+        return self._fs
+
+    @property
+    def num_workers(self):
+        """Get the number of worker threads."""
+        return self._pool.num_workers
+
+    @property
+    def iter_batch_size(self):
+        """Get the number of items to fetch from an iterator at a time."""
+        return self._iter_batch_size
+
+    def _init(self):
+        self._pool.init()
+
+    def _close(self):
+        self._pool.close()
+
+    def __aenter__(self):
+        self.init()
+        return _completed_future(self)
+
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        # closing the pool waits for the running jobs, thus should not be
+        # executed in the event loop thread
+        return asyncio.get_event_loop().run_in_executor(None, self.close)
+
+    def _submit(self, method, *args, **kwargs):
+        self.init()
+        return asyncio.wrap_future(
+            self._pool.submit(_call_method, method, args, kwargs))
+
+    def count(self):
+        """Asynchronous version of :meth:`DataFS.count`."""
+        return self._submit('count')
+
+    def iter_names(self):
+        """
+        Asynchronous version of :meth:`DataFS.iter_names`.
+
+        Returns:
+            The asynchronous iterator of the file names.
+        """
+        return _AsyncIterator(
+            self._fs, 'iter_names', (), {}, self._iter_batch_size)
+
+    def list_names(self):
+        """Asynchronous version of :meth:`DataFS.list_names`."""
+        return self._submit('list_names')
+
+    def sample_names(self, n_samples):
+        """Asynchronous version of :meth:`DataFS.sample_names`."""
+        return self._submit('sample_names', n_samples)
+
+    def query_names(self, names_pattern=None, meta_filter=None):
+        """
+        Asynchronous version of :meth:`DataFS.query_names`.
+
+        Returns:
+            The asynchronous iterator of the matched file names.
+        """
+        return _AsyncIterator(
+            self._fs, 'query_names', (),
+            {'names_pattern': names_pattern, 'meta_filter': meta_filter},
+            self._iter_batch_size
+        )
+
+    def iter_files(self, meta_keys=None):
+        """
+        Asynchronous version of :meth:`DataFS.iter_files`.
+
+        Returns:
+            The asynchronous iterator of the files.
+        """
+        return _AsyncIterator(self._fs, 'iter_files', (),
+                              {'meta_keys': meta_keys}, self._iter_batch_size)
+
+    def query_files(self, meta_keys=None, names_pattern=None,
+                    meta_filter=None):
+        """
+        Asynchronous version of :meth:`DataFS.query_files`.
+
+        Returns:
+            The asynchronous iterator of the matched files.
+        """
+        return _AsyncIterator(
+            self._fs, 'query_files', (),
+            {'meta_keys': meta_keys, 'names_pattern': names_pattern,
+             'meta_filter': meta_filter},
+            self._iter_batch_size
+        )
+
+    def sample_files(self, n_samples, meta_keys=None):
+        """Asynchronous version of :meth:`DataFS.sample_files`."""
+        return self._submit('sample_files', n_samples, meta_keys=meta_keys)
+
+    def retrieve(self, filename, meta_keys=None):
+        """Asynchronous version of :meth:`DataFS.retrieve`."""
+        return self._submit('retrieve', filename, meta_keys=meta_keys)
+
+    def batch_retrieve(self, filenames, meta_keys=None):
+        """Asynchronous version of :meth:`DataFS.batch_retrieve`."""
+        return self._submit('batch_retrieve', tuple(filenames),
+                            meta_keys=meta_keys)
+
+    def get_data(self, filename):
+        """Asynchronous version of :meth:`DataFS.get_data`."""
+        return self._submit('get_data', filename)
+
+    def put_data(self, filename, data):
+        """Asynchronous version of :meth:`DataFS.put_data`."""
+        return self._submit('put_data', filename, data)
+
+    def isfile(self, filename):
+        """Asynchronous version of :meth:`DataFS.isfile`."""
+        return self._submit('isfile', filename)
+
+    def batch_isfile(self, filenames):
+        """Asynchronous version of :meth:`DataFS.batch_isfile`."""
+        return self._submit('batch_isfile', tuple(filenames))
+
+    def list_meta(self, filename):
+        """Asynchronous version of :meth:`DataFS.list_meta`."""
+        return self._submit('list_meta', filename)
+
+    def get_meta(self, filename, meta_keys):
+        """Asynchronous version of :meth:`DataFS.get_meta`."""
+        return self._submit('get_meta', filename, meta_keys)
+
+    def batch_get_meta(self, filenames, meta_keys):
+        """Asynchronous version of :meth:`DataFS.batch_get_meta`."""
+        return self._submit('batch_get_meta', tuple(filenames), meta_keys)
+
+    def get_meta_dict(self, filename):
+        """Asynchronous version of :meth:`DataFS.get_meta_dict`."""
+        return self._submit('get_meta_dict', filename)
+
+    def put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
+        """Asynchronous version of :meth:`DataFS.put_meta`."""
+        return self._submit('put_meta', filename, meta_dict,
+                            **meta_dict_kwargs)
+
+    def batch_put_data(self, items):
+        """Asynchronous version of :meth:`DataFS.batch_put_data`."""
+        return self._submit('batch_put_data', list(items))
+
+    def batch_put_meta(self, items):
+        """Asynchronous version of :meth:`DataFS.batch_put_meta`."""
+        return self._submit('batch_put_meta', list(items))
+
+    def clear_and_put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
+        """Asynchronous version of :meth:`DataFS.clear_and_put_meta`."""
+        return self._submit('clear_and_put_meta', filename, meta_dict,
+                            **meta_dict_kwargs)
+
+    def clear_meta(self, filename):
+        """Asynchronous version of :meth:`DataFS.clear_meta`."""
+        return self._submit('clear_meta', filename)
+
+
+def _call_method(fs, method, args, kwargs):
+    return getattr(fs, method)(*args, **kwargs)
+
+
+def _completed_future(result):
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+class _AsyncIterator(object):
+    """
+    Asynchronous iterator over a blocking iterator of a :class:`DataFS`.
+
+    The blocking iterator is consumed in a dedicated thread, with a
+    dedicated clone of the :class:`DataFS`, since the iterator must keep
+    its states between two fetches.  Items are fetched in batches, to
+    reduce the overhead of thread switching.
+    """
+
+    def __init__(self, fs, method, args, kwargs, batch_size):
+        self._fs = fs
+        self._method = method
+        self._args = args
+        self._kwargs = kwargs
+        self._batch_size = batch_size
+        self._buffer = collections.deque()
+        self._clone = None  # type: DataFS
+        self._iterator = None
+        self._executor = None  # type: ThreadPoolExecutor
+        self._exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    def _fetch_batch(self):
+        if self._iterator is None:
+            self._clone = self._fs.clone()
+            self._iterator = iter(getattr(self._clone, self._method)(
+                *self._args, **self._kwargs))
+        batch = []
+        for item in self._iterator:
+            batch.append(item)
+            if len(batch) >= self._batch_size:
+                break
+        if not batch:
+            self._close_clone()
+        return batch
+
+    def _close_clone(self):
+        if self._clone is not None:
+            self._iterator = None
+            self._clone.close()
+            self._clone = None
+
+    def __anext__(self):
+        loop = asyncio.get_event_loop()
+        result = loop.create_future()
+        if self._buffer:
+            result.set_result(self._buffer.popleft())
+            return result
+        if self._exhausted:
+            result.set_exception(StopAsyncIteration())
+            return result
+
+        def on_done(f):
+            if result.cancelled():
+                return
+            if f.exception() is not None:
+                self._shutdown()
+                result.set_exception(f.exception())
+            else:
+                batch = f.result()
+                if not batch:
+                    self._shutdown()
+                    result.set_exception(StopAsyncIteration())
+                else:
+                    self._buffer.extend(batch[1:])
+                    result.set_result(batch[0])
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        future = asyncio.wrap_future(
+            self._executor.submit(self._fetch_batch))
+        future.add_done_callback(on_done)
+        return result
+
+    def _shutdown(self):
+        self._exhausted = True
+        if self._executor is not None:
+            # the remaining job closes the clone in the executor thread
+            self._executor.submit(self._close_clone)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def aclose(self):
+        """Stop the iteration, and release the underlying resources."""
+        self._buffer.clear()
+        self._shutdown()
+        return _completed_future(None)
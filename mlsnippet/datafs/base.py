@@ -1,5 +1,7 @@
 import collections
+import random
 import re
+import shutil
 
 import six
 
@@ -102,6 +104,24 @@ class DataFSCapacity(object):
         return hash(self._mode)
 
 
+def _sample_from_names(names, n_samples):
+    """
+    Sample at most ``n_samples`` distinct names from an in-memory name list.
+
+    The cost is ``O(n_samples)`` rather than ``O(len(names))``.
+
+    Args:
+        names (list[str]): The name list.
+        n_samples (int): The number of names to sample.
+
+    Returns:
+        list[str]: The sampled names.
+    """
+    n_samples = min(n_samples, len(names))
+    return [names[i]
+            for i in random.sample(six.moves.range(len(names)), n_samples)]
+
+
 @DocInherit
 class DataFS(AutoInitAndCloseable):
     """
@@ -120,6 +140,9 @@ class DataFS(AutoInitAndCloseable):
     _buffer_size = 65536
     """The default buffer size for IO operations."""
 
+    _query_batch_size = 256
+    """The number of names to be filtered by meta values at a time."""
+
     _initialized = False
     """Whether or not this :class:`DataFS` has been initialized?"""
 
@@ -156,8 +179,18 @@ class DataFS(AutoInitAndCloseable):
         """Whether or not this :class:`DataFS` works in strict mode?"""
         return self._strict
 
+    @property
+    def buffer_size(self):
+        """Get the default buffer size for streaming IO operations."""
+        return self._buffer_size
+
     def as_flow(self, batch_size, with_names=True, meta_keys=None,
-                shuffle=False, skip_incomplete=False, names_pattern=None):
+                shuffle=False, skip_incomplete=False, names_pattern=None,
+                num_workers=None, prefetch=None, decode_fn=None,
+                decode_workers=None, columnar=False, meta_dtypes=None,
+                background=False, seed=None, shuffle_block_size=None,
+                shuffle_buffer_size=None, num_shards=None, shard_index=None,
+                shard_by='position', meta_filter=None, reuse_buffers=False):
         """
         Construct a :class:`~tfsnippet.dataflow.DataFlow`, which iterates
         through the files once and only once in an epoch.
@@ -184,6 +217,75 @@ class DataFS(AutoInitAndCloseable):
                 would the file be included in the constructed data flow.
                 Specifying this option will force loading the file list
                 into memory. (default :obj:`None`)
+            num_workers (None or int): If specified, retrieve the files of
+                the upcoming mini-batches in a pool of ``num_workers``
+                background threads.  Only effective if ``shuffle = True``,
+                or ``names_pattern`` or ``meta_filter`` is specified.
+                (default :obj:`None`)
+            prefetch (None or int): The maximum number of mini-batches to
+                be retrieved ahead of time, if ``num_workers`` is specified,
+                or ``background = True``.  (default :obj:`None`, equal to
+                ``num_workers``, or 2 in background mode)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            background (bool): Whether or not to iterate through the files
+                in a background thread, which gathers the files of the
+                upcoming mini-batches ahead of time?  Only effective if
+                ``shuffle = False``, and neither ``names_pattern`` nor
+                ``meta_filter`` is specified.  (default :obj:`False`)
+            seed (None or int): The seed for shuffling the files in each
+                epoch, if ``shuffle = True``.  (default :obj:`None`,
+                generated by the global :class:`~numpy.random.RandomState`)
+            shuffle_block_size (None or int): If specified, shuffle the
+                order of the contiguous blocks of ``shuffle_block_size``
+                files (in the order of :meth:`iter_names`), instead of
+                shuffling the files individually.  (default :obj:`None`)
+            shuffle_buffer_size (None or int): If specified, shuffle the
+                files within each contiguous window of
+                ``shuffle_buffer_size`` files (after the blocks are
+                shuffled), instead of shuffling the files individually.
+                The files of each window are kept in memory until taken
+                by the mini-batches.  These two options trade the
+                randomness for mostly sequential reading, which is much
+                faster for large archives.  (default :obj:`None`)
+            num_shards (None or int): If specified, partition the files
+                into ``num_shards`` disjoint shards, and iterate through
+                only one of them, e.g., one shard for each process in the
+                data-parallel training.  (default :obj:`None`)
+            shard_index (None or int): The index of the shard to iterate
+                through, in the range ``[0, num_shards)``.
+            shard_by ({'position', 'hash'}): Partition the files by their
+                positions in the file list, or by the hash of their names.
+                The latter does not require the file lists of all the
+                processes to be in the same order.  (default 'position')
+            meta_filter (None or dict[str, any]): If specified, only if
+                the meta values of a file equal to the values in this dict,
+                would the file be included in the constructed data flow.
+                The names are obtained by :meth:`query_names`, thus the
+                filtering might be done by the storage backend.  Specifying
+                this option will force loading the file list into memory.
+                (default :obj:`None`)
 
         Returns:
             tfsnippet.dataflow.DataFlow: A dataflow, with each mini-batch
@@ -193,23 +295,33 @@ class DataFS(AutoInitAndCloseable):
         from .dataflow import DataFSForwardFlow, DataFSIndexedFlow
 
         # quick path: use forward flow if no shuffling and name filtering
-        if not shuffle and names_pattern is None:
+        if not shuffle and names_pattern is None and not meta_filter:
             return DataFSForwardFlow(
                 fs=self.clone(),
                 batch_size=batch_size,
                 with_names=with_names,
                 meta_keys=meta_keys,
                 skip_incomplete=skip_incomplete,
+                decode_fn=decode_fn,
+                decode_workers=decode_workers,
+                columnar=columnar,
+                meta_dtypes=meta_dtypes,
+                reuse_buffers=reuse_buffers,
+                background=background,
+                prefetch=prefetch,
+                num_shards=num_shards,
+                shard_index=shard_index,
+                shard_by=shard_by,
             )
 
         # slow path: load the names, then do filtering if required,
         # and use indexed flow to serve
         else:
-            if names_pattern is None:
+            if names_pattern is None and not meta_filter:
                 names = self.list_names()
             else:
-                names_pattern = re.compile(names_pattern)
-                names = [n for n in self.iter_names() if names_pattern.match(n)]
+                names = list(self.query_names(
+                    names_pattern=names_pattern, meta_filter=meta_filter))
             return DataFSIndexedFlow(
                 fs=self.clone(),
                 names=names,
@@ -218,10 +330,27 @@ class DataFS(AutoInitAndCloseable):
                 meta_keys=meta_keys,
                 shuffle=shuffle,
                 skip_incomplete=skip_incomplete,
+                num_workers=num_workers,
+                prefetch=prefetch,
+                decode_fn=decode_fn,
+                decode_workers=decode_workers,
+                columnar=columnar,
+                meta_dtypes=meta_dtypes,
+                reuse_buffers=reuse_buffers,
+                seed=seed,
+                shuffle_block_size=shuffle_block_size,
+                shuffle_buffer_size=shuffle_buffer_size,
+                num_shards=num_shards,
+                shard_index=shard_index,
+                shard_by=shard_by,
             )
 
     def sub_flow(self, batch_size, names, with_names=True, meta_keys=None,
-                 shuffle=False, skip_incomplete=False):
+                 shuffle=False, skip_incomplete=False, num_workers=None,
+                 prefetch=None, decode_fn=None, decode_workers=None,
+                 columnar=False, meta_dtypes=None, seed=None,
+                 num_shards=None, shard_index=None, shard_by='position',
+                 reuse_buffers=False):
         """
         Construct a :class:`~tfsnippet.dataflow.DataFlow`, which iterates
         through the files according to selected `names`.
@@ -244,6 +373,48 @@ class DataFS(AutoInitAndCloseable):
                 if it has fewer data than ``batch_size``? (default
                 :obj:`False`, the final mini-batch will always be visited even
                 if it has fewer data than ``batch_size``)
+            num_workers (None or int): If specified, retrieve the files of
+                the upcoming mini-batches in a pool of ``num_workers``
+                background threads.  (default :obj:`None`)
+            prefetch (None or int): The maximum number of mini-batches to
+                be retrieved ahead of time, if ``num_workers`` is specified.
+                (default :obj:`None`, equal to ``num_workers``)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            seed (None or int): The seed for shuffling the files in each
+                epoch, if ``shuffle = True``.  (default :obj:`None`,
+                generated by the global :class:`~numpy.random.RandomState`)
+            num_shards (None or int): If specified, partition `names`
+                into ``num_shards`` disjoint shards, and iterate through
+                only one of them, e.g., one shard for each process in the
+                data-parallel training.  (default :obj:`None`)
+            shard_index (None or int): The index of the shard to iterate
+                through, in the range ``[0, num_shards)``.
+            shard_by ({'position', 'hash'}): Partition `names` by their
+                positions, or by their hash.  The latter does not require
+                `names` of all the processes to be in the same order.
+                (default 'position')
 
         Returns:
             tfsnippet.dataflow.DataFlow: A dataflow, with each mini-batch
@@ -259,10 +430,23 @@ class DataFS(AutoInitAndCloseable):
             meta_keys=meta_keys,
             shuffle=shuffle,
             skip_incomplete=skip_incomplete,
+            num_workers=num_workers,
+            prefetch=prefetch,
+            decode_fn=decode_fn,
+            decode_workers=decode_workers,
+            columnar=columnar,
+            meta_dtypes=meta_dtypes,
+            reuse_buffers=reuse_buffers,
+            seed=seed,
+            num_shards=num_shards,
+            shard_index=shard_index,
+            shard_by=shard_by,
         )
 
     def random_flow(self, batch_size, with_names=True, meta_keys=None,
-                    skip_incomplete=False, batch_count=None):
+                    skip_incomplete=False, batch_count=None, decode_fn=None,
+                    decode_workers=None, columnar=False, meta_dtypes=None,
+                    num_shards=None, shard_index=None, reuse_buffers=False):
         """
         Construct a :class:`~tfsnippet.dataflow.DataFlow`, with infinite
         or pre-configured number of mini-batches in an epoch, randomly
@@ -284,6 +468,35 @@ class DataFS(AutoInitAndCloseable):
                 if it has fewer data than ``batch_size``)
             batch_count (int or None): The number of mini-batches to obtain
                 in an epoch.  (default :obj:`None`, infinite mini-batches)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            num_shards (None or int): If specified, partition the files
+                into ``num_shards`` disjoint shards by the hash of their
+                names, and sample from only one of them.
+                (default :obj:`None`)
+            shard_index (None or int): The index of the shard to sample
+                from, in the range ``[0, num_shards)``.
 
         Returns:
             tfsnippet.dataflow.DataFlow: A dataflow, with each mini-batch
@@ -302,7 +515,14 @@ class DataFS(AutoInitAndCloseable):
             meta_keys=meta_keys,
             batch_size=batch_size,
             batch_count=batch_count,
-            skip_incomplete=skip_incomplete
+            skip_incomplete=skip_incomplete,
+            decode_fn=decode_fn,
+            decode_workers=decode_workers,
+            columnar=columnar,
+            meta_dtypes=meta_dtypes,
+            reuse_buffers=reuse_buffers,
+            num_shards=num_shards,
+            shard_index=shard_index,
         )
 
     def clone(self):
@@ -367,6 +587,47 @@ class DataFS(AutoInitAndCloseable):
         """
         raise NotImplementedError()
 
+    def query_names(self, names_pattern=None, meta_filter=None):
+        """
+        Iterate through the file names matching the specified query.
+
+        The default implementation filters the names from :meth:`iter_names`
+        in Python, with the meta values of each batch of names fetched by
+        :meth:`batch_get_meta`.  Derived classes may override this method
+        to do the filtering in the storage backend.
+
+        Args:
+            names_pattern (None or str or regex): If specified, only the
+                names matching this pattern (via ``re.match``) would be
+                included.  (default :obj:`None`)
+            meta_filter (None or dict[str, any]): If specified, only the
+                files whose meta values equal to the values in this dict
+                would be included.  An absent meta key is regarded as
+                :obj:`None`.  (default :obj:`None`)
+
+        Yields:
+            str: The file name of each matched file.
+
+        Raises:
+            UnsupportedOperation: If ``meta_filter`` is specified, but
+                ``READ_META`` capacity is absent.
+        """
+        names = self.iter_names()
+        if names_pattern is not None:
+            names_pattern = re.compile(names_pattern)
+            names = (n for n in names if names_pattern.match(n))
+        if not meta_filter:
+            for name in names:
+                yield name
+        else:
+            meta_keys = tuple(meta_filter)
+            expected = tuple(meta_filter[k] for k in meta_keys)
+            for batch in _iter_batches(names, self._query_batch_size):
+                for name, meta in zip(
+                        batch, self.batch_get_meta(batch, meta_keys)):
+                    if meta is not None and tuple(meta) == expected:
+                        yield name
+
     def iter_files(self, meta_keys=None):
         """
         Iterate through all the files in this :class:`DataFS`.
@@ -389,6 +650,42 @@ class DataFS(AutoInitAndCloseable):
         for name in self.iter_names():
             yield (name,) + self.retrieve(name, meta_keys)
 
+    def query_files(self, meta_keys=None, names_pattern=None,
+                    meta_filter=None):
+        """
+        Iterate through the files matching the specified query.
+
+        The default implementation retrieves the files of the names from
+        :meth:`query_names` by :meth:`batch_retrieve`.
+
+        Args:
+            meta_keys (None or Iterable[str]): The keys of the meta data
+                to be retrieved. (default :obj:`None`)
+            names_pattern (None or str or regex): If specified, only the
+                files whose names match this pattern (via ``re.match``)
+                would be included.  (default :obj:`None`)
+            meta_filter (None or dict[str, any]): If specified, only the
+                files whose meta values equal to the values in this dict
+                would be included.  (default :obj:`None`)
+
+        Yields:
+            (filename, content, [meta-data...]): A tuple containing the
+                name of a file, its content, and the values of each meta
+                data corresponding to ``meta_keys``.
+
+        Raises:
+            UnsupportedOperation: If ``meta_keys`` or ``meta_filter`` is
+                specified, but ``READ_META`` capacity is absent.
+        """
+        meta_keys = tuple(meta_keys or ())
+        names = self.query_names(names_pattern=names_pattern,
+                                 meta_filter=meta_filter)
+        for batch in _iter_batches(names, self._query_batch_size):
+            for name, r in zip(batch, self.batch_retrieve(batch, meta_keys)):
+                # the file might have been deleted since it was listed
+                if r is not None:
+                    yield (name,) + r
+
     def sample_files(self, n_samples, meta_keys=None):
         """
         Sample ``n_samples`` files from this :class:`DataFS`.
@@ -412,7 +709,12 @@ class DataFS(AutoInitAndCloseable):
         """
         meta_keys = tuple(meta_keys or ())
         names = self.sample_names(n_samples)
-        return [(name,) + self.retrieve(name, meta_keys) for name in names]
+        ret = []
+        for name, r in zip(names, self.batch_retrieve(names, meta_keys)):
+            if r is None:
+                raise DataFileNotExist(name)
+            ret.append((name,) + r)
+        return ret
 
     def retrieve(self, filename, meta_keys=None):
         """
@@ -445,6 +747,35 @@ class DataFS(AutoInitAndCloseable):
         else:
             return self.get_data(filename)
 
+    def batch_retrieve(self, filenames, meta_keys=None):
+        """
+        Retrieve the content and maybe meta data of files.
+
+        Args:
+            filenames (Iterable[str]): The names of the files.
+            meta_keys (None or Iterable[str]): The keys of the meta data
+                to be retrieved. (default :obj:`None`)
+
+        Returns:
+            list[bytes or (bytes, [meta-data...]) or None]: A list of
+                results, each being the content, or a tuple containing the
+                content and the meta values (as :meth:`retrieve` does), or
+                :obj:`None` if the corresponding file does not exist.
+
+        Raises:
+            UnsupportedOperation: If ``meta_keys`` is specified, but
+                ``READ_META`` capacity is absent.
+        """
+        if meta_keys is not None:
+            meta_keys = tuple(meta_keys)
+        ret = []
+        for name in filenames:
+            try:
+                ret.append(self.retrieve(name, meta_keys))
+            except DataFileNotExist:
+                ret.append(None)
+        return ret
+
     def get_data(self, filename):
         """
         Get the content of a file.
@@ -484,6 +815,79 @@ class DataFS(AutoInitAndCloseable):
         else:
             raise TypeError('`data` must be bytes or a file-like object.')
 
+    def batch_put_data(self, items):
+        """
+        Save the contents of files.  Some backends may implement this
+        method with much fewer round trips than calling :meth:`put_data`
+        repeatedly.
+
+        Args:
+            items (Iterable[(str, bytes or file-like)]): The names of the
+                files, and the contents (or file-like objects with
+                ``read(size)`` method) of these files.
+
+        Raises:
+            UnsupportedOperation: If ``WRITE_DATA`` capacity is absent.
+        """
+        for filename, data in items:
+            self.put_data(filename, data)
+
+    def iter_chunks(self, filename, chunk_size=None):
+        """
+        Iterate through the content of a file in chunks, without loading
+        the whole file into memory.
+
+        Args:
+            filename (str): The name of the file.
+            chunk_size (None or int): The maximum size of each chunk.
+                (default :obj:`None`, use :attr:`buffer_size`, or the
+                native chunk size of the backend)
+
+        Returns:
+            Iterator[bytes]: The iterator of the chunks.
+
+        Raises:
+            DataFileNotExist: If `filename` does not exist.
+        """
+        return _iter_file_chunks(self.open(filename, 'r'),
+                                 chunk_size or self.buffer_size)
+
+    def put_stream(self, filename, source):
+        """
+        Save the content of a file from a stream, without loading the whole
+        content into memory.
+
+        Args:
+            filename (str): The name of the file.
+            source (file-like or Iterable[bytes]): A file-like object with
+                ``read(size)`` method, or an iterable of content chunks.
+
+        Raises:
+            UnsupportedOperation: If ``WRITE_DATA`` capacity is absent.
+        """
+        if hasattr(source, 'read'):
+            self.put_data(filename, source)
+        else:
+            with maybe_close(self.open(filename, 'w')) as f:
+                for chunk in source:
+                    f.write(chunk)
+
+    def copy_to(self, filename, file_obj):
+        """
+        Copy the content of a file to a file-like object, without loading
+        the whole file into memory.
+
+        Args:
+            filename (str): The name of the file.
+            file_obj (file-like): The file-like object with ``write(data)``
+                method, where to copy the content.
+
+        Raises:
+            DataFileNotExist: If `filename` does not exist.
+        """
+        with maybe_close(self.open(filename, 'r')) as f:
+            shutil.copyfileobj(f, file_obj, self.buffer_size)
+
     def open(self, filename, mode):
         """
         Open a file-like object to read / write a file.
@@ -629,6 +1033,35 @@ class DataFS(AutoInitAndCloseable):
         """
         raise NotImplementedError()
 
+    def batch_put_meta(self, items):
+        """
+        Update the meta data of files.  The un-mentioned meta data will
+        remain unchanged.  Some backends may implement this method with
+        much fewer round trips than calling :meth:`put_meta` repeatedly.
+
+        The updates of different files are not applied in any particular
+        order.  If some of the files do not exist, the updates of all the
+        other files will still be applied, before raising the error.
+
+        Args:
+            items (Iterable[(str, dict[str, any])]): The names of the
+                files, and the meta values to be updated for each file.
+
+        Raises:
+            DataFileNotExist: If any of the files does not exist.
+            UnsupportedOperation: If the ``WRITE_META`` capacity (and
+                possibly the ``READ_META`` capacity) is(are) absent.
+        """
+        not_exist = None
+        for filename, meta_dict in items:
+            try:
+                self.put_meta(filename, meta_dict)
+            except DataFileNotExist as ex:
+                if not_exist is None:
+                    not_exist = ex
+        if not_exist is not None:
+            raise not_exist
+
     def clear_and_put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
         """
         Set the meta data of a file.  The un-mentioned meta data will be
@@ -662,3 +1095,23 @@ class DataFS(AutoInitAndCloseable):
                 possibly the ``LIST_META`` capacity) is(are) absent.
         """
         raise NotImplementedError()
+
+
+def _iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_file_chunks(f, chunk_size):
+    with maybe_close(f):
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
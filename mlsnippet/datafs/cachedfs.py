@@ -0,0 +1,509 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+import six
+
+from mlsnippet.utils import makedirs, write_file_atomic
+from .base import DataFS
+from .errors import DataFileNotExist, InvalidOpenMode
+
+__all__ = ['CachedDataFS']
+
+# the names of the bucket directories in the on-disk tier
+_BUCKET_NAME = re.compile(r'^[0-9a-f]{2}$')
+
+
+class _DataCache(object):
+    """
+    The cache shared by a :class:`CachedDataFS` and all its clones.
+
+    The file contents are kept in an LRU dict, whose total size is bounded
+    by `memory_limit`.  The meta values are kept in a plain dict, since
+    they are usually much smaller than the file contents.
+
+    The generation is bumped by every invalidation, such that the contents
+    or meta values fetched before a write would not be cached after the
+    write.
+    """
+
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.lock = threading.RLock()
+        self.data = OrderedDict()  # type: dict[str, bytes]
+        self.memory_size = 0
+        self.meta = {}  # type: dict[str, dict[str, any]]
+        self.generation = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_data(self, filename):
+        data = self.data.pop(filename, None)
+        if data is not None:
+            # re-insert the data to mark it as the most recently used
+            self.data[filename] = data
+        return data
+
+    def put_data(self, filename, data):
+        self.pop_data(filename)
+        if len(data) <= self.memory_limit:
+            self.data[filename] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_limit:
+                _, evicted = self.data.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def pop_data(self, filename):
+        data = self.data.pop(filename, None)
+        if data is not None:
+            self.memory_size -= len(data)
+
+    def invalidate(self, filename=None):
+        self.generation += 1
+        if filename is None:
+            self.data.clear()
+            self.memory_size = 0
+            self.meta.clear()
+        else:
+            self.pop_data(filename)
+            self.meta.pop(filename, None)
+
+    def invalidate_meta(self, filename):
+        self.generation += 1
+        self.meta.pop(filename, None)
+
+
+class CachedDataFS(DataFS):
+    """
+    A read-through cache wrapper for any :class:`DataFS`.
+
+    The file contents fetched from the wrapped :class:`DataFS` are cached
+    in a size-bounded in-memory LRU tier, and optionally in an on-disk tier
+    (which is a local directory without size limit).  The meta values are
+    also cached in memory.  This can greatly speed up the multi-epoch
+    training over a remote :class:`DataFS`, e.g., :class:`MongoFS`.
+
+    Writing a file through this :class:`CachedDataFS` would invalidate the
+    cached content or meta values of the file.  However, modifications made
+    to the wrapped :class:`DataFS` by others will not be noticed, until
+    :meth:`invalidate` is called.
+
+    The contents in the on-disk tier are stored under the hashes of the
+    file names, thus any file name is safe to be cached.  Any error in
+    reading or writing the on-disk tier is regarded as a cache miss.
+    Only the bucket directories created by the cache (named by two hex
+    digits) are removed by :meth:`invalidate`, while other entries of the
+    directory are left untouched.
+
+    The cache is shared by this :class:`CachedDataFS` and all its clones
+    (e.g., the clones held by the data flows), and can be safely accessed
+    from different threads.  :meth:`open` in ``'r'`` mode does not use the
+    cache, since it is intended to stream large files.
+    """
+
+    def __init__(self, fs, memory_limit=256 * 1024 * 1024,
+                 disk_cache_dir=None):
+        """
+        Construct a new :class:`CachedDataFS`.
+
+        Args:
+            fs (DataFS): The wrapped :class:`DataFS`.
+            memory_limit (int): The maximum total size of the file contents
+                cached in memory, in bytes.  (default 256MB)
+            disk_cache_dir (None or str): If specified, also cache the file
+                contents in this directory.  (default :obj:`None`)
+        """
+        super(CachedDataFS, self).__init__(
+            capacity=fs.capacity, strict=fs.strict)
+        if disk_cache_dir is not None:
+            disk_cache_dir = os.path.abspath(disk_cache_dir)
+            makedirs(disk_cache_dir, exist_ok=True)
+        self._fs = fs  # type: DataFS
+        self._cache = _DataCache(int(memory_limit))
+        self._disk_cache_dir = disk_cache_dir
+
+    @property
+    def fs(self):
+        """Get the wrapped :class:`DataFS`."""
+        return self._fs
+
+    @property
+    def memory_limit(self):
+        """Get the maximum total size of the contents cached in memory."""
+        return self._cache.memory_limit
+
+    @property
+    def memory_size(self):
+        """Get the total size of the contents cached in memory."""
+        return self._cache.memory_size
+
+    @property
+    def disk_cache_dir(self):
+        """Get the directory of the on-disk cache tier."""
+        return self._disk_cache_dir
+
+    @property
+    def memory_hits(self):
+        """Get the number of file contents served from memory."""
+        return self._cache.memory_hits
+
+    @property
+    def disk_hits(self):
+        """Get the number of file contents served from the disk cache."""
+        return self._cache.disk_hits
+
+    @property
+    def misses(self):
+        """Get the number of file contents fetched from the wrapped fs."""
+        return self._cache.misses
+
+    def invalidate(self, filename=None):
+        """
+        Invalidate the cached content and meta values.
+
+        Args:
+            filename (None or str): If specified, invalidate only the cache
+                of this file.  Otherwise invalidate the whole cache,
+                including the on-disk tier.  (default :obj:`None`)
+        """
+        with self._cache.lock:
+            self._cache.invalidate(filename)
+        if self._disk_cache_dir is not None:
+            if filename is None:
+                for name in os.listdir(self._disk_cache_dir):
+                    path = os.path.join(self._disk_cache_dir, name)
+                    if _BUCKET_NAME.match(name) and os.path.isdir(path) \
+                            and not os.path.islink(path):
+                        shutil.rmtree(path, ignore_errors=True)
+            else:
+                self._remove_disk_data(filename)
+
+    def _invalidate_meta(self, filename):
+        with self._cache.lock:
+            self._cache.invalidate_meta(filename)
+
+    def clone(self):
+        ret = CachedDataFS(self._fs.clone(), memory_limit=self.memory_limit,
+                           disk_cache_dir=self.disk_cache_dir)
+        ret._cache = self._cache  # share the cache with the clone
+        return ret
+
+    def _init(self):
+        self._fs.init()
+
+    def _close(self):
+        self._fs.close()
+
+    def _get_data_batch(self, filenames):
+        cache = self._cache
+        ret = [None] * len(filenames)
+        missing = []
+        with cache.lock:
+            generation = cache.generation
+            for i, name in enumerate(filenames):
+                data = cache.get_data(name)
+                if data is not None:
+                    ret[i] = data
+                    cache.memory_hits += 1
+                else:
+                    missing.append(i)
+
+        if missing and self._disk_cache_dir is not None:
+            disk_data = [self._get_disk_data(filenames[i]) for i in missing]
+            remaining = []
+            with cache.lock:
+                for i, data in zip(missing, disk_data):
+                    if data is not None:
+                        ret[i] = data
+                        if cache.generation == generation:
+                            cache.put_data(filenames[i], data)
+                        cache.disk_hits += 1
+                    else:
+                        remaining.append(i)
+            missing = remaining
+
+        if missing:
+            fetched = self._fs.batch_retrieve(
+                [filenames[i] for i in missing])
+            with cache.lock:
+                # skip caching the contents if any file has been written
+                # since the contents were fetched
+                valid = cache.generation == generation
+                for i, data in zip(missing, fetched):
+                    if data is not None:
+                        ret[i] = data
+                        if valid:
+                            cache.put_data(filenames[i], data)
+                cache.misses += len(missing)
+            if valid and self._disk_cache_dir is not None:
+                written = [filenames[i] for i, data in zip(missing, fetched)
+                           if data is not None and
+                           self._put_disk_data(filenames[i], data)]
+                # a file might be written while the contents are being
+                # saved, in which case the saved contents are dropped
+                if cache.generation != generation:
+                    for name in written:
+                        self._remove_disk_data(name)
+        return ret
+
+    def _disk_cache_path(self, filename):
+        # hash the names, such that absolute names, names with ``..``, and
+        # names nested under each other are all mapped to plain files
+        # inside the cache directory
+        if isinstance(filename, six.text_type):
+            filename = filename.encode('utf-8')
+        key = hashlib.sha1(filename).hexdigest()
+        return os.path.join(self._disk_cache_dir, key[:2], key[2:])
+
+    def _get_disk_data(self, filename):
+        try:
+            with open(self._disk_cache_path(filename), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _put_disk_data(self, filename, data):
+        path = self._disk_cache_path(filename)
+        try:
+            makedirs(os.path.dirname(path), exist_ok=True)
+            write_file_atomic(path, data)
+            return True
+        except (IOError, OSError):
+            return False
+
+    def _remove_disk_data(self, filename):
+        try:
+            os.remove(self._disk_cache_path(filename))
+        except (IOError, OSError):
+            pass
+
+    def count(self):
+        return self._fs.count()
+
+    def iter_names(self):
+        return self._fs.iter_names()
+
+    def list_names(self):
+        return self._fs.list_names()
+
+    def sample_names(self, n_samples):
+        return self._fs.sample_names(n_samples)
+
+    def query_names(self, names_pattern=None, meta_filter=None):
+        return self._fs.query_names(names_pattern=names_pattern,
+                                    meta_filter=meta_filter)
+
+    def iter_files(self, meta_keys=None):
+        return self._iter_cached_files(self._fs.iter_names(), meta_keys)
+
+    def query_files(self, meta_keys=None, names_pattern=None,
+                    meta_filter=None):
+        return self._iter_cached_files(
+            self.query_names(names_pattern=names_pattern,
+                             meta_filter=meta_filter),
+            meta_keys
+        )
+
+    def _iter_cached_files(self, names, meta_keys):
+        batch_size = 64
+        batch = []
+        for name in names:
+            batch.append(name)
+            if len(batch) >= batch_size:
+                for f in self._retrieve_files(batch, meta_keys):
+                    yield f
+                batch = []
+        if batch:
+            for f in self._retrieve_files(batch, meta_keys):
+                yield f
+
+    def _retrieve_files(self, filenames, meta_keys):
+        meta_keys = tuple(meta_keys or ())
+        for name, r in zip(filenames,
+                           self.batch_retrieve(filenames, meta_keys)):
+            # the file might have been deleted since it was listed
+            if r is not None:
+                yield (name,) + r
+
+    def sample_files(self, n_samples, meta_keys=None):
+        return list(self._retrieve_files(self.sample_names(n_samples),
+                                         meta_keys))
+
+    def retrieve(self, filename, meta_keys=None):
+        ret = self.batch_retrieve([filename], meta_keys)[0]
+        if ret is None:
+            raise DataFileNotExist(filename)
+        return ret
+
+    def batch_retrieve(self, filenames, meta_keys=None):
+        self.init()
+        filenames = tuple(filenames)
+        data = self._get_data_batch(filenames)
+        if meta_keys is None:
+            return data
+        meta_keys = tuple(meta_keys)
+        if meta_keys:
+            meta = self.batch_get_meta(
+                [n for n, d in zip(filenames, data) if d is not None],
+                meta_keys
+            )
+            meta.reverse()
+        ret = []
+        for d in data:
+            if d is None:
+                ret.append(None)
+            elif meta_keys:
+                m = meta.pop()
+                ret.append((d,) + m if m is not None else None)
+            else:
+                ret.append((d,))
+        return ret
+
+    def get_data(self, filename):
+        return self.retrieve(filename)
+
+    # The cache is shared with the clones, which may read a file while it
+    # is being written, and put the old content back into the cache.
+    # Thus the cache must be invalidated after the writing is done, which
+    # also bumps the generation of the cache, such that the contents read
+    # before then would not be cached.
+
+    def put_data(self, filename, data):
+        try:
+            self._fs.put_data(filename, data)
+        finally:
+            self.invalidate(filename)
+
+    def batch_put_data(self, items):
+        items = list(items)
+        try:
+            self._fs.batch_put_data(items)
+        finally:
+            for filename, _ in items:
+                self.invalidate(filename)
+
+    def put_stream(self, filename, source):
+        try:
+            self._fs.put_stream(filename, source)
+        finally:
+            self.invalidate(filename)
+
+    def open(self, filename, mode):
+        if mode == 'w':
+            return _InvalidateOnClose(
+                self._fs.open(filename, mode),
+                lambda: self.invalidate(filename)
+            )
+        elif mode != 'r':
+            raise InvalidOpenMode(mode)
+        return self._fs.open(filename, mode)
+
+    def iter_chunks(self, filename, chunk_size=None):
+        return self._fs.iter_chunks(filename, chunk_size)
+
+    def copy_to(self, filename, file_obj):
+        self._fs.copy_to(filename, file_obj)
+
+    def isfile(self, filename):
+        return self._fs.isfile(filename)
+
+    def batch_isfile(self, filenames):
+        return self._fs.batch_isfile(filenames)
+
+    def list_meta(self, filename):
+        return self._fs.list_meta(filename)
+
+    def get_meta(self, filename, meta_keys):
+        ret = self.batch_get_meta([filename], meta_keys)[0]
+        if ret is None:
+            raise DataFileNotExist(filename)
+        return ret
+
+    def batch_get_meta(self, filenames, meta_keys):
+        cache = self._cache
+        filenames = tuple(filenames)
+        meta_keys = tuple(meta_keys or ())
+        ret = [None] * len(filenames)
+        missing = []
+        with cache.lock:
+            generation = cache.generation
+            for i, name in enumerate(filenames):
+                meta_dict = cache.meta.get(name)
+                if meta_dict is not None and \
+                        all(k in meta_dict for k in meta_keys):
+                    ret[i] = tuple(meta_dict[k] for k in meta_keys)
+                else:
+                    missing.append(i)
+
+        if missing:
+            fetched = self._fs.batch_get_meta(
+                [filenames[i] for i in missing], meta_keys)
+            with cache.lock:
+                valid = cache.generation == generation
+                for i, meta in zip(missing, fetched):
+                    if meta is not None:
+                        ret[i] = meta
+                        if valid:
+                            cache.meta.setdefault(filenames[i], {}).update(
+                                zip(meta_keys, meta))
+        return ret
+
+    def get_meta_dict(self, filename):
+        return self._fs.get_meta_dict(filename)
+
+    def put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
+        try:
+            self._fs.put_meta(filename, meta_dict, **meta_dict_kwargs)
+        finally:
+            self._invalidate_meta(filename)
+
+    def batch_put_meta(self, items):
+        items = list(items)
+        try:
+            self._fs.batch_put_meta(items)
+        finally:
+            for filename, _ in items:
+                self._invalidate_meta(filename)
+
+    def clear_and_put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
+        try:
+            self._fs.clear_and_put_meta(filename, meta_dict,
+                                        **meta_dict_kwargs)
+        finally:
+            self._invalidate_meta(filename)
+
+    def clear_meta(self, filename):
+        try:
+            self._fs.clear_meta(filename)
+        finally:
+            self._invalidate_meta(filename)
+
+
+class _InvalidateOnClose(object):
+    """Wraps a file opened for writing, to invalidate the cache on close."""
+
+    def __init__(self, f, invalidate):
+        self._f = f
+        self._invalidate = invalidate
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def close(self):
+        try:
+            self._f.close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._invalidate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,266 @@
+import argparse
+import collections
+import sys
+import time
+
+from six.moves.urllib.parse import urlsplit, urlunsplit
+
+from mlsnippet.utils import makedirs
+from .archivefs import TarArchiveFS, ZipArchiveFS
+from .localfs import LocalFS
+from .mongofs import MongoFS
+from .workers import DataFSWorkerPool
+
+__all__ = ['CopyFSStats', 'copy_fs']
+
+
+class CopyFSStats(object):
+    """Statistics of a :func:`copy_fs` job."""
+
+    def __init__(self):
+        self.copied_files = 0
+        """The number of copied files."""
+
+        self.copied_bytes = 0
+        """The total size of the copied files."""
+
+        self.skipped_files = 0
+        """The number of files skipped, since they already exist."""
+
+        self.start_time = time.time()
+        """The start time of the job."""
+
+        self.elapsed = 0.
+        """The elapsed seconds of the job."""
+
+    @property
+    def files_per_sec(self):
+        """Get the number of copied files per second."""
+        return self.copied_files / self.elapsed if self.elapsed else 0.
+
+    @property
+    def bytes_per_sec(self):
+        """Get the number of copied bytes per second."""
+        return self.copied_bytes / self.elapsed if self.elapsed else 0.
+
+    def __str__(self):
+        return ('{} files ({:.1f} MB) copied, {} files skipped, in {:.1f}s: '
+                '{:.1f} files/s, {:.2f} MB/s'.
+                format(self.copied_files, self.copied_bytes / 1048576.,
+                       self.skipped_files, self.elapsed, self.files_per_sec,
+                       self.bytes_per_sec / 1048576.))
+
+
+def _read_batch(fs, names, meta_keys):
+    return fs.batch_retrieve(names, meta_keys)
+
+
+def _write_batch(fs, names, records, meta_keys):
+    copied_files = copied_bytes = 0
+    data_items = []
+    meta_items = []
+    for name, record in zip(names, records):
+        # the file might have been deleted since it was listed
+        if record is not None:
+            data_items.append((name, record[0]))
+            copied_files += 1
+            copied_bytes += len(record[0])
+            meta_dict = {k: v for k, v in zip(meta_keys, record[1:])
+                         if v is not None}
+            if meta_dict:
+                meta_items.append((name, meta_dict))
+    if data_items:
+        fs.batch_put_data(data_items)
+    if meta_items:
+        fs.batch_put_meta(meta_items)
+    return copied_files, copied_bytes
+
+
+def copy_fs(src, dst, meta_keys=None, workers=4, skip_existing=True,
+            batch_size=64, progress=None):
+    """
+    Copy all files from `src` to `dst`.
+
+    The files are copied in mini-batches.  The mini-batches are read from
+    `src` by a :class:`DataFSWorkerPool`, and written to `dst` by another
+    :class:`DataFSWorkerPool`, such that the reading and the writing of
+    different mini-batches can be performed concurrently.
+
+    Args:
+        src (DataFS): The source :class:`DataFS`.
+        dst (DataFS): The destination :class:`DataFS`.
+        meta_keys (None or Iterable[str]): The keys of the meta data to be
+            copied along with the files.  (default :obj:`None`)
+        workers (int): The number of workers for reading `src`, as well as
+            for writing `dst`.  (default 4)
+        skip_existing (bool): Whether or not to skip the files already
+            existing in `dst`?  (default :obj:`True`)
+        batch_size (int): The number of files in each mini-batch.
+            (default 64)
+        progress ((CopyFSStats) -> None): If specified, will be called
+            with the statistics after each mini-batch has been written.
+
+    Returns:
+        CopyFSStats: The statistics of the copy job.
+    """
+    meta_keys = tuple(meta_keys or ())
+    batch_size = int(batch_size)
+    if batch_size < 1:
+        raise ValueError('`batch_size` must be positive.')
+    max_pending = 2 * workers
+    stats = CopyFSStats()
+
+    def wait_write(future):
+        copied_files, copied_bytes = future.result()
+        stats.copied_files += copied_files
+        stats.copied_bytes += copied_bytes
+        stats.elapsed = time.time() - stats.start_time
+        if progress is not None:
+            progress(stats)
+
+    with DataFSWorkerPool(src, workers) as src_pool, \
+            DataFSWorkerPool(dst, workers) as dst_pool:
+        reading = collections.deque()
+        writing = collections.deque()
+
+        def write_one():
+            names, read_future = reading.popleft()
+            writing.append(dst_pool.submit(
+                _write_batch, names, read_future.result(), meta_keys))
+            if len(writing) >= max_pending:
+                wait_write(writing.popleft())
+
+        def read(names):
+            if skip_existing:
+                exists = dst.batch_isfile(names)
+                stats.skipped_files += sum(exists)
+                names = [n for n, e in zip(names, exists) if not e]
+            if names:
+                reading.append(
+                    (names, src_pool.submit(_read_batch, names, meta_keys)))
+                if len(reading) >= max_pending:
+                    write_one()
+
+        batch = []
+        for name in src.iter_names():
+            batch.append(name)
+            if len(batch) >= batch_size:
+                read(batch)
+                batch = []
+        if batch:
+            read(batch)
+        while reading:
+            write_one()
+        while writing:
+            wait_write(writing.popleft())
+
+    stats.elapsed = time.time() - stats.start_time
+    return stats
+
+
+def _open_fs(spec):
+    """
+    Open a :class:`DataFS` according to the command line specification.
+
+    Args:
+        spec (str): One of the following forms:
+
+            *   ``mongodb://[auth@]host[:port]/db_name/coll_name[?options]``:
+                a :class:`MongoFS`.
+            *   ``*.zip``: a :class:`ZipArchiveFS`.
+            *   ``*.tar``, ``*.tar.gz``, ``*.tgz``, ``*.tar.bz2``,
+                ``*.tbz2``, ``*.tar.xz``: a :class:`TarArchiveFS`.
+            *   other paths: a :class:`LocalFS`.  The directory will be
+                created if not exist.
+
+    Returns:
+        DataFS: The :class:`DataFS` instance.
+    """
+    if spec.startswith('mongodb://') or spec.startswith('mongodb+srv://'):
+        parts = urlsplit(spec)
+        path = parts.path.strip('/').split('/')
+        if len(path) != 2 or not all(path):
+            raise ValueError('Invalid MongoFS specification {!r}: the path '
+                             'must be `/db_name/coll_name`.'.format(spec))
+        db_name, coll_name = path
+        conn_str = urlunsplit((parts.scheme, parts.netloc, '/' + db_name,
+                               parts.query, parts.fragment))
+        return MongoFS(conn_str, db_name, coll_name)
+
+    ret = _open_archive(spec)
+    if ret is None:
+        makedirs(spec, exist_ok=True)
+        ret = LocalFS(spec)
+    return ret
+
+
+def _open_archive(path):
+    """
+    Open an archive as a :class:`DataFS`, according to its extension.
+
+    Args:
+        path (str): The path of the archive.
+
+    Returns:
+        DataFS or None: A :class:`ZipArchiveFS` or a :class:`TarArchiveFS`,
+            or :obj:`None` if `path` does not have an archive extension.
+    """
+    lower_path = path.lower()
+    if lower_path.endswith('.zip'):
+        return ZipArchiveFS(path)
+    if any(lower_path.endswith(ext) for ext in (
+            '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz')):
+        return TarArchiveFS(path)
+
+
+def main(argv=None):
+    """
+    The command line entry of :func:`copy_fs`.
+
+    Args:
+        argv (None or list[str]): The command line arguments.
+            (default :obj:`None`, use ``sys.argv[1:]``)
+    """
+    parser = argparse.ArgumentParser(
+        description='Copy all files from one DataFS to another.  '
+                    'A DataFS may be specified by a MongoDB URI in the form '
+                    '`mongodb://host[:port]/db_name/coll_name`, a zip or tar '
+                    'archive, or a local directory.'
+    )
+    parser.add_argument('src', help='The source DataFS.')
+    parser.add_argument('dst', help='The destination DataFS.')
+    parser.add_argument('-m', '--meta-keys', default='',
+                        help='Comma separated keys of the meta data to copy.')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        help='The number of reading and writing workers.')
+    parser.add_argument('-b', '--batch-size', type=int, default=64,
+                        help='The number of files in each mini-batch.')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Overwrite the files already existing in '
+                             'the destination DataFS.')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='Do not report the progress.')
+    args = parser.parse_args(argv)
+
+    last_report = [0.]
+
+    def progress(stats):
+        now = time.time()
+        if now - last_report[0] >= 1.:
+            last_report[0] = now
+            sys.stderr.write('\r{}'.format(stats))
+            sys.stderr.flush()
+
+    meta_keys = [k for k in args.meta_keys.split(',') if k]
+    with _open_fs(args.src) as src, _open_fs(args.dst) as dst:
+        stats = copy_fs(
+            src, dst, meta_keys=meta_keys, workers=args.workers,
+            skip_existing=not args.overwrite, batch_size=args.batch_size,
+            progress=None if args.quiet else progress
+        )
+    if not args.quiet:
+        sys.stderr.write('\r{}\n'.format(stats))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
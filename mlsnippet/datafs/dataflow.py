@@ -1,3 +1,8 @@
+import collections
+import itertools
+import multiprocessing
+import zlib
+
 import numpy as np
 import six
 from numpy.random import RandomState
@@ -6,6 +11,8 @@ from tfsnippet.dataflow import DataFlow
 from tfsnippet.utils import AutoInitAndCloseable, minibatch_slices_iterator
 
 from .base import DataFS
+from .errors import DataFileNotExist
+from .workers import BackgroundIterator, DataFSWorkerPool
 
 __all__ = [
     'DataFSForwardFlow',
@@ -20,7 +27,9 @@ class _BaseDataFSFlow(DataFlow, AutoInitAndCloseable):
     """
 
     def __init__(self, fs, batch_size, with_names=True, meta_keys=None,
-                 skip_incomplete=False):
+                 skip_incomplete=False, decode_fn=None, decode_workers=None,
+                 columnar=False, meta_dtypes=None, num_shards=None,
+                 shard_index=None, shard_by='position', reuse_buffers=False):
         """
         Initialize all internal states of the :class:`_BaseDataFSFlow`.
 
@@ -35,13 +44,88 @@ class _BaseDataFSFlow(DataFlow, AutoInitAndCloseable):
                 if it has fewer data than ``batch_size``?
                 (default :obj:`False`, the final mini-batch will always
                  be visited even if it has fewer data than ``batch_size``)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`,
+                decode in the iterating thread)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            num_shards (None or int): If specified, partition the files
+                into ``num_shards`` disjoint shards, and iterate through
+                only one of them.  (default :obj:`None`)
+            shard_index (None or int): The index of the shard to iterate
+                through, in the range ``[0, num_shards)``.
+            shard_by ({'position', 'hash'}): Partition the files by their
+                positions in the file list, or by the hash of their names.
+                (default 'position')
         """
         super(_BaseDataFSFlow, self).__init__()
+        if decode_workers is not None:
+            if decode_fn is None:
+                raise ValueError('`decode_workers` is specified, but '
+                                 '`decode_fn` is not.')
+            decode_workers = int(decode_workers)
+            if decode_workers < 1:
+                raise ValueError('`decode_workers` must be positive.')
+        if columnar and decode_fn is not None:
+            raise ValueError('`columnar` and `decode_fn` cannot be both '
+                             'specified.')
+        if reuse_buffers and not columnar:
+            raise ValueError('`reuse_buffers` requires `columnar = True`.')
+        if num_shards is not None or shard_index is not None:
+            if num_shards is None or shard_index is None:
+                raise ValueError('`num_shards` and `shard_index` must be '
+                                 'both specified, or both not.')
+            num_shards = int(num_shards)
+            shard_index = int(shard_index)
+            if num_shards < 1:
+                raise ValueError('`num_shards` must be positive.')
+            if not 0 <= shard_index < num_shards:
+                raise ValueError('`shard_index` must be in the range '
+                                 '[0, num_shards).')
+        if shard_by not in ('position', 'hash'):
+            raise ValueError('`shard_by` must be either \'position\' or '
+                             '\'hash\': got {!r}.'.format(shard_by))
+        meta_keys = tuple(meta_keys) if meta_keys is not None else None
+        if meta_dtypes is not None:
+            meta_dtypes = dict(meta_dtypes)
+            for k in meta_dtypes:
+                if k not in (meta_keys or ()):
+                    raise ValueError('The dtype of meta key {!r} is '
+                                     'specified, but the key is not included '
+                                     'in `meta_keys`.'.format(k))
         self._fs = fs  # type: DataFS
         self._batch_size = batch_size
         self._with_names = with_names
-        self._meta_keys = tuple(meta_keys) if meta_keys is not None else None
+        self._meta_keys = meta_keys
         self._skip_incomplete = skip_incomplete
+        self._decode_fn = decode_fn
+        self._decode_workers = decode_workers
+        self._decode_pool = None  # type: multiprocessing.Pool
+        self._columnar = bool(columnar)
+        self._reuse_buffers = bool(reuse_buffers)
+        self._meta_dtypes = meta_dtypes
+        self._num_shards = num_shards
+        self._shard_index = shard_index
+        self._shard_by = shard_by
 
     @property
     def batch_size(self):
@@ -89,28 +173,154 @@ class _BaseDataFSFlow(DataFlow, AutoInitAndCloseable):
         """
         return self._meta_keys
 
+    @property
+    def decode_fn(self):
+        """Get the function for decoding the content of each file."""
+        return self._decode_fn
+
+    @property
+    def decode_workers(self):
+        """
+        Get the number of processes for decoding the content of files.
+
+        Returns:
+            int or None: The number of processes, or :obj:`None` if the
+                content is decoded in the iterating thread.
+        """
+        return self._decode_workers
+
+    @property
+    def columnar(self):
+        """
+        Whether or not to output the contents of files as a buffer array
+        and an offsets array?
+        """
+        return self._columnar
+
+    @property
+    def reuse_buffers(self):
+        """
+        Whether or not to reuse the columnar arrays for the next mini-batch?
+        """
+        return self._reuse_buffers
+
+    @property
+    def meta_dtypes(self):
+        """
+        Get the dtypes of the meta arrays.
+
+        Returns:
+            None or dict[str, np.dtype]: The dtypes of the meta arrays,
+                or :obj:`None` if not configured.
+        """
+        return self._meta_dtypes
+
+    @property
+    def num_shards(self):
+        """
+        Get the number of shards the files are partitioned into.
+
+        Returns:
+            int or None: The number of shards, or :obj:`None` if the files
+                are not partitioned.
+        """
+        return self._num_shards
+
+    @property
+    def shard_index(self):
+        """Get the index of the shard to iterate through."""
+        return self._shard_index
+
+    @property
+    def shard_by(self):
+        """Get the method to partition the files, 'position' or 'hash'."""
+        return self._shard_by
+
+    def _is_in_shard(self, position, name):
+        """
+        Check whether or not a file belongs to the selected shard.
+
+        Args:
+            position (int): The position of the file in the file list.
+            name (str): The name of the file.
+
+        Returns:
+            bool: :obj:`True` if the file belongs to the selected shard.
+        """
+        if self._shard_by == 'position':
+            return position % self._num_shards == self._shard_index
+        return _name_shard(name, self._num_shards) == self._shard_index
+
     def _init(self):
         self.fs.init()
 
     def _close(self):
-        self.fs.close()
+        try:
+            if self._decode_pool is not None:
+                self._decode_pool.close()
+                self._decode_pool.join()
+                self._decode_pool = None
+        finally:
+            self.fs.close()
+
+    def _decode(self, contents):
+        if self._decode_workers is not None:
+            if self._decode_pool is None:
+                self._decode_pool = multiprocessing.Pool(self._decode_workers)
+            decoded = self._decode_pool.map(self._decode_fn, contents)
+        else:
+            decoded = [self._decode_fn(c) for c in contents]
+        return np.stack(decoded)
+
+    def _new_batch_generator(self):
+        return _BatchArrayGenerator(
+            self.batch_size, self.with_names, self.meta_keys,
+            columnar=self.columnar, meta_dtypes=self.meta_dtypes,
+            reuse_buffers=self.reuse_buffers
+        )
+
+    def _make_arrays(self, g):
+        """
+        Make the mini-batch arrays from the gathered data.
+
+        Args:
+            g (_BatchArrayGenerator): The gathered data.
+
+        Returns:
+            tuple[np.ndarray]: The mini-batch arrays.
+        """
+        if self._decode_fn is None:
+            return g.to_arrays()
+        return g.to_arrays(self._decode(g.buffers[g.data_index]))
 
 
 class _BatchArrayGenerator(object):
     """
     A helper class for gathering data from :class:`DataFS` into mini-batches.
+
+    In columnar mode, the contents are copied into a ``uint8`` buffer, and
+    the meta values with declared dtypes are copied into typed arrays, such
+    that no padded ``bytes`` array would be allocated.  These arrays are
+    reused by the next mini-batch if `reuse_buffers` is :obj:`True`.
     """
 
-    def __init__(self, batch_size, with_names, meta_keys):
+    def __init__(self, batch_size, with_names, meta_keys, columnar=False,
+                 meta_dtypes=None, reuse_buffers=False):
         meta_keys = meta_keys or ()
         self.batch_size = batch_size
         self.with_names = with_names
         self.meta_keys = meta_keys
+        self.columnar = columnar
+        self.reuse_buffers = reuse_buffers
+        self.meta_dtypes = tuple((meta_dtypes or {}).get(k) for k in meta_keys)
         self.buffers = [
             [] for _ in range(int(with_names) +  # optional file name
                               1 +  # file data
                               len(meta_keys))  # optional file meta
         ]
+        self._data_buffer = None  # type: np.ndarray
+        self._data_offsets = None  # type: np.ndarray
+        self._meta_arrays = [None] * len(meta_keys)  # type: list[np.ndarray]
 
         if with_names:
             def add(name, data, meta=()):
@@ -126,14 +336,67 @@ class _BatchArrayGenerator(object):
                     buf.append(val)
         self.add = add
 
-    def to_arrays(self):
-        if self.with_names:
-            return ((np.asarray(self.buffers[0], dtype=str),
-                     np.asarray(self.buffers[1], dtype=six.binary_type),) +
-                    tuple(np.asarray(buf) for buf in self.buffers[2:]))
+    @property
+    def data_index(self):
+        return int(self.with_names)
+
+    def _columnar_data_arrays(self, contents):
+        count = len(contents)
+        if not self.reuse_buffers:
+            offsets = np.empty(count + 1, dtype=np.int64)
+            offsets[0] = 0
+            np.cumsum([len(c) for c in contents], out=offsets[1:])
+            buffer = np.empty(int(offsets[-1]), dtype=np.uint8)
+            for c, start, end in zip(contents, offsets[:-1], offsets[1:]):
+                buffer[start: end] = np.frombuffer(c, dtype=np.uint8)
+            return buffer, offsets
+
+        if self._data_offsets is None or len(self._data_offsets) <= count:
+            self._data_offsets = np.empty(
+                max(count, self.batch_size) + 1, dtype=np.int64)
+        offsets = self._data_offsets[:count + 1]
+        offsets[0] = 0
+        np.cumsum([len(c) for c in contents], out=offsets[1:])
+        size = int(offsets[-1])
+
+        # grow the buffer geometrically, to avoid frequent re-allocation
+        if self._data_buffer is None or len(self._data_buffer) < size:
+            old_size = (len(self._data_buffer)
+                        if self._data_buffer is not None else 0)
+            self._data_buffer = np.empty(max(size, old_size * 2),
+                                         dtype=np.uint8)
+        buffer = self._data_buffer[:size]
+        for c, start, end in zip(contents, offsets[:-1], offsets[1:]):
+            buffer[start: end] = np.frombuffer(c, dtype=np.uint8)
+        return buffer, offsets
+
+    def _meta_array(self, j, values):
+        dtype = self.meta_dtypes[j]
+        if dtype is None:
+            return np.asarray(values)
+        if not self.reuse_buffers:
+            return np.asarray(values, dtype=dtype)
+        arr = self._meta_arrays[j]
+        if arr is None or len(arr) < len(values):
+            arr = self._meta_arrays[j] = np.empty(
+                max(len(values), self.batch_size), dtype=dtype)
+        arr = arr[:len(values)]
+        arr[:] = values
+        return arr
+
+    def to_arrays(self, data_array=None):
+        i = self.data_index
+        if self.columnar:
+            data_arrays = self._columnar_data_arrays(self.buffers[i])
         else:
-            return ((np.asarray(self.buffers[0], dtype=six.binary_type),) +
-                    tuple(np.asarray(buf) for buf in self.buffers[1:]))
+            if data_array is None:
+                data_array = np.asarray(self.buffers[i],
+                                        dtype=six.binary_type)
+            data_arrays = (data_array,)
+        names = (np.asarray(self.buffers[0], dtype=str),) if i else ()
+        return (names + data_arrays +
+                tuple(self._meta_array(j, buf)
+                      for j, buf in enumerate(self.buffers[i + 1:])))
 
     def clear_all(self):
         for buf in self.buffers:
@@ -145,7 +408,7 @@ class _BatchArrayGenerator(object):
 
     @property
     def not_empty(self):
-        return len(self.buffers[0]) >= 0
+        return len(self.buffers[0]) > 0
 
 
 class DataFSForwardFlow(_BaseDataFSFlow):
@@ -155,7 +418,10 @@ class DataFSForwardFlow(_BaseDataFSFlow):
     """
 
     def __init__(self, fs, batch_size, with_names=True, meta_keys=None,
-                 skip_incomplete=False):
+                 skip_incomplete=False, decode_fn=None, decode_workers=None,
+                 columnar=False, meta_dtypes=None, background=False,
+                 prefetch=None, num_shards=None, shard_index=None,
+                 shard_by='position', reuse_buffers=False):
         """
         Construct a new :class:`DataFSForwardFlow`.
 
@@ -170,25 +436,171 @@ class DataFSForwardFlow(_BaseDataFSFlow):
                 if it has fewer data than ``batch_size``? (default
                 :obj:`False`, the final mini-batch will always be visited even
                 if it has fewer data than ``batch_size``)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`,
+                decode in the iterating thread)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            background (bool): Whether or not to run :meth:`iter_files`
+                in a background thread, which gathers the files of the
+                upcoming mini-batches ahead of time?  (default :obj:`False`)
+            prefetch (None or int): The maximum number of mini-batches to
+                be gathered ahead of time, if ``background = True``.
+                (default :obj:`None`, 2 mini-batches)
+            num_shards (None or int): If specified, partition the files
+                into ``num_shards`` disjoint shards, and iterate through
+                only one of them.  The names are then obtained by
+                :meth:`iter_names`, and only the files of the selected
+                shard are read by :meth:`batch_retrieve`.
+                (default :obj:`None`)
+            shard_index (None or int): The index of the shard to iterate
+                through, in the range ``[0, num_shards)``.
+            shard_by ({'position', 'hash'}): Partition the files by their
+                positions in :meth:`iter_names`, or by the hash of their
+                names.  (default 'position')
         """
         super(DataFSForwardFlow, self).__init__(
             fs=fs,
             batch_size=batch_size,
             with_names=with_names,
             meta_keys=meta_keys,
-            skip_incomplete=skip_incomplete
+            skip_incomplete=skip_incomplete,
+            decode_fn=decode_fn,
+            decode_workers=decode_workers,
+            columnar=columnar,
+            meta_dtypes=meta_dtypes,
+            reuse_buffers=reuse_buffers,
+            num_shards=num_shards,
+            shard_index=shard_index,
+            shard_by=shard_by,
         )
+        if background:
+            prefetch = 2 if prefetch is None else int(prefetch)
+            if prefetch < 1:
+                raise ValueError('`prefetch` must be positive.')
+        else:
+            prefetch = None
+        self._background = bool(background)
+        self._prefetch = prefetch
+        self._background_iterator = None  # type: BackgroundIterator
+
+    @property
+    def background(self):
+        """
+        Whether or not to run :meth:`iter_files` in a background thread?
+        """
+        return self._background
+
+    @property
+    def prefetch(self):
+        """
+        Get the maximum number of mini-batches to be gathered ahead of time.
+
+        Returns:
+            int or None: The number of mini-batches, or :obj:`None` if the
+                files are gathered in the iterating thread.
+        """
+        return self._prefetch
+
+    def _close(self):
+        try:
+            # the background thread must exit before closing the fs
+            if self._background_iterator is not None:
+                self._background_iterator.close()
+                self._background_iterator = None
+        finally:
+            super(DataFSForwardFlow, self)._close()
+
+    def _iter_files(self):
+        if self._num_shards is None:
+            return self.fs.iter_files(meta_keys=self.meta_keys)
+        return self._iter_shard_files()
+
+    def _iter_shard_files(self):
+        meta_keys = tuple(self.meta_keys or ())
+
+        def retrieve(names):
+            for name, r in zip(names,
+                               self.fs.batch_retrieve(names, meta_keys)):
+                # the file might have been deleted since it was listed
+                if r is not None:
+                    yield (name,) + r
+
+        names = []
+        for i, name in enumerate(self.fs.iter_names()):
+            if self._is_in_shard(i, name):
+                names.append(name)
+                if len(names) >= self.batch_size:
+                    for f in retrieve(names):
+                        yield f
+                    names = []
+        if names:
+            for f in retrieve(names):
+                yield f
+
+    def _iter_file_batches(self):
+        batch = []
+        for f in self._iter_files():
+            batch.append(f)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _background_minibatch_iterator(self):
+        # only the raw files are gathered by the background thread, while
+        # the arrays are made in the iterating thread, since the buffers
+        # of the arrays might be reused by the next mini-batch
+        g = self._new_batch_generator()
+        it = BackgroundIterator(self._iter_file_batches, self._prefetch)
+        self._background_iterator = it
+        try:
+            for batch in it:
+                if len(batch) < self.batch_size and self.skip_incomplete:
+                    continue
+                for f in batch:
+                    g.add(f[0], f[1], f[2:])
+                yield self._make_arrays(g)
+                g.clear_all()
+        finally:
+            it.close()
+            if self._background_iterator is it:
+                self._background_iterator = None
 
     def _minibatch_iterator(self):
-        g = _BatchArrayGenerator(
-            self.batch_size, self.with_names, self.meta_keys)
-        for f in self.fs.iter_files(meta_keys=self.meta_keys):
+        if self._background:
+            for b in self._background_minibatch_iterator():
+                yield b
+            return
+
+        g = self._new_batch_generator()
+        for f in self._iter_files():
             g.add(f[0], f[1], f[2:])
             if g.full_batch:
-                yield g.to_arrays()
+                yield self._make_arrays(g)
                 g.clear_all()
         if g.not_empty and (g.full_batch or not self.skip_incomplete):
-            yield g.to_arrays()
+            yield self._make_arrays(g)
 
 
 class DataFSIndexedFlow(_BaseDataFSFlow):
@@ -198,7 +610,12 @@ class DataFSIndexedFlow(_BaseDataFSFlow):
     """
 
     def __init__(self, fs, batch_size, names, with_names=True, meta_keys=None,
-                 shuffle=False, skip_incomplete=False, random_state=None):
+                 shuffle=False, skip_incomplete=False, random_state=None,
+                 num_workers=None, prefetch=None, decode_fn=None,
+                 decode_workers=None, columnar=False, meta_dtypes=None,
+                 seed=None, shuffle_block_size=None, shuffle_buffer_size=None,
+                 num_shards=None, shard_index=None, shard_by='position',
+                 reuse_buffers=False):
         """
         Construct a new :class:`DataFSIndexedFlow`.
 
@@ -217,25 +634,126 @@ class DataFSIndexedFlow(_BaseDataFSFlow):
                 :obj:`False`, the final mini-batch will always be visited even
                 if it has fewer data than ``batch_size``)
             random_state (RandomState): Optional numpy RandomState for
-                shuffling data before each epoch.  (default :obj:`None`,
-                use the global :class:`RandomState`).
+                generating `seed`, if `seed` is not specified.
+                (default :obj:`None`, use the global :class:`RandomState`).
+            num_workers (None or int): If specified, retrieve the files of
+                the upcoming mini-batches in a pool of ``num_workers``
+                background threads, each owning a clone of `fs`.
+                (default :obj:`None`, retrieve the files in the iterating
+                thread)
+            prefetch (None or int): The maximum number of mini-batches to
+                be retrieved ahead of time, if ``num_workers`` is specified.
+                (default :obj:`None`, equal to ``num_workers``)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`,
+                decode in the iterating thread)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            seed (None or int): The seed for shuffling.  The names of each
+                epoch are shuffled by ``RandomState([seed, epoch])``, such
+                that any epoch can be reproduced.  (default :obj:`None`,
+                generated by `random_state` if ``shuffle = True``)
+            shuffle_block_size (None or int): If specified, shuffle the
+                order of the contiguous blocks of ``shuffle_block_size``
+                names, instead of shuffling the names individually.
+                Requires ``shuffle = True``.  (default :obj:`None`)
+            shuffle_buffer_size (None or int): If specified, shuffle the
+                names within each contiguous window of ``shuffle_buffer_size``
+                names (after the blocks are shuffled), instead of shuffling
+                the names individually.  The files of each window are read
+                in the order of `names`, and are kept in memory until taken
+                by the mini-batches.  Requires ``shuffle = True``.
+                (default :obj:`None`)
+            num_shards (None or int): If specified, partition `names`
+                into ``num_shards`` disjoint shards, and iterate through
+                only one of them.  (default :obj:`None`)
+            shard_index (None or int): The index of the shard to iterate
+                through, in the range ``[0, num_shards)``.
+            shard_by ({'position', 'hash'}): Partition `names` by their
+                positions, or by their hash.  (default 'position')
+
+        Notes:
+            Shuffling in blocks and in windows trades the randomness for
+            mostly sequential reading, which is much faster than the random
+            reading for large archives, e.g., :class:`TarArchiveFS`.
         """
         super(DataFSIndexedFlow, self).__init__(
             fs=fs,
             batch_size=batch_size,
             with_names=with_names,
             meta_keys=meta_keys,
-            skip_incomplete=skip_incomplete
+            skip_incomplete=skip_incomplete,
+            decode_fn=decode_fn,
+            decode_workers=decode_workers,
+            columnar=columnar,
+            meta_dtypes=meta_dtypes,
+            reuse_buffers=reuse_buffers,
+            num_shards=num_shards,
+            shard_index=shard_index,
+            shard_by=shard_by,
         )
+        if num_shards is not None:
+            names = [n for i, n in enumerate(names)
+                     if self._is_in_shard(i, n)]
         self._names = np.asarray(names, dtype=str)
         self._is_shuffled = shuffle
         self._cached_indices = None  # np.ndarray
-        self._random_state = random_state or np.random
+        if shuffle_block_size is not None or shuffle_buffer_size is not None:
+            if not shuffle:
+                raise ValueError('`shuffle_block_size` and '
+                                 '`shuffle_buffer_size` require '
+                                 '`shuffle = True`.')
+            if shuffle_block_size is not None:
+                shuffle_block_size = int(shuffle_block_size)
+                if shuffle_block_size < 1:
+                    raise ValueError('`shuffle_block_size` must be positive.')
+            if shuffle_buffer_size is not None:
+                shuffle_buffer_size = int(shuffle_buffer_size)
+                if shuffle_buffer_size < 1:
+                    raise ValueError(
+                        '`shuffle_buffer_size` must be positive.')
+        self._shuffle_block_size = shuffle_block_size
+        self._shuffle_buffer_size = shuffle_buffer_size
+        if seed is None and shuffle:
+            seed = (random_state or np.random).randint(0, 2 ** 31 - 1)
+        self._seed = int(seed) if seed is not None else None
+        self._epoch = 0
+        self._step = 0
+        self._resuming = False
+
+        if num_workers:
+            prefetch = num_workers if prefetch is None else int(prefetch)
+            if prefetch < 1:
+                raise ValueError('`prefetch` must be positive.')
+            self._worker_pool = DataFSWorkerPool(fs, num_workers)
+        else:
+            prefetch = None
+            self._worker_pool = None
+        self._prefetch = prefetch
 
     @property
     def names(self):
         """
-        Get the names of files to retrieve.
+        Get the names of files to retrieve (in the selected shard).
 
         Returns:
             np.ndarray[str]: The names, as numpy array.
@@ -249,7 +767,115 @@ class DataFSIndexedFlow(_BaseDataFSFlow):
         """
         return self._is_shuffled
 
-    def _shuffled_indices_iterator(self):
+    @property
+    def shuffle_block_size(self):
+        """Get the number of contiguous names in each shuffling block."""
+        return self._shuffle_block_size
+
+    @property
+    def shuffle_buffer_size(self):
+        """Get the number of contiguous names in each shuffling window."""
+        return self._shuffle_buffer_size
+
+    @property
+    def seed(self):
+        """
+        Get the seed for shuffling.
+
+        Returns:
+            int or None: The seed, or :obj:`None` if the names are not
+                shuffled and no seed is specified.
+        """
+        return self._seed
+
+    @property
+    def epoch(self):
+        """Get the index of the current (or the next) epoch."""
+        return self._epoch
+
+    @property
+    def step(self):
+        """Get the number of mini-batches taken in the current epoch."""
+        return self._step
+
+    def get_state(self):
+        """
+        Get the iteration state of this flow.
+
+        The state can be saved along with the training checkpoints, and
+        be restored by :meth:`set_state`, such that an interrupted epoch
+        can be resumed from the next mini-batch, without reading the files
+        of the mini-batches already taken.
+
+        Returns:
+            dict[str, int]: The state, with keys ``seed``, ``epoch`` and
+                ``step``.
+        """
+        return {'seed': self._seed, 'epoch': self._epoch, 'step': self._step}
+
+    def set_state(self, state):
+        """
+        Restore the iteration state of this flow.
+
+        The next iteration will start from the ``step``-th mini-batch of
+        the ``epoch``-th epoch, where the names are shuffled by ``seed``.
+
+        Args:
+            state (dict[str, int]): The state obtained by :meth:`get_state`.
+        """
+        seed = state['seed']
+        epoch = int(state['epoch'])
+        step = int(state['step'])
+        if epoch < 0 or step < 0:
+            raise ValueError('Invalid state {!r}: `epoch` and `step` must '
+                             'not be negative.'.format(state))
+        if seed is None and self._is_shuffled:
+            raise ValueError('Invalid state {!r}: `seed` is required by a '
+                             'shuffled flow.'.format(state))
+        self._seed = int(seed) if seed is not None else None
+        self._epoch = epoch
+        self._step = step
+        self._resuming = True
+
+    @property
+    def num_workers(self):
+        """
+        Get the number of background threads for retrieving files.
+
+        Returns:
+            int or None: The number of threads, or :obj:`None` if the
+                files are retrieved in the iterating thread.
+        """
+        if self._worker_pool is not None:
+            return self._worker_pool.num_workers
+
+    @property
+    def prefetch(self):
+        """
+        Get the maximum number of mini-batches to be retrieved ahead of time.
+
+        Returns:
+            int or None: The number of mini-batches, or :obj:`None` if the
+                files are retrieved in the iterating thread.
+        """
+        return self._prefetch
+
+    def _close(self):
+        try:
+            if self._worker_pool is not None:
+                self._worker_pool.close()
+        finally:
+            super(DataFSIndexedFlow, self)._close()
+
+    @staticmethod
+    def _retrieve_batch(fs, names, meta_keys):
+        ret = fs.batch_retrieve(names, meta_keys=meta_keys)
+        for name, r in zip(names, ret):
+            if r is None:
+                raise DataFileNotExist(name)
+        return ret
+
+    def _shuffled_indices(self):
         # reuse indices
         if self._cached_indices is None:
             indices_dtype = (
@@ -259,9 +885,30 @@ class DataFSIndexedFlow(_BaseDataFSFlow):
                 len(self.names), dtype=indices_dtype)
         indices = self._cached_indices
 
-        # shuffle indices
-        self._random_state.shuffle(indices)
+        # shuffle indices, starting from the identity permutation, such
+        # that the order of each epoch depends only on the seed and epoch
+        indices.sort()
+        random_state = RandomState([self._seed, self._epoch])
+        block_size = self._shuffle_block_size
+        buffer_size = self._shuffle_buffer_size
+        if block_size is None and buffer_size is None:
+            random_state.shuffle(indices)
+        elif len(indices) > 0:
+            if block_size is not None:
+                # shuffle the order of the contiguous blocks
+                block_count = (len(indices) + block_size - 1) // block_size
+                indices[:] = np.concatenate([
+                    indices[i * block_size: (i + 1) * block_size]
+                    for i in random_state.permutation(block_count)
+                ])
+            if buffer_size is not None:
+                # shuffle the indices within each window of `buffer_size`
+                for i in range(0, len(indices), buffer_size):
+                    random_state.shuffle(indices[i: i + buffer_size])
+        return indices
 
+    def _shuffled_indices_iterator(self):
+        indices = self._shuffled_indices()
         for s in minibatch_slices_iterator(
                 length=len(self.names),
                 batch_size=self.batch_size,
@@ -275,27 +922,107 @@ class DataFSIndexedFlow(_BaseDataFSFlow):
             skip_incomplete=self.skip_incomplete
         )
 
+    def _buffered_batches_iterator(self, meta_keys):
+        # The files of each shuffling window are read in the order of the
+        # names, and are kept in memory until taken by the mini-batches,
+        # thus at most ``shuffle_buffer_size + batch_size`` files would be
+        # kept in memory.
+        indices = self._shuffled_indices()
+        buffer_size = self._shuffle_buffer_size
+        records = {}
+
+        def load_window(start, stop):
+            window = np.sort(indices[start: stop])
+            chunks = [window[i: i + self.batch_size]
+                      for i in range(0, len(window), self.batch_size)]
+            if self._worker_pool is None:
+                results = (
+                    self._retrieve_batch(self.fs, self.names[c], meta_keys)
+                    for c in chunks
+                )
+            else:
+                futures = [
+                    self._worker_pool.submit(
+                        self._retrieve_batch, self.names[c], meta_keys)
+                    for c in chunks
+                ]
+                results = (f.result() for f in futures)
+            for c, r in zip(chunks, results):
+                records.update(zip(c.tolist(), r))
+
+        # the mini-batches already taken in this epoch are skipped, as well
+        # as their files
+        loaded = self._step * self.batch_size
+        for s in itertools.islice(self._normal_indices_iterator(),
+                                  self._step, None):
+            while loaded < s.stop:
+                stop = min(len(indices),
+                           (loaded // buffer_size + 1) * buffer_size)
+                load_window(loaded, stop)
+                loaded = stop
+            s_indices = indices[s]
+            yield (self.names[s_indices],
+                   [records.pop(i) for i in s_indices.tolist()])
+
     def _minibatch_iterator(self):
-        # iterate through mini-batches
-        if self.is_shuffled:
-            indices_iter = self._shuffled_indices_iterator()
-        else:
-            indices_iter = self._normal_indices_iterator()
+        # start a new epoch, unless resuming from a restored state
+        if self._step > 0 and not self._resuming:
+            self._epoch += 1
+            self._step = 0
+        self._resuming = False
 
         # for gathering batch arrays
-        g = _BatchArrayGenerator(
-            self.batch_size, self.with_names, self.meta_keys)
+        g = self._new_batch_generator()
 
         # produce the mini-batches
         meta_keys = tuple(self.meta_keys or ())
-        for s in indices_iter:
-            s_names = self.names[s]
-            s_data = [self.fs.retrieve(name, meta_keys=meta_keys)
-                      for name in s_names]
+
+        def make_arrays(s_names, s_data):
             for n, d in zip(s_names, s_data):
                 g.add(n, d[0], d[1:])
-            yield g.to_arrays()
+            ret = self._make_arrays(g)
             g.clear_all()
+            self._step += 1
+            return ret
+
+        if self.is_shuffled and self._shuffle_buffer_size is not None:
+            for s_names, s_data in self._buffered_batches_iterator(meta_keys):
+                yield make_arrays(s_names, s_data)
+
+        else:
+            # iterate through mini-batches, skipping the taken ones
+            if self.is_shuffled:
+                indices_iter = self._shuffled_indices_iterator()
+            else:
+                indices_iter = self._normal_indices_iterator()
+            indices_iter = itertools.islice(indices_iter, self._step, None)
+
+            if self._worker_pool is None:
+                for s in indices_iter:
+                    s_names = self.names[s]
+                    yield make_arrays(
+                        s_names,
+                        self._retrieve_batch(self.fs, s_names, meta_keys)
+                    )
+
+            else:
+                # keep at most `prefetch` mini-batches in flight, and yield
+                # them in the order of submission
+                pending = collections.deque()
+                for s in indices_iter:
+                    s_names = self.names[s]
+                    pending.append((s_names, self._worker_pool.submit(
+                        self._retrieve_batch, s_names, meta_keys)))
+                    if len(pending) >= self._prefetch:
+                        s_names, future = pending.popleft()
+                        yield make_arrays(s_names, future.result())
+                while pending:
+                    s_names, future = pending.popleft()
+                    yield make_arrays(s_names, future.result())
+
+        # the epoch is completed
+        self._epoch += 1
+        self._step = 0
 
 
 class DataFSRandomFlow(_BaseDataFSFlow):
@@ -304,8 +1031,13 @@ class DataFSRandomFlow(_BaseDataFSFlow):
     from the :class:`DataFS`.
     """
 
+    _max_shard_sample_rounds = 16
+    """The maximum number of rounds to sample names for a sharded batch."""
+
     def __init__(self, fs, batch_size, with_names=True, meta_keys=None,
-                 batch_count=None, skip_incomplete=False):
+                 batch_count=None, skip_incomplete=False, decode_fn=None,
+                 decode_workers=None, columnar=False, meta_dtypes=None,
+                 num_shards=None, shard_index=None, reuse_buffers=False):
         """
         Construct a new :class:`DataFSRandomFlow`.
 
@@ -322,10 +1054,47 @@ class DataFSRandomFlow(_BaseDataFSFlow):
                 if it has fewer data than ``batch_size``? (default
                 :obj:`False`, the final mini-batch will always be visited even
                 if it has fewer data than ``batch_size``)
+            decode_fn ((bytes) -> np.ndarray): If specified, decode the
+                content of each file by this function, and stack the decoded
+                arrays as the content array of mini-batches.
+                (default :obj:`None`)
+            decode_workers (None or int): If specified, run ``decode_fn``
+                in a pool of ``decode_workers`` processes, in which case
+                ``decode_fn`` must be picklable.  (default :obj:`None`,
+                decode in the iterating thread)
+            columnar (bool): If :obj:`True`, the contents of files will be
+                concatenated into a ``uint8`` buffer array, followed by an
+                ``int64`` offsets array, instead of being a ``bytes`` array.
+                The arrays are reused by the next mini-batch only if
+                ``reuse_buffers = True``.
+                Cannot be specified along with ``decode_fn``.
+                (default :obj:`False`)
+            meta_dtypes (None or dict[str, np.dtype]): The dtypes of the
+                meta arrays.  (default :obj:`None`, infer the dtypes)
+            reuse_buffers (bool): If :obj:`True`, reuse the columnar arrays
+                of contents and the typed meta arrays for the next
+                mini-batch, to avoid re-allocation.  The arrays of a
+                mini-batch must then not be kept after the next mini-batch
+                is taken, thus this should not be used along with
+                ``get_arrays()`` or prefetching.  Requires ``columnar =
+                True``.  (default :obj:`False`)
+            num_shards (None or int): If specified, partition the files
+                into ``num_shards`` disjoint shards by the hash of their
+                names, and sample from only one of them.  The names are
+                then sampled by :meth:`sample_names`, and only the files of
+                the selected shard are read by :meth:`batch_retrieve`.
+                A mini-batch might have fewer than ``batch_size`` files if
+                the shard is very small.  (default :obj:`None`)
+            shard_index (None or int): The index of the shard to sample
+                from, in the range ``[0, num_shards)``.
         """
         super(DataFSRandomFlow, self).__init__(
             fs, batch_size=batch_size, with_names=with_names,
-            meta_keys=meta_keys, skip_incomplete=skip_incomplete
+            meta_keys=meta_keys, skip_incomplete=skip_incomplete,
+            decode_fn=decode_fn, decode_workers=decode_workers,
+            columnar=columnar, meta_dtypes=meta_dtypes,
+            reuse_buffers=reuse_buffers,
+            num_shards=num_shards, shard_index=shard_index, shard_by='hash'
         )
         if batch_count is not None:
             if batch_count <= 0:
@@ -351,15 +1120,55 @@ class DataFSRandomFlow(_BaseDataFSFlow):
         """Get the number of mini-batches to obtain in an epoch."""
         return self._batch_count
 
+    def _sample_shard_files(self):
+        # sample ``batch_size * num_shards`` names at a time, such that
+        # about ``batch_size`` of them are expected to be in the shard
+        n_samples = self.batch_size * self._num_shards
+        names = []
+        names_set = set()
+        for _ in range(self._max_shard_sample_rounds):
+            samples = self.fs.sample_names(n_samples)
+            for n in samples:
+                if n not in names_set and self._is_in_shard(None, n):
+                    names.append(n)
+                    names_set.add(n)
+            if len(names) >= self.batch_size or len(samples) < n_samples:
+                # enough names, or all the files have been sampled
+                break
+        if not names:
+            raise ValueError('No file can be sampled from the shard {} of '
+                             '{} shards: the shard might be empty.'.
+                             format(self._shard_index, self._num_shards))
+        names = names[:self.batch_size]
+
+        ret = []
+        meta_keys = tuple(self.meta_keys or ())
+        for name, r in zip(names, self.fs.batch_retrieve(names, meta_keys)):
+            if r is None:
+                raise DataFileNotExist(name)
+            ret.append((name,) + r)
+        return ret
+
     def _minibatch_iterator(self):
-        g = _BatchArrayGenerator(batch_size=self.batch_size,
-                                 with_names=self.with_names,
-                                 meta_keys=self.meta_keys)
+        g = self._new_batch_generator()
         for _ in self._loop_generator():
-            batch = self.fs.sample_files(self.batch_size, self.meta_keys)
+            if self._num_shards is None:
+                batch = self.fs.sample_files(self.batch_size, self.meta_keys)
+            else:
+                batch = self._sample_shard_files()
             if batch:
                 for b in batch:
                     g.add(b[0], b[1], b[2:])
                 if g.full_batch or not self.skip_incomplete:
-                    yield g.to_arrays()
+                    yield self._make_arrays(g)
                 g.clear_all()
+
+
+def _name_shard(name, num_shards):
+    """
+    Get the shard of a file name, by a hash function which is stable across
+    processes (unlike :func:`hash` of :class:`str`).
+    """
+    if not isinstance(name, six.binary_type):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % num_shards
@@ -1,16 +1,41 @@
+import codecs
+import json
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from mlsnippet.utils import makedirs, ActiveFiles, iter_files
-from .base import DataFS, DataFSCapacity
+from mlsnippet.utils import (makedirs, ActiveFiles, iter_files, scan_dir,
+                             write_file_atomic)
+from .base import DataFS, DataFSCapacity, _sample_from_names
 from .errors import InvalidOpenMode, UnsupportedOperation, DataFileNotExist
 
 __all__ = ['LocalFS']
 
 
 class LocalFS(DataFS):
-    """Local directory based :class:`DataFS`."""
+    """
+    Local directory based :class:`DataFS`.
 
-    def __init__(self, root_dir, strict=False):
+    The file names are collected into an in-memory list at the first call
+    of :meth:`count`, :meth:`list_names`, :meth:`sample_names` or
+    :meth:`sample_files`, and reused until this :class:`LocalFS` is closed,
+    a file is written through it, or :meth:`refresh_names` is called.
+    Files created or deleted by others will not be noticed before then.
+    If `cache_names` is :obj:`False`, the names are collected again at
+    each call, and the ``QUICK_COUNT`` and ``RANDOM_SAMPLE`` capacities
+    are absent unless `manifest_file` is specified.
+
+    If `manifest_file` is specified, the file names will also be persisted
+    into this manifest, along with the modification time of each directory.
+    The next time the names are collected, only the directories modified
+    since then will be listed again, while all other directories will be
+    taken from the manifest.  This makes building a shuffled flow over a
+    large and stable dataset almost instant, after the first time.
+    """
+
+    def __init__(self, root_dir, strict=False, io_workers=None,
+                 manifest_file=None, cache_names=True):
         """
         Construct a new :class:`LocalFS`.
 
@@ -18,16 +43,39 @@ class LocalFS(DataFS):
             root_dir (str): The root directory for this :class:`LocalFS`.
             strict (bool): Whether or not this :class:`DataFS` works in
                 strict mode?  (default :obj:`False`)
+            io_workers (None or int): The number of threads for reading
+                files concurrently in :meth:`batch_retrieve`, and for
+                scanning directories concurrently when listing the files.
+                If :obj:`None` or less than 2, the files will be read and
+                the directories will be scanned one after another.
+                (default :obj:`None`)
+            manifest_file (None or str): If specified, persist the file
+                names into this manifest file, and incrementally refresh
+                the names according to the modification time of each
+                directory.  It may reside in `root_dir`, in which case
+                it will be excluded from the file names.
+                (default :obj:`None`, do not use a manifest file)
+            cache_names (bool): Whether or not to cache the file names
+                in memory?  See above.  (default :obj:`True`)
         """
-        super(LocalFS, self).__init__(
-            capacity=DataFSCapacity.READ_WRITE_DATA,
-            strict=strict
-        )
+        capacity = DataFSCapacity.READ_WRITE_DATA
+        if cache_names or manifest_file is not None:
+            capacity |= (DataFSCapacity.QUICK_COUNT |
+                         DataFSCapacity.RANDOM_SAMPLE)
+        super(LocalFS, self).__init__(capacity=capacity, strict=strict)
 
         root_dir = os.path.abspath(root_dir)
         if not os.path.isdir(root_dir):
             raise IOError('Not a directory: {!r}'.format(root_dir))
         self._root_dir = root_dir
+        self._io_workers = io_workers if io_workers and io_workers > 1 \
+            else None
+        if manifest_file is not None:
+            manifest_file = os.path.abspath(manifest_file)
+        self._manifest_file = manifest_file
+        self._cache_names = bool(cache_names)
+        self._io_executor = None  # type: ThreadPoolExecutor
+        self._names = None  # type: list[str]
         self._active_files = ActiveFiles()
 
     @property
@@ -35,21 +83,94 @@ class LocalFS(DataFS):
         """Get the absolute path of the root directory."""
         return self._root_dir
 
+    @property
+    def io_workers(self):
+        """
+        Get the number of threads for reading files concurrently.
+
+        Returns:
+            int or None: The number of threads, or :obj:`None` if the
+                files are read one after another.
+        """
+        return self._io_workers
+
+    @property
+    def manifest_file(self):
+        """
+        Get the path of the manifest file.
+
+        Returns:
+            str or None: The absolute path of the manifest file, or
+                :obj:`None` if the manifest is not used.
+        """
+        return self._manifest_file
+
+    @property
+    def cache_names(self):
+        """Whether or not the file names are cached in memory?"""
+        return self._cache_names
+
+    def refresh_names(self):
+        """
+        Drop the cached file names, such that the files created or deleted
+        by others will be noticed the next time the names are collected.
+        """
+        self._names = None
+
     def clone(self):
-        return LocalFS(self.root_dir, strict=self.strict)
+        return LocalFS(self.root_dir, strict=self.strict,
+                       io_workers=self.io_workers,
+                       manifest_file=self.manifest_file,
+                       cache_names=self.cache_names)
 
     def _init(self):
         pass
 
     def _close(self):
-        self._active_files.close_all()
+        try:
+            if self._io_executor is not None:
+                self._io_executor.shutdown(wait=True)
+                self._io_executor = None
+        finally:
+            self._names = None
+            self._active_files.close_all()
+
+    def _iter_files(self):
+        return iter_files(self.root_dir, num_workers=self.io_workers)
+
+    def _collect_names(self):
+        if self._manifest_file is not None:
+            manifest = _NamesManifest.load(self._manifest_file)
+            names = manifest.refresh(self.root_dir, self._manifest_file)
+            if manifest.modified:
+                manifest.save(self._manifest_file)
+            return names
+        return list(self._iter_files())
+
+    def _get_names(self):
+        self.init()
+        if not self._cache_names:
+            return self._collect_names()
+        if self._names is None:
+            self._names = self._collect_names()
+        return self._names
+
+    def count(self):
+        return len(self._get_names())
 
     def iter_names(self):
         self.init()
-        return iter_files(self.root_dir)
+        if self._names is not None or self._manifest_file is not None:
+            return iter(self._get_names())
+        return self._iter_files()
+
+    def list_names(self):
+        return list(self._get_names())
 
     def sample_names(self, n_samples):
-        raise UnsupportedOperation()
+        if not self.capacity.can_random_sample():
+            raise UnsupportedOperation()
+        return _sample_from_names(self._get_names(), n_samples)
 
     def open(self, filename, mode):
         self.init()
@@ -59,12 +180,63 @@ class LocalFS(DataFS):
                 raise DataFileNotExist(file_path)
             return self._active_files.add(open(file_path, 'rb'))
         elif mode == 'w':
+            self._names = None
             parent_dir = os.path.split(file_path)[0]
             makedirs(parent_dir, exist_ok=True)
             return self._active_files.add(open(file_path, 'wb'))
         else:
             raise InvalidOpenMode(mode)
 
+    def _read_file(self, filename):
+        file_path = os.path.join(self.root_dir, filename)
+        try:
+            with open(file_path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            if not os.path.isfile(file_path):
+                return None
+            raise
+
+    def batch_retrieve(self, filenames, meta_keys=None):
+        self.init()
+        filenames = tuple(filenames)
+        if self._io_workers is not None and len(filenames) > 1:
+            if self._io_executor is None:
+                self._io_executor = ThreadPoolExecutor(
+                    max_workers=self._io_workers)
+            data = list(self._io_executor.map(self._read_file, filenames))
+        else:
+            data = [self._read_file(name) for name in filenames]
+
+        if meta_keys is None:
+            return data
+        meta_keys = tuple(meta_keys)
+        if meta_keys:
+            meta = self.batch_get_meta(
+                [n for n, d in zip(filenames, data) if d is not None],
+                meta_keys
+            )
+            meta.reverse()
+        ret = []
+        for d in data:
+            if d is None:
+                ret.append(None)
+            elif meta_keys:
+                m = meta.pop()
+                ret.append((d,) + m if m is not None else None)
+            else:
+                ret.append((d,))
+        return ret
+
+    def copy_to(self, filename, file_obj):
+        self.init()
+        file_path = os.path.join(self.root_dir, filename)
+        if not os.path.isfile(file_path):
+            raise DataFileNotExist(file_path)
+        with open(file_path, 'rb') as f:
+            if not _sendfile(f, file_obj):
+                shutil.copyfileobj(f, file_obj, self.buffer_size)
+
     def isfile(self, filename):
         return os.path.isfile(os.path.join(self.root_dir, filename))
 
@@ -79,3 +251,165 @@ class LocalFS(DataFS):
 
     def clear_meta(self, filename):
         raise UnsupportedOperation()
+
+
+def _sendfile(f, file_obj):
+    """
+    Copy the content of `f` to `file_obj` with ``os.sendfile``, which
+    avoids copying the data through the user space.
+
+    ``os.sendfile`` writes through the file descriptor underneath
+    `file_obj`, thus if `file_obj` is seekable, the descriptor is moved
+    to the position of `file_obj` before copying, and `file_obj` is moved
+    to the end of the copied content afterwards.
+
+    Returns:
+        bool: :obj:`True` if the content has been copied, or :obj:`False`
+            if ``os.sendfile`` is not applicable, and nothing is copied.
+    """
+    if not hasattr(os, 'sendfile'):
+        return False
+    try:
+        out_fd = file_obj.fileno()
+    except Exception:  # not a real file, e.g., io.BytesIO
+        return False
+    file_obj.flush()
+    start = None
+    if getattr(file_obj, 'seekable', lambda: False)():
+        # the buffered position of `file_obj` might differ from the
+        # position of the descriptor, e.g., after reading ahead
+        start = file_obj.tell()
+        os.lseek(out_fd, start, os.SEEK_SET)
+    in_fd = f.fileno()
+    size = os.fstat(in_fd).st_size
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+            except OSError:
+                # the first call fails if `file_obj` is not supported
+                if offset == 0:
+                    return False
+                raise
+            if sent == 0:
+                break
+            offset += sent
+    finally:
+        if start is not None:
+            file_obj.seek(start + offset)
+    return True
+
+
+class _NamesManifest(object):
+    """
+    The persisted file names of a :class:`LocalFS`.
+
+    The manifest records the listing ``(mtime, files, dirs)`` of each
+    directory, keyed by the relative path of the directory.  Since
+    creating, deleting or renaming an entry would update the mtime of
+    its parent directory, a recorded listing is reused as long as the
+    mtime of the directory is not changed.
+    """
+
+    VERSION = 1
+
+    # A directory modified within this number of seconds might be further
+    # modified within the same mtime tick, thus its mtime is not recorded.
+    RACY_SECONDS = 2.
+
+    def __init__(self, dirs):
+        self.dirs = dirs  # type: dict[str, list]
+        self.modified = False
+
+    @classmethod
+    def load(cls, manifest_file):
+        """
+        Load the manifest from `manifest_file`.
+
+        Returns:
+            _NamesManifest: The loaded manifest, or an empty manifest if
+                the manifest file does not exist, or cannot be loaded.
+        """
+        try:
+            with codecs.open(manifest_file, 'rb', 'utf-8') as f:
+                obj = json.load(f)
+            if obj.get('version') == cls.VERSION:
+                return cls(obj['dirs'])
+        except (IOError, OSError, ValueError):
+            pass
+        return cls({})
+
+    def save(self, manifest_file):
+        """
+        Save the manifest to `manifest_file`.
+
+        Failures (e.g., the directory is read-only) are silently ignored.
+        """
+        data = json.dumps({'version': self.VERSION, 'dirs': self.dirs})
+        try:
+            makedirs(os.path.dirname(manifest_file), exist_ok=True)
+            write_file_atomic(manifest_file, data.encode('utf-8'))
+        except (IOError, OSError):
+            pass
+
+    def refresh(self, root_dir, manifest_file):
+        """
+        Refresh the manifest, by listing the directories modified since
+        last time.
+
+        Args:
+            root_dir (str): The root directory of the :class:`LocalFS`.
+            manifest_file (str): The path of the manifest file, which
+                should be excluded from the file names.
+
+        Returns:
+            list[str]: The relative paths of all files in `root_dir`.
+        """
+        # saving the manifest always updates the mtime of its directory,
+        # thus this directory should be listed every time
+        manifest_dir, manifest_name = os.path.split(manifest_file)
+        manifest_temp = (manifest_name + '.', '.tmp')
+
+        names = []
+        dirs = {}
+        now = time.time()
+        stack = [(root_dir, '')]
+        while stack:
+            path, prefix = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if now - mtime < self.RACY_SECONDS or path == manifest_dir:
+                mtime = None
+
+            key = prefix.rstrip('/')
+            cached = self.dirs.get(key)
+            if mtime is not None and cached is not None and \
+                    cached[0] == mtime:
+                files, sub_dirs = cached[1], cached[2]
+            else:
+                files, sub_dirs = scan_dir(path, sort=True)
+                if path == manifest_dir:
+                    files = [
+                        f for f in files
+                        if f != manifest_name and not (
+                            f.startswith(manifest_temp[0]) and
+                            f.endswith(manifest_temp[1])
+                        )
+                    ]
+                if cached is None or cached[1:] != [files, sub_dirs]:
+                    self.modified = True
+            if cached is None or cached[0] != mtime:
+                self.modified = True
+            dirs[key] = [mtime, files, sub_dirs]
+
+            names.extend(prefix + f for f in files)
+            stack.extend((os.path.join(path, d), prefix + d + '/')
+                         for d in reversed(sub_dirs))
+
+        if len(dirs) != len(self.dirs):
+            self.modified = True
+        self.dirs = dirs
+        return names
@@ -1,13 +1,30 @@
-import six
-from pymongo import CursorType
+import collections
+import re
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
 
-from mlsnippet.utils import MongoBinder
+import six
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from gridfs import DEFAULT_CHUNK_SIZE
+from gridfs.errors import CorruptGridFile
+from pymongo import ASCENDING, CursorType, UpdateOne
+
+from mlsnippet.utils import MongoBinder, maybe_close
 from .base import DataFS, DataFSCapacity
 from .errors import DataFileNotExist, InvalidOpenMode, MetaKeyNotExist
 
 __all__ = ['MongoFS']
 
 META_FIELD = 'metadata'
+INLINE_FIELD = 'inlineData'
+BULK_WRITE_SIZE = 1000
+BULK_WRITE_BYTES = 16 * 1024 * 1024
+ITER_BATCH_SIZE = 256
+ITER_BATCH_BYTES = 16 * 1024 * 1024
 
 
 class MongoFS(DataFS, MongoBinder):
@@ -17,9 +34,21 @@ class MongoFS(DataFS, MongoBinder):
     This class provides a :class:`DataFS`, which saves the files in
     a MongoDB GridFS, and stores the meta values in ``metadata`` field
     of each record in the fs collection.
+
+    If ``inline_threshold`` is specified, the contents of small files
+    written by :meth:`put_data` would be stored in the ``inlineData`` field
+    of the records in the fs collection, instead of in the chunks
+    collection, such that reading or writing these files requires only
+    one document.  Such files are not accessible to the other GridFS
+    clients.
+
+    :meth:`count` takes the estimated number of records from the metadata
+    of the fs collection, which is cached for ``count_ttl`` seconds if
+    specified.  Use ``count(exact=True)`` to count the records exactly.
     """
 
-    def __init__(self, conn_str, db_name, coll_name, strict=False):
+    def __init__(self, conn_str, db_name, coll_name, strict=False,
+                 inline_threshold=None, count_ttl=None):
         """
         Construct a new :class:`MongoFS`.
 
@@ -29,7 +58,23 @@ class MongoFS(DataFS, MongoBinder):
             coll_name (str): The collection name (prefix) of the GridFS.
             strict (bool): Whether or not this :class:`DataFS` works in
                 strict mode?  (default :obj:`False`)
+            inline_threshold (None or int): If specified, store the
+                contents of no more than ``inline_threshold`` bytes in the
+                records of the fs collection.  (default :obj:`None`)
+            count_ttl (None or float): If specified, cache the result of
+                :meth:`count` for at most ``count_ttl`` seconds.  The cache
+                is shared with the clones, and is cleared whenever a file
+                is written via this instance or its clones.
+                (default :obj:`None`, do not cache the count)
         """
+        if inline_threshold is not None:
+            inline_threshold = int(inline_threshold)
+            if inline_threshold < 0:
+                raise ValueError('`inline_threshold` must not be negative.')
+        if count_ttl is not None:
+            count_ttl = float(count_ttl)
+            if count_ttl < 0:
+                raise ValueError('`count_ttl` must not be negative.')
         DataFS.__init__(
             self, capacity=DataFSCapacity.ALL, strict=strict)
         MongoBinder.__init__(
@@ -44,21 +89,87 @@ class MongoFS(DataFS, MongoBinder):
             get_meta_value = lambda r, m, k: m.get(k)
 
         self._get_meta_value_from_record = get_meta_value
-
-    def _make_query_project(self, meta_keys=None, _id=1, filename=1):
+        self._inline_threshold = inline_threshold
+        self._count_ttl = count_ttl
+        self._count_cache = _CountCache()
+        self._gridfs_indexed = False
+
+    @property
+    def inline_threshold(self):
+        """Get the maximum size of the contents to be stored inline."""
+        return self._inline_threshold
+
+    @property
+    def count_ttl(self):
+        """Get the maximum number of seconds to cache the count."""
+        return self._count_ttl
+
+    def _make_query_project(self, meta_keys=None, _id=1, filename=1,
+                            with_data=False):
         ret = {'_id': _id, 'filename': filename}
+        if with_data:
+            # the fields required by `_read_blobs`
+            ret.update({'length': 1, INLINE_FIELD: 1})
         if meta_keys:
             ret.update({'{}.{}'.format(META_FIELD, k): 1
                         for k in meta_keys})
         return ret
 
+    def _make_query_filter(self, names_pattern=None, meta_filter=None):
+        ret = {}
+        if names_pattern is not None:
+            ret['filename'] = _make_names_regex(names_pattern)
+        if meta_filter:
+            ret.update({'{}.{}'.format(META_FIELD, k): v
+                        for k, v in six.iteritems(meta_filter)})
+        return ret
+
     def _make_sample_cursor(self, n_samples, meta_keys, with_id=1):
-        project = self._make_query_project(_id=with_id, meta_keys=meta_keys)
+        project = self._make_query_project(
+            _id=with_id, meta_keys=meta_keys, with_data=bool(with_id))
         return self.collection.files.aggregate([
             {'$sample': {'size': n_samples}},
             {'$project': project},
         ])
 
+    def _read_blobs(self, records):
+        """
+        Read the contents of files from the GridFS chunks collection,
+        with only one query.  The inline contents are taken from the
+        records directly.
+
+        Args:
+            records (list[dict]): The file records, each must contain
+                ``_id``, ``length`` and ``inlineData`` (if exists) fields.
+
+        Returns:
+            list[bytes]: The contents of the files.
+        """
+        pieces = {r['_id']: [] for r in records if INLINE_FIELD not in r}
+        if pieces:
+            for c in self.collection.chunks.find(
+                    {'files_id': {'$in': list(pieces)}},
+                    {'_id': 0, 'files_id': 1, 'n': 1, 'data': 1},
+                    sort=[('files_id', 1), ('n', 1)]):
+                buf = pieces[c['files_id']]
+                if c['n'] != len(buf):
+                    raise CorruptGridFile(
+                        'Missing chunk {} of file {!r}.'.
+                        format(len(buf), c['files_id']))
+                buf.append(c['data'])
+        ret = []
+        for r in records:
+            if INLINE_FIELD in r:
+                data = bytes(r[INLINE_FIELD])
+            else:
+                data = b''.join(pieces[r['_id']])
+            if len(data) != r['length']:
+                raise CorruptGridFile(
+                    'Truncated file {!r}: expected {} bytes, got {}.'.
+                    format(r['filename'], r['length'], len(data)))
+            ret.append(data)
+        return ret
+
     def _make_result_meta(self, record, meta_keys):
         meta_dict = record.get(META_FIELD)
         if not meta_dict or not isinstance(meta_dict, dict):
@@ -67,14 +178,76 @@ class MongoFS(DataFS, MongoBinder):
                      for k in meta_keys)
 
     def clone(self):
-        return MongoFS(self.conn_str, self.db_name, self.coll_name,
-                       strict=self.strict)
+        ret = MongoFS(self.conn_str, self.db_name, self.coll_name,
+                      strict=self.strict,
+                      inline_threshold=self.inline_threshold,
+                      count_ttl=self.count_ttl)
+        ret._count_cache = self._count_cache
+        return ret
 
-    def count(self):
-        return self.collection.files.count()
+    def _init(self):
+        MongoBinder._init(self)
+        self._gridfs_indexed = False
+
+    def _ensure_gridfs_indexes(self):
+        # inserting the documents directly does not create the GridFS
+        # indexes, which are required for reading the files efficiently
+        if not self._gridfs_indexed:
+            self.collection.files.create_index(
+                [('filename', ASCENDING), ('uploadDate', ASCENDING)])
+            self.collection.chunks.create_index(
+                [('files_id', ASCENDING), ('n', ASCENDING)], unique=True)
+            self._gridfs_indexed = True
+
+    def count(self, exact=False):
+        """
+        Count the files in this :class:`MongoFS`.
+
+        Args:
+            exact (bool): If :obj:`True`, count the records of the fs
+                collection exactly, which scans the whole collection,
+                instead of taking the estimated number of records from
+                the collection metadata.  The exact count would not be
+                cached.  (default :obj:`False`)
+
+        Returns:
+            int: The total number of files.
+        """
+        if exact:
+            return self.collection.files.count_documents({})
+        if self._count_ttl is not None:
+            ret = self._count_cache.get()
+            if ret is not None:
+                return ret
+            generation = self._count_cache.generation
+        ret = self.collection.files.estimated_document_count()
+        if self._count_ttl is not None:
+            self._count_cache.put(ret, self._count_ttl, generation)
+        return ret
 
     def iter_names(self):
-        for r in self.collection.files.find({}, {'filename': 1, '_id': 0}):
+        return self.query_names()
+
+    def query_names(self, names_pattern=None, meta_filter=None, hint=None):
+        """
+        Iterate through the file names matching the specified query.
+
+        The query is translated into the filter of a ``find`` command, thus
+        the matching is done by the MongoDB server.  See
+        :meth:`DataFS.query_names` for the details of the arguments.
+
+        Args:
+            hint (None or str or list[(str, int)]): The index to be used
+                by the ``find`` command.  (default :obj:`None`, chosen by
+                the query planner of the server)
+        """
+        cursor = self.collection.files.find(
+            self._make_query_filter(names_pattern, meta_filter),
+            {'filename': 1, '_id': 0}
+        )
+        if hint is not None:
+            cursor = cursor.hint(hint)
+        for r in cursor:
             yield r['filename']
 
     def sample_names(self, n_samples):
@@ -82,58 +255,224 @@ class MongoFS(DataFS, MongoBinder):
                 for r in self._make_sample_cursor(n_samples, (), 0)]
 
     def iter_files(self, meta_keys=None):
+        return self.query_files(meta_keys)
+
+    def query_files(self, meta_keys=None, names_pattern=None,
+                    meta_filter=None, hint=None):
+        """
+        Iterate through the files matching the specified query.
+
+        The query is translated into the filter of a ``find`` command, thus
+        the matching is done by the MongoDB server.  See
+        :meth:`DataFS.query_files` for the details of the arguments.
+
+        The contents of the files are read in batches, with one query on
+        the chunks collection for each batch of at most ``ITER_BATCH_SIZE``
+        files (or ``ITER_BATCH_BYTES`` bytes), instead of one query for
+        each file.
+
+        Args:
+            hint (None or str or list[(str, int)]): The index to be used
+                by the ``find`` command.  (default :obj:`None`, chosen by
+                the query planner of the server)
+        """
         meta_keys = tuple(meta_keys or ())
-        project = self._make_query_project(meta_keys)
-        for r in self.collection.files.find({}, project,
-                                            no_cursor_timeout=True,
-                                            cursor_type=CursorType.EXHAUST):
-            with self.gridfs.get(r['_id']) as f:
-                data = f.read()
-            yield (r['filename'], data) + self._make_result_meta(r, meta_keys)
+        project = self._make_query_project(meta_keys, with_data=True)
+        cursor = self.collection.files.find(
+            self._make_query_filter(names_pattern, meta_filter), project,
+            no_cursor_timeout=True, cursor_type=CursorType.EXHAUST
+        )
+        if hint is not None:
+            cursor = cursor.hint(hint)
+
+        def flush():
+            for r, data in zip(batch, self._read_blobs(batch)):
+                yield ((r['filename'], data) +
+                       self._make_result_meta(r, meta_keys))
+            del batch[:]
+
+        batch = []
+        batch_bytes = 0
+        for r in cursor:
+            batch.append(r)
+            batch_bytes += r['length']
+            if len(batch) >= ITER_BATCH_SIZE or \
+                    batch_bytes >= ITER_BATCH_BYTES:
+                for f in flush():
+                    yield f
+                batch_bytes = 0
+        if batch:
+            for f in flush():
+                yield f
 
     def sample_files(self, n_samples, meta_keys=None):
         meta_keys = tuple(meta_keys or ())
-        ret = []
-        for r in self._make_sample_cursor(n_samples, meta_keys, 1):
-            with self.gridfs.get(r['_id']) as f:
-                data = f.read()
-            ret.append(
-                (r['filename'], data) + self._make_result_meta(r, meta_keys))
-        return ret
+        records = list(self._make_sample_cursor(n_samples, meta_keys, 1))
+        return [(r['filename'], data) + self._make_result_meta(r, meta_keys)
+                for r, data in zip(records, self._read_blobs(records))]
 
     def retrieve(self, filename, meta_keys=None):
         has_meta_keys = meta_keys is not None
         meta_keys = tuple(meta_keys or ())
-        project = self._make_query_project(meta_keys)
-        r = self.collection.files.find_one(
-            {'filename': filename}, project, no_cursor_timeout=True)
+        project = self._make_query_project(meta_keys, with_data=True)
+        r = self.collection.files.find_one({'filename': filename}, project)
         if r is None:
             raise DataFileNotExist(filename)
-        with self.gridfs.get(r['_id']) as f:
-            data = f.read()
+        data = self._read_blobs([r])[0]
         if has_meta_keys:
             return (data,) + self._make_result_meta(r, meta_keys)
         else:
             return data
 
+    def batch_retrieve(self, filenames, meta_keys=None):
+        has_meta_keys = meta_keys is not None
+        filenames = tuple(filenames)
+        meta_keys = tuple(meta_keys or ())
+        project = self._make_query_project(meta_keys, with_data=True)
+        records = {
+            r['filename']: r
+            for r in self.collection.files.find(
+                {'filename': {'$in': filenames}}, project)
+        }
+        records_list = list(six.itervalues(records))
+        blobs = {r['_id']: data for r, data in
+                 zip(records_list, self._read_blobs(records_list))}
+
+        ret = []
+        for name in filenames:
+            r = records.get(name)
+            if r is None:
+                ret.append(None)
+            elif has_meta_keys:
+                ret.append((blobs[r['_id']],) +
+                           self._make_result_meta(r, meta_keys))
+            else:
+                ret.append(blobs[r['_id']])
+        return ret
+
+    def get_data(self, filename):
+        return self.retrieve(filename)
+
+    def iter_chunks(self, filename, chunk_size=None):
+        if chunk_size is not None:
+            return super(MongoFS, self).iter_chunks(filename, chunk_size)
+        f = self.open(filename, 'r')
+        if isinstance(f, BytesIO):
+            # an inline file is not split into chunks
+            return iter([f.read()])
+        return _iter_grid_chunks(f)
+
+    def copy_to(self, filename, file_obj):
+        for chunk in self.iter_chunks(filename):
+            file_obj.write(chunk)
+
     def put_data(self, filename, data):
         if isinstance(data, six.binary_type) or hasattr(data, 'read'):
+            self._count_cache.clear()
             f = self.collection.files.find_one(
                 {'filename': filename}, {'_id': 1})
             if f is not None:
                 self.gridfs.delete(f['_id'])
-            self.gridfs.put(data, filename=filename)
+            if self._inline_threshold is not None and \
+                    isinstance(data, six.binary_type) and \
+                    len(data) <= self._inline_threshold:
+                self.collection.files.insert_one(
+                    self._make_file_docs(filename, data)[0])
+            else:
+                self.gridfs.put(data, filename=filename)
         else:
             raise TypeError('`data` must be bytes or a file-like object.')
 
+    def _make_file_docs(self, filename, data):
+        """
+        Make the GridFS files document and the chunks documents of a file.
+
+        Returns:
+            (dict, list[dict]): The files document and the chunks documents.
+        """
+        if self._inline_threshold is not None and \
+                len(data) <= self._inline_threshold:
+            return ({'filename': filename, 'length': len(data),
+                     'uploadDate': datetime.utcnow(),
+                     INLINE_FIELD: Binary(data)}, [])
+        file_id = ObjectId()
+        chunks = [
+            {'files_id': file_id, 'n': n,
+             'data': Binary(data[i: i + DEFAULT_CHUNK_SIZE])}
+            for n, i in enumerate(range(0, len(data), DEFAULT_CHUNK_SIZE))
+        ]
+        return ({'_id': file_id, 'filename': filename, 'length': len(data),
+                 'chunkSize': DEFAULT_CHUNK_SIZE,
+                 'uploadDate': datetime.utcnow()}, chunks)
+
+    def batch_put_data(self, items):
+        """
+        Save the contents of files, with bulk writes.
+
+        The existing versions of each batch of at most ``BULK_WRITE_SIZE``
+        files (or ``BULK_WRITE_BYTES`` bytes) are deleted by one
+        ``delete_many`` command on each of the files and chunks
+        collections, then the new documents are inserted by one
+        ``insert_many`` command on each of these collections.  The
+        file-like contents are saved by :meth:`put_data`.
+        """
+        self._count_cache.clear()
+        files = self.collection.files
+        chunks = self.collection.chunks
+        self._ensure_gridfs_indexes()
+        buf = collections.OrderedDict()
+
+        def flush():
+            names = list(buf)
+            old_ids = [r['_id'] for r in files.find(
+                {'filename': {'$in': names}}, {'_id': 1})]
+            if old_ids:
+                files.delete_many({'_id': {'$in': old_ids}})
+                chunks.delete_many({'files_id': {'$in': old_ids}})
+            file_docs = []
+            chunk_docs = []
+            for name, data in six.iteritems(buf):
+                file_doc, file_chunks = self._make_file_docs(name, data)
+                file_docs.append(file_doc)
+                chunk_docs.extend(file_chunks)
+            # insert the chunks first, such that any visible file is complete
+            if chunk_docs:
+                chunks.insert_many(chunk_docs, ordered=False)
+            files.insert_many(file_docs, ordered=False)
+            buf.clear()
+
+        buf_bytes = 0
+        for filename, data in items:
+            # the latest content of the same file wins
+            old_data = buf.pop(filename, None)
+            if old_data is not None:
+                buf_bytes -= len(old_data)
+            if hasattr(data, 'read'):
+                self.put_data(filename, data)
+            elif isinstance(data, six.binary_type):
+                buf[filename] = data
+                buf_bytes += len(data)
+                if len(buf) >= BULK_WRITE_SIZE or \
+                        buf_bytes >= BULK_WRITE_BYTES:
+                    flush()
+                    buf_bytes = 0
+            else:
+                raise TypeError('`data` must be bytes or a file-like object.')
+        if buf:
+            flush()
+
     def open(self, filename, mode):
-        f = self.collection.files.find_one({'filename': filename}, {'_id': 1})
+        f = self.collection.files.find_one(
+            {'filename': filename}, {'_id': 1, INLINE_FIELD: 1})
         if mode == 'r':
             if f is None:
                 raise DataFileNotExist(filename)
+            if INLINE_FIELD in f:
+                return self._active_files.add(BytesIO(f[INLINE_FIELD]))
             return self._active_files.add(
                 self.gridfs_bucket.open_download_stream(f['_id']))
         elif mode == 'w':
+            self._count_cache.clear()
             if f is not None:
                 self.gridfs.delete(f['_id'])
             return self._active_files.add(
@@ -199,12 +538,86 @@ class MongoFS(DataFS, MongoBinder):
             ret.update(dict(d2))
         return ret
 
+    def _make_put_meta_update(self, meta_dict):
+        return {'$set': {'{}.{}'.format(META_FIELD, k): v
+                         for k, v in six.iteritems(meta_dict)}}
+
+    def _make_put_meta_filter(self, filename):
+        # `$set` on the fields of `metadata` would be rejected by the server
+        # if `metadata` is not a document (e.g., `null` written by other
+        # GridFS clients), thus such files must be excluded
+        return {'filename': filename,
+                '$or': [{META_FIELD: {'$type': 'object'}},
+                        {META_FIELD: {'$exists': False}}]}
+
+    def _merge_and_put_meta(self, filename, meta_dict):
+        # the slow path for files whose `metadata` is not a document
+        merged = dict(self.get_meta_dict(filename))
+        merged.update(meta_dict)
+        self.clear_and_put_meta(filename, merged)
+
     def put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
         meta_dict = self._merge_meta_dict(meta_dict, meta_dict_kwargs)
         if meta_dict:
-            merged_dict = self.get_meta_dict(filename)
-            merged_dict.update(meta_dict)
-            self.clear_and_put_meta(filename, merged_dict)
+            r = self.collection.files.update_one(
+                self._make_put_meta_filter(filename),
+                self._make_put_meta_update(meta_dict)
+            )
+            if not r.matched_count:
+                # either the file does not exist, or its `metadata` is not
+                # a document, in which case `get_meta_dict` returns `{}`
+                self._merge_and_put_meta(filename, meta_dict)
+
+    def batch_put_meta(self, items):
+        missing = []
+        buf = []
+        # the files with nothing to update, only checked for existence
+        empty = []
+
+        def flush():
+            r = self.collection.files.bulk_write(
+                [UpdateOne(self._make_put_meta_filter(n),
+                           self._make_put_meta_update(m))
+                 for n, m in buf],
+                ordered=False
+            )
+            if r.matched_count < len(buf):
+                # find out the unmatched files only when some file does not
+                # match, which either does not exist, or has a `metadata`
+                # that is not a document
+                names = [n for n, _ in buf]
+                matched = {r['filename'] for r in self.collection.files.find(
+                    self._make_put_meta_filter({'$in': names}),
+                    {'filename': 1, '_id': 0}
+                )}
+                for (n, m), exists in zip(buf, self.batch_isfile(names)):
+                    if not exists:
+                        missing.append(n)
+                    elif n not in matched:
+                        self._merge_and_put_meta(n, m)
+            del buf[:]
+
+        def check_empty():
+            missing.extend(n for n, exists in
+                           zip(empty, self.batch_isfile(empty))
+                           if not exists)
+            del empty[:]
+
+        for filename, meta_dict in items:
+            if meta_dict:
+                buf.append((filename, meta_dict))
+                if len(buf) >= BULK_WRITE_SIZE:
+                    flush()
+            else:
+                empty.append(filename)
+                if len(empty) >= BULK_WRITE_SIZE:
+                    check_empty()
+        if buf:
+            flush()
+        if empty:
+            check_empty()
+        if missing:
+            raise DataFileNotExist(missing[0])
 
     def clear_and_put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
         meta_dict = self._merge_meta_dict(meta_dict, meta_dict_kwargs)
@@ -217,3 +630,54 @@ class MongoFS(DataFS, MongoBinder):
 
     def clear_meta(self, filename):
         self.clear_and_put_meta(filename)
+
+
+class _CountCache(object):
+    """
+    The cached count shared by a :class:`MongoFS` and all its clones.
+
+    The generation is bumped by every write, such that a count which
+    has started before a write would not be cached after the write.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.expire_time = None
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        value, expire_time = self.value, self.expire_time
+        if value is not None and time.time() < expire_time:
+            return value
+
+    def put(self, value, ttl, generation):
+        with self._lock:
+            if generation == self.generation:
+                self.value, self.expire_time = value, time.time() + ttl
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.value = None
+
+
+def _make_names_regex(names_pattern):
+    # `re.match` only matches at the beginning of the names, thus the
+    # pattern is anchored, which also allows the server to scan the
+    # `filename` index of GridFS for patterns with a literal prefix
+    names_pattern = re.compile(names_pattern)
+    flags = ''.join(f for f, v in [('i', re.IGNORECASE), ('m', re.MULTILINE),
+                                   ('s', re.DOTALL), ('x', re.VERBOSE)]
+                    if names_pattern.flags & v)
+    return Regex('^(?:{})'.format(names_pattern.pattern), flags)
+
+
+def _iter_grid_chunks(f):
+    # read the GridFS chunks one by one, without re-slicing them
+    with maybe_close(f):
+        while True:
+            chunk = f.readchunk()
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,334 @@
+import collections
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+
+from .base import DataFS, DataFSCapacity, _sample_from_names
+from .errors import InvalidOpenMode, UnsupportedOperation, DataFileNotExist
+from .localfs import LocalFS
+from .workers import BackgroundIterator
+
+__all__ = ['ShardedDataFS']
+
+
+class ShardedDataFS(DataFS):
+    """
+    A read-only :class:`DataFS`, which presents many child :class:`DataFS`
+    instances (the shards, e.g., hundreds of :class:`TarArchiveFS`) as one
+    namespace.
+
+    The file names of all shards are merged into an in-memory index at the
+    first lookup, which maps each name to its shard.  The names are expected
+    to be unique across the shards.  Otherwise the file in the first shard
+    would shadow the files of the same name in the other shards, which are
+    excluded from :meth:`count`, :meth:`iter_names`, :meth:`iter_files`
+    and all other methods.
+
+    :meth:`iter_files` reads ``num_parallel`` shards at the same time, each
+    in a background thread with a dedicated clone of the shard, and yields
+    the files from these shards in a round-robin fashion.
+
+    For distributed training, :meth:`for_worker` assigns a disjoint subset
+    of the shards to each worker.
+    """
+
+    def __init__(self, shards, strict=False, num_parallel=4, prefetch=16):
+        """
+        Construct a new :class:`ShardedDataFS`.
+
+        Args:
+            shards (Iterable[DataFS]): The child :class:`DataFS` instances.
+            strict (bool): Whether or not this :class:`DataFS` works in
+                strict mode?  (default :obj:`False`)
+            num_parallel (int): The number of shards to be read in parallel
+                by :meth:`iter_files`, and to be listed in parallel when
+                building the name index.  (default 4)
+            prefetch (int): The maximum number of files of each shard to
+                be read ahead of time by :meth:`iter_files`.  (default 16)
+        """
+        shards = list(shards)
+        if not shards:
+            raise ValueError('`shards` must not be empty.')
+        num_parallel = int(num_parallel)
+        if num_parallel < 1:
+            raise ValueError('`num_parallel` must be positive.')
+        prefetch = int(prefetch)
+        if prefetch < 1:
+            raise ValueError('`prefetch` must be positive.')
+
+        # the capacities to read meta and to quick count require all the
+        # shards to have them, while the names can always be sampled from
+        # the merged name index
+        mode = DataFSCapacity.READ_DATA | DataFSCapacity.RANDOM_SAMPLE
+        for flag, can in [(DataFSCapacity.READ_META, 'can_read_meta'),
+                          (DataFSCapacity.LIST_META, 'can_list_meta'),
+                          (DataFSCapacity.QUICK_COUNT, 'can_quick_count')]:
+            if all(getattr(s.capacity, can)() for s in shards):
+                mode |= flag
+        super(ShardedDataFS, self).__init__(capacity=mode, strict=strict)
+
+        self._shards = shards  # type: list[DataFS]
+        self._num_parallel = num_parallel
+        self._prefetch = prefetch
+        self._names = None  # type: list[str]
+        self._name_index = None  # type: dict[str, int]
+
+    @classmethod
+    def from_glob(cls, pattern, **kwargs):
+        """
+        Construct a new :class:`ShardedDataFS` from the archives (or the
+        directories) matching a glob pattern.
+
+        The matched paths are sorted by name, and opened as described in
+        :func:`~mlsnippet.datafs.copy_fs`, i.e., ``*.zip`` as a
+        :class:`ZipArchiveFS`, ``*.tar``, ``*.tar.gz`` and so on as a
+        :class:`TarArchiveFS`, and directories as a :class:`LocalFS`.
+        Other matched files (e.g., the side-car index files written by
+        :class:`TarArchiveFS`) are ignored, and no directory is created.
+
+        Args:
+            pattern (str): The glob pattern, e.g., ``/data/train-*.tar``.
+            **kwargs: Other arguments passed to :class:`ShardedDataFS`.
+
+        Returns:
+            ShardedDataFS: The sharded :class:`DataFS`.
+        """
+        from .copyfs import _open_archive
+        shards = []
+        for path in sorted(glob.glob(pattern)):
+            shard = _open_archive(path)
+            if shard is None and os.path.isdir(path):
+                shard = LocalFS(path)
+            if shard is not None:
+                shards.append(shard)
+        if not shards:
+            raise IOError('No file matches {!r}.'.format(pattern))
+        return cls(shards, **kwargs)
+
+    @property
+    def shards(self):
+        """Get the child :class:`DataFS` instances."""
+        return self._shards
+
+    @property
+    def num_parallel(self):
+        """Get the number of shards to be read in parallel."""
+        return self._num_parallel
+
+    @property
+    def prefetch(self):
+        """Get the number of files of each shard to be read ahead of time."""
+        return self._prefetch
+
+    def for_worker(self, num_workers, worker_index):
+        """
+        Get the shards assigned to a worker, for distributed training.
+
+        The shards are assigned to the workers in a round-robin fashion,
+        i.e., the ``worker_index``-th worker gets the shards
+        ``worker_index, worker_index + num_workers, ...``.
+
+        Args:
+            num_workers (int): The total number of workers.
+            worker_index (int): The index of this worker, starting from 0.
+
+        Returns:
+            ShardedDataFS: A new :class:`ShardedDataFS`, with clones of the
+                assigned shards.
+        """
+        num_workers = int(num_workers)
+        worker_index = int(worker_index)
+        if num_workers < 1:
+            raise ValueError('`num_workers` must be positive.')
+        if not 0 <= worker_index < num_workers:
+            raise ValueError('`worker_index` must be in the range '
+                             '[0, num_workers).')
+        if num_workers > len(self._shards):
+            raise ValueError('Cannot assign {} shards to {} workers.'.
+                             format(len(self._shards), num_workers))
+        return ShardedDataFS(
+            [s.clone() for s in self._shards[worker_index::num_workers]],
+            strict=self.strict, num_parallel=self.num_parallel,
+            prefetch=self.prefetch
+        )
+
+    def clone(self):
+        ret = ShardedDataFS(
+            [s.clone() for s in self._shards], strict=self.strict,
+            num_parallel=self.num_parallel, prefetch=self.prefetch
+        )
+        # the name index is read-only, thus can be shared with the clone
+        ret._names = self._names
+        ret._name_index = self._name_index
+        return ret
+
+    def _init(self):
+        pass
+
+    def _close(self):
+        self._names = None
+        self._name_index = None
+        for s in self._shards:
+            s.close()
+
+    def _get_name_index(self):
+        if self._name_index is None:
+            with ThreadPoolExecutor(
+                    max_workers=min(self._num_parallel,
+                                    len(self._shards))) as executor:
+                shard_names = list(executor.map(
+                    lambda s: s.list_names(), self._shards))
+            names = []
+            name_index = {}
+            for i, s_names in enumerate(shard_names):
+                for name in s_names:
+                    if name not in name_index:
+                        name_index[name] = i
+                        names.append(name)
+            self._names = names
+            self._name_index = name_index
+        return self._name_index
+
+    def _get_names(self):
+        self._get_name_index()
+        return self._names
+
+    def _get_shard(self, filename):
+        self.init()
+        i = self._get_name_index().get(filename)
+        if i is None:
+            raise DataFileNotExist(filename)
+        return self._shards[i]
+
+    def _group_by_shard(self, filenames):
+        """
+        Group the names by their shards.
+
+        Returns:
+            dict[int, list[int]]: The indices of the names in `filenames`,
+                grouped by the index of the shards.  Names that do not exist
+                are excluded.
+        """
+        self.init()
+        name_index = self._get_name_index()
+        groups = collections.OrderedDict()
+        for i, name in enumerate(filenames):
+            shard = name_index.get(name)
+            if shard is not None:
+                groups.setdefault(shard, []).append(i)
+        return groups
+
+    def _batch_call(self, method, filenames, default, *args):
+        filenames = tuple(filenames)
+        ret = [default] * len(filenames)
+        for shard, indices in six.iteritems(self._group_by_shard(filenames)):
+            results = getattr(self._shards[shard], method)(
+                [filenames[i] for i in indices], *args)
+            for i, r in zip(indices, results):
+                ret[i] = r
+        return ret
+
+    def count(self):
+        self.init()
+        return len(self._get_names())
+
+    def iter_names(self):
+        self.init()
+        return iter(self._get_names())
+
+    def list_names(self):
+        self.init()
+        return list(self._get_names())
+
+    def sample_names(self, n_samples):
+        self.init()
+        return _sample_from_names(self._get_names(), n_samples)
+
+    def iter_files(self, meta_keys=None):
+        self.init()
+        meta_keys = tuple(meta_keys or ())
+        name_index = self._get_name_index()
+
+        def shard_files(i):
+            # each shard is iterated by a dedicated clone, since the shard
+            # itself might be used by the iterating thread at the same time
+            clone = self._shards[i].clone()
+            try:
+                for f in clone.iter_files(meta_keys):
+                    # skip the files shadowed by the previous shards
+                    if name_index.get(f[0]) == i:
+                        yield f
+            finally:
+                clone.close()
+
+        pending = collections.deque(range(len(self._shards)))
+        active = collections.deque()
+        try:
+            while pending or active:
+                while pending and len(active) < self._num_parallel:
+                    active.append(BackgroundIterator(
+                        lambda i=pending.popleft(): shard_files(i),
+                        max_pending=self._prefetch
+                    ))
+                it = active.popleft()
+                try:
+                    f = next(it)
+                except StopIteration:
+                    continue
+                active.append(it)
+                yield f
+        finally:
+            for it in active:
+                it.close()
+
+    def retrieve(self, filename, meta_keys=None):
+        return self._get_shard(filename).retrieve(filename, meta_keys)
+
+    def batch_retrieve(self, filenames, meta_keys=None):
+        if meta_keys is not None:
+            meta_keys = tuple(meta_keys)
+        return self._batch_call('batch_retrieve', filenames, None, meta_keys)
+
+    def get_data(self, filename):
+        return self._get_shard(filename).get_data(filename)
+
+    def iter_chunks(self, filename, chunk_size=None):
+        return self._get_shard(filename).iter_chunks(filename, chunk_size)
+
+    def copy_to(self, filename, file_obj):
+        self._get_shard(filename).copy_to(filename, file_obj)
+
+    def open(self, filename, mode):
+        if mode != 'r':
+            raise InvalidOpenMode(mode)
+        return self._get_shard(filename).open(filename, mode)
+
+    def isfile(self, filename):
+        self.init()
+        return filename in self._get_name_index()
+
+    def batch_isfile(self, filenames):
+        self.init()
+        name_index = self._get_name_index()
+        return [name in name_index for name in filenames]
+
+    def list_meta(self, filename):
+        return self._get_shard(filename).list_meta(filename)
+
+    def get_meta(self, filename, meta_keys):
+        return self._get_shard(filename).get_meta(filename, meta_keys)
+
+    def batch_get_meta(self, filenames, meta_keys):
+        return self._batch_call('batch_get_meta', filenames, None,
+                                tuple(meta_keys or ()))
+
+    def get_meta_dict(self, filename):
+        return self._get_shard(filename).get_meta_dict(filename)
+
+    def put_meta(self, filename, meta_dict=None, **meta_dict_kwargs):
+        raise UnsupportedOperation()
+
+    def clear_meta(self, filename):
+        raise UnsupportedOperation()
@@ -0,0 +1,205 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+from six.moves import queue
+
+from mlsnippet.utils import AutoInitAndCloseable
+from .base import DataFS
+
+__all__ = ['BackgroundIterator', 'DataFSWorkerPool']
+
+
+class DataFSWorkerPool(AutoInitAndCloseable):
+    """
+    A thread pool, whose workers each own a clone of a :class:`DataFS`.
+
+    Most :class:`DataFS` instances are not thread-safe (e.g., the internal
+    states of :class:`~mlsnippet.datafs.TarArchiveFS`), thus concurrent
+    jobs should not share the same :class:`DataFS`.  This class creates
+    ``num_workers`` clones of the specified :class:`DataFS` (obtained by
+    :meth:`DataFS.clone()`), and each job submitted to this pool would
+    run with exclusive access to one of these clones.
+
+    The clones are created and initialized lazily, and will be closed as
+    soon as this pool is closed.
+    """
+
+    def __init__(self, fs, num_workers):
+        """
+        Construct a new :class:`DataFSWorkerPool`.
+
+        Args:
+            fs (DataFS): The data fs instance, from which to obtain clones.
+                This instance itself will not be used by the workers.
+            num_workers (int): The number of worker threads.
+        """
+        num_workers = int(num_workers)
+        if num_workers < 1:
+            raise ValueError('`num_workers` must be positive.')
+        self._fs = fs  # type: DataFS
+        self._num_workers = num_workers
+        self._executor = None  # type: ThreadPoolExecutor
+        self._clones = None  # type: list[DataFS]
+        self._idle_clones = None  # type: queue.Queue
+
+    @property
+    def fs(self):
+        """Get the data fs instance, from which to obtain clones."""
+        return self._fs
+
+    @property
+    def num_workers(self):
+        """Get the number of worker threads."""
+        return self._num_workers
+
+    def _init(self):
+        self._clones = [self._fs.clone() for _ in range(self._num_workers)]
+        self._idle_clones = queue.Queue()
+        for fs in self._clones:
+            self._idle_clones.put(fs)
+        self._executor = ThreadPoolExecutor(max_workers=self._num_workers)
+
+    def _close(self):
+        try:
+            self._executor.shutdown(wait=True)
+        finally:
+            for fs in self._clones:
+                fs.close()
+            self._executor = None
+            self._clones = None
+            self._idle_clones = None
+
+    def _run(self, fn, args, kwargs):
+        # there are exactly as many clones as worker threads, thus
+        # obtaining a clone from the queue should never be blocked
+        fs = self._idle_clones.get()
+        try:
+            return fn(fs, *args, **kwargs)
+        finally:
+            self._idle_clones.put(fs)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit a job to run in this pool.
+
+        Args:
+            fn ((DataFS, *args, **kwargs) -> any): The job function.
+                The first argument will be a clone of :attr:`fs`, which
+                is exclusively owned by the job during its execution.
+            *args: The positional arguments passed to `fn`.
+            **kwargs: The named arguments passed to `fn`.
+
+        Returns:
+            concurrent.futures.Future: The future of the job result.
+        """
+        self.init()
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+
+class BackgroundIterator(object):
+    """
+    An iterator, which consumes another iterator in a background thread.
+
+    The items produced by the background thread are kept in a bounded
+    queue, until they are taken by :meth:`__next__`.  The errors raised by
+    the underlying iterator will be re-raised by :meth:`__next__`.
+
+    Usage::
+
+        with BackgroundIterator(lambda: fs.iter_files()) as it:
+            for name, data in it:
+                ...
+    """
+
+    _END = object()
+    """Marks the end of the underlying iterator."""
+
+    def __init__(self, iterable_factory, max_pending=2):
+        """
+        Construct a new :class:`BackgroundIterator`.
+
+        Args:
+            iterable_factory (() -> Iterable): The factory to obtain the
+                iterable, which will be called in the background thread.
+            max_pending (int): The maximum number of produced items to be
+                kept in the queue.  (default 2, i.e., double buffering)
+        """
+        max_pending = int(max_pending)
+        if max_pending < 1:
+            raise ValueError('`max_pending` must be positive.')
+        self._iterable_factory = iterable_factory
+        self._max_pending = max_pending
+        self._queue = None  # type: queue.Queue
+        self._thread = None  # type: threading.Thread
+        self._stopped = threading.Event()
+        self._exhausted = False
+
+    @property
+    def max_pending(self):
+        """Get the maximum number of produced items kept in the queue."""
+        return self._max_pending
+
+    def _put(self, item):
+        # use a timeout, such that the thread can exit as soon as
+        # this iterator is closed, even if the queue is full
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            it = iter(self._iterable_factory())
+            try:
+                for item in it:
+                    if not self._put((item, None)):
+                        return
+            finally:
+                # release the resources held by a generator immediately,
+                # if the iteration is stopped before exhausted
+                if hasattr(it, 'close'):
+                    it.close()
+            self._put((self._END, None))
+        except Exception:
+            self._put((self._END, sys.exc_info()))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._exhausted:
+            raise StopIteration()
+        if self._thread is None:
+            self._queue = queue.Queue(self._max_pending)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        item, exc_info = self._queue.get()
+        if item is self._END:
+            self.close()
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            raise StopIteration()
+        return item
+
+    next = __next__  # Python 2 compatibility
+
+    def close(self):
+        """Stop the background thread, and wait for it to exit."""
+        self._exhausted = True
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
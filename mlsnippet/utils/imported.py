@@ -6,8 +6,13 @@ try:
 except ImportError:
     from backports.tempfile import TemporaryDirectory
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 __all__ = [
-    'TemporaryDirectory', 'makedirs'
+    'TemporaryDirectory', 'makedirs', 'scandir'
 ]
 
 
@@ -1,3 +1,6 @@
+import os
+import threading
+
 from gridfs import GridFS, GridFSBucket
 from pymongo import MongoClient
 from pymongo.database import Database
@@ -9,12 +12,90 @@ from .concepts import AutoInitAndCloseable
 __all__ = ['MongoBinder']
 
 
+class _MongoClientRegistry(object):
+    """
+    The process-wide registry of reference-counted :class:`MongoClient`
+    instances, keyed by the connection strings.
+
+    :class:`MongoClient` is thread-safe and maintains its own connection
+    pool, thus all the binders (e.g., the clones of a
+    :class:`~mlsnippet.datafs.MongoFS`) of the same connection string
+    can share one client.  A client is closed as soon as it is released
+    by all the binders.
+
+    :class:`MongoClient` must not be used across :func:`os.fork`, thus the
+    clients created by the parent process are discarded (without being
+    closed) when the registry is first used in a forked child process.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._clients = {}  # type: dict[str, list]
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # the lock might have been held by another thread of the
+            # parent process at the time of forking, thus must be replaced
+            self._pid = pid
+            self._lock = threading.Lock()
+            self._clients = {}
+
+    def acquire(self, conn_str):
+        """
+        Get the shared client of `conn_str`, and increase its reference
+        count.  A new client will be created if it does not exist.
+
+        Args:
+            conn_str (str): The MongoDB connection string.
+
+        Returns:
+            MongoClient: The shared client.
+        """
+        self._check_fork()
+        with self._lock:
+            entry = self._clients.get(conn_str)
+            if entry is None:
+                entry = self._clients[conn_str] = [MongoClient(conn_str), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, conn_str, client):
+        """
+        Decrease the reference count of a client obtained by
+        :meth:`acquire`, and close it if it is no longer referenced.
+
+        Args:
+            conn_str (str): The MongoDB connection string.
+            client (MongoClient): The client to release.
+        """
+        self._check_fork()
+        with self._lock:
+            entry = self._clients.get(conn_str)
+            # the client might be created by the parent process
+            if entry is None or entry[0] is not client:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._clients[conn_str]
+        client.close()
+
+
+_client_registry = _MongoClientRegistry()
+
+
 class MongoBinder(AutoInitAndCloseable):
     """
     Base class for MongoDB data binder.
 
     A MongoDB data binder may save and load data in a MongoDB.
     This class provides the basic interface for accessing the MongoDB.
+
+    The binders of the same connection string in a process share one
+    :class:`MongoClient` (and thus one connection pool), which is closed
+    when all these binders are closed.
     """
 
     def __init__(self, conn_str, db_name, coll_name):
@@ -114,7 +195,7 @@ class MongoBinder(AutoInitAndCloseable):
         return self._collection
 
     def _init(self):
-        self._client = MongoClient(self._conn_str)
+        self._client = _client_registry.acquire(self._conn_str)
         self._db = self._client.get_database(self._db_name)
         self._collection = self._db[self._coll_name]
         self._gridfs = GridFS(self._db, self._coll_name)
@@ -124,7 +205,7 @@ class MongoBinder(AutoInitAndCloseable):
         self._active_files.close_all()
         try:
             if self._client is not None:
-                self._client.close()
+                _client_registry.release(self._conn_str, self._client)
         finally:
             self._gridfs = None
             self._db = None
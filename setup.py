@@ -55,6 +55,11 @@ setup(
     setup_requires=['setuptools'],
     install_requires=install_requires,
     dependency_links=dependency_links,
+    entry_points={
+        'console_scripts': [
+            'mlsnippet-copy-fs = mlsnippet.datafs.copyfs:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 2 - Alpha',
         'Intended Audience :: Developers',
@@ -174,6 +174,33 @@ class StandardFSChecks(object):
                     with maybe_close(fs.open(n + '.invalid', 'r')):
                         pass
 
+            # iter_chunks and copy_to
+            for n in names:
+                chunks = list(fs.iter_chunks(n, 3))
+                self.assertEquals(get_content(n), b''.join(chunks))
+                for chunk in chunks:
+                    self.assertLessEqual(len(chunk), 3)
+                self.assertEquals(get_content(n), b''.join(fs.iter_chunks(n)))
+                buf = BytesIO()
+                fs.copy_to(n, buf)
+                self.assertEquals(get_content(n), buf.getvalue())
+                with pytest.raises(DataFileNotExist):
+                    _ = fs.iter_chunks(n + '.invalid')
+                with pytest.raises(DataFileNotExist):
+                    fs.copy_to(n + '.invalid', BytesIO())
+
+            # batch_retrieve
+            query = sum([[n, n + '.invalid'] for n in names], []) + ['a']
+            self.assertListEqual(
+                sum([[get_content(n), None] for n in names], []) + [None],
+                fs.batch_retrieve(query)
+            )
+            self.assertListEqual(
+                sum([[(get_content(n),), None] for n in names], []) + [None],
+                fs.batch_retrieve(iter(query), ())
+            )
+            self.assertListEqual([], fs.batch_retrieve([]))
+
             # isfile, batch_isfile
             for n in names:
                 self.assertTrue(fs.isfile(n))
@@ -198,6 +225,10 @@ class StandardFSChecks(object):
                 with pytest.raises(UnsupportedOperation):
                     with maybe_close(fs.open('c/3.txt', 'w')) as f:
                         f.write(b'c/3.txt content')
+                with pytest.raises(UnsupportedOperation):
+                    fs.put_stream('d/4.txt', [b'd/4.txt content'])
+                with pytest.raises(UnsupportedOperation):
+                    fs.batch_put_data([('f/6.txt', b'f/6.txt content')])
             return
 
         with self.temporary_fs() as fs:
@@ -214,6 +245,19 @@ class StandardFSChecks(object):
                                                 'file-like object'):
                 fs.put_data('err2.txt', object())
 
+            # put_stream
+            fs.put_stream('d/4.txt', [b'to be ', b'overwritten'])
+            fs.put_stream('d/4.txt', iter([b'd/4', b'.txt ', b'content']))
+            fs.put_stream('e/5.txt', BytesIO(b'e/5.txt content'))
+
+            # batch_put_data
+            fs.batch_put_data([('f/6.txt', b'to be overwritten'),
+                               ('g/7.txt', BytesIO(b'g/7.txt content')),
+                               ('f/6.txt', b'f/6.txt content')])
+            with pytest.raises(TypeError, match='`data` must be bytes or a '
+                                                'file-like object'):
+                fs.batch_put_data([('err3.txt', u'')])
+
             # open
             with maybe_close(fs.open('c/3.txt', 'w')) as f:
                 f.write(b'to be overwritten')
@@ -229,7 +273,11 @@ class StandardFSChecks(object):
                 {
                     'a/1.txt': (b'a/1.txt content',),
                     'b/2.txt': (b'b/2.txt content',),
-                    'c/3.txt': (b'c/3.txt content',)
+                    'c/3.txt': (b'c/3.txt content',),
+                    'd/4.txt': (b'd/4.txt content',),
+                    'e/5.txt': (b'e/5.txt content',),
+                    'f/6.txt': (b'f/6.txt content',),
+                    'g/7.txt': (b'g/7.txt content',),
                 },
                 self.get_snapshot(fs)
             )
@@ -341,6 +389,18 @@ class StandardFSChecks(object):
                     with pytest.raises(UnsupportedOperation):
                         fs.retrieve(name, meta_keys_iter())
 
+            # batch_retrieve
+            query = sum([[name, name + '.invalid'] for name in names], [])
+            if capacity.can_read_meta():
+                self.assertListEqual(
+                    sum([[(get_content(name),) + get_meta_values(name), None]
+                         for name in names], []),
+                    fs.batch_retrieve(query, meta_keys_iter())
+                )
+            else:
+                with pytest.raises(UnsupportedOperation):
+                    _ = fs.batch_retrieve(query, meta_keys_iter())
+
             # iter_files
             if capacity.can_read_meta():
                 expected = [
@@ -428,6 +488,22 @@ class StandardFSChecks(object):
                     self.get_snapshot(fs)
                 )
 
+                # batch_put_meta
+                fs.batch_put_meta([('a/1.txt', {'z': 'a/1.txt zz'}),
+                                   ('b/2.rst', {'y': 2}),
+                                   ('c', {})])
+                with pytest.raises(DataFileNotExist):
+                    fs.batch_put_meta([('d.invalid', {'z': 'd z'}),
+                                       ('c', {'y': 3})])
+                self.assertDictEqual(
+                    {'a/1.txt': (get_content('a/1.txt'),
+                                 {'z': 'a/1.txt zz', 'a': 1}),
+                     'b/2.rst': (get_content('b/2.rst'),
+                                 dict(get_meta_dict('b/2.rst'), y=2)),
+                     'c': (get_content('c'), dict(get_meta_dict('c'), y=3))},
+                    self.get_snapshot(fs)
+                )
+
                 # clear_meta
                 for name in names:
                     try:
@@ -482,6 +558,8 @@ class StandardFSChecks(object):
                 for name in names:
                     with pytest.raises(UnsupportedOperation):
                         _ = fs.put_meta(name, {'z': name}, **{name[0]: 1})
+                    with pytest.raises(UnsupportedOperation):
+                        fs.batch_put_meta([(name, {'z': name})])
                     with pytest.raises(UnsupportedOperation):
                         fs.clear_meta(name)
                     with pytest.raises(UnsupportedOperation):
@@ -3,7 +3,9 @@ import tarfile
 import unittest
 import zipfile
 from contextlib import contextmanager
+from io import BytesIO
 
+import mock
 import pytest
 import six
 
@@ -16,20 +18,51 @@ def canonical_path(name):
     return name.replace('\\', '/')
 
 
+def check_zero_copy(self, is_mapped):
+    snapshot = {'a/1.txt': (b'a/1.txt content',), 'b': (b'b content',)}
+    data_type = memoryview if is_mapped else six.binary_type
+
+    with self.temporary_fs(snapshot) as fs:
+        data = fs.retrieve('a/1.txt', zero_copy=True)
+        self.assertIsInstance(data, data_type)
+        self.assertEquals(b'a/1.txt content', bytes(data))
+        data2 = fs.retrieve('b', (), zero_copy=True)
+        self.assertIsInstance(data2, tuple)
+        self.assertIsInstance(data2[0], data_type)
+        self.assertEquals(b'b content', bytes(data2[0]))
+        self.assertIsInstance(fs.retrieve('b'), six.binary_type)
+        with pytest.raises(DataFileNotExist):
+            _ = fs.retrieve('c', zero_copy=True)
+
+        batch = fs.batch_retrieve(['b', 'c', 'a/1.txt'], zero_copy=True)
+        self.assertIsNone(batch[1])
+        self.assertIsInstance(batch[0], data_type)
+        self.assertEquals([b'b content', b'a/1.txt content'],
+                          [bytes(batch[0]), bytes(batch[2])])
+
+    # the memoryview objects should still be valid after fs is closed
+    self.assertEquals(b'a/1.txt content', bytes(data))
+    self.assertEquals(b'b content', bytes(batch[0]))
+
+
 class TarArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
 
+    archive_name = 'archive.tar.gz'
+    archive_mode = 'w:gz'
+
     def get_snapshot(self, fs):
         ret = {}
-        for mi in fs._file_obj:
-            if not mi.isdir():
-                cnt = fs._file_obj.extractfile(mi).read()
-                ret[canonical_path(mi.name)] = (cnt,)
+        with tarfile.open(fs.archive_file, 'r') as tf:
+            for mi in tf:
+                if not mi.isdir():
+                    cnt = tf.extractfile(mi).read()
+                    ret[canonical_path(mi.name)] = (cnt,)
         return ret
 
     @contextmanager
     def temporary_fs(self, snapshot=None, **kwargs):
         with TemporaryDirectory() as tempdir:
-            archive_file = os.path.join(tempdir, 'archive.tar.gz')
+            archive_file = os.path.join(tempdir, self.archive_name)
             tempdir = os.path.join(tempdir, 'temp')
             if snapshot:
                 for filename, payload in six.iteritems(snapshot):
@@ -39,7 +72,7 @@ class TarArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
                     makedirs(file_dir, exist_ok=True)
                     with open(file_path, 'wb') as f:
                         f.write(content)
-            with tarfile.open(archive_file, 'w:gz') as fobj:
+            with tarfile.open(archive_file, self.archive_mode) as fobj:
                 if snapshot:
                     for filename in os.listdir(tempdir):
                         temp_path = os.path.join(tempdir, filename)
@@ -48,7 +81,10 @@ class TarArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
                 yield fs
 
     def test_standard(self):
-        self.run_standard_checks(DataFSCapacity.READ_DATA)
+        self.run_standard_checks(
+            DataFSCapacity.READ_DATA | DataFSCapacity.QUICK_COUNT |
+            DataFSCapacity.RANDOM_SAMPLE
+        )
 
     def test_errors(self):
         with pytest.raises(IOError, match='Not a file'):
@@ -57,9 +93,74 @@ class TarArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
             with pytest.raises(IOError, match='Not a file'):
                 _ = TarArchiveFS(tempdir)
 
+    def test_zero_copy(self):
+        check_zero_copy(self, False)
+
+    def test_index(self):
+        snapshot = {'a/1.txt': (b'a/1.txt content',), 'b': (b'b content',)}
+        expected = sorted((n, v[0]) for n, v in six.iteritems(snapshot))
+
+        with self.temporary_fs(snapshot) as fs:
+            self.assertEquals(fs.archive_file + '.index', fs.index_file)
+            self.assertTrue(fs.save_index)
+            self.assertTrue(os.path.isfile(fs.index_file))
+            self.assertEquals(fs.index_file, fs.clone().index_file)
+
+            # the saved index should be reused by other instances
+            with mock.patch('mlsnippet.datafs.archivefs._TarIndex.build',
+                            side_effect=RuntimeError('should not build')):
+                with fs.clone() as fs2:
+                    self.assertEquals(expected, sorted(fs2.iter_files()))
+                    self.assertEquals(b'b content', fs2.get_data('b'))
+
+            # the saved index should be invalidated if archive is modified
+            with tarfile.open(fs.archive_file, self.archive_mode) as fobj:
+                ti = tarfile.TarInfo('c')
+                ti.size = 9
+                fobj.addfile(ti, BytesIO(b'c content'))
+            os.utime(fs.archive_file, (0, 0))
+            with fs.clone() as fs2:
+                self.assertEquals(['c'], list(fs2.iter_names()))
+                self.assertEquals(b'c content', fs2.get_data('c'))
+                self.assertFalse(fs2.isfile('b'))
+
+            # test custom index file, and do not save index
+            index_file = fs.archive_file + '.custom'
+            with TarArchiveFS(fs.archive_file, index_file=index_file,
+                              save_index=False) as fs2:
+                self.assertEquals(index_file, fs2.index_file)
+                self.assertFalse(fs2.save_index)
+                self.assertEquals(['c'], list(fs2.iter_names()))
+                self.assertFalse(os.path.exists(index_file))
+
+            # test unwritable index file
+            index_file = os.path.join(
+                os.path.dirname(fs.archive_file), 'not-exist', 'archive.index')
+            with TarArchiveFS(fs.archive_file, index_file=index_file) as fs2:
+                self.assertEquals(['c'], list(fs2.iter_names()))
+                self.assertFalse(os.path.exists(index_file))
+
+
+class UncompressedTarArchiveFSTestCase(TarArchiveFSTestCase):
+
+    archive_name = 'archive.tar'
+    archive_mode = 'w'
+
+    def test_mmap(self):
+        snapshot = {'a/1.txt': (b'a/1.txt content',), 'b': (b'b content',)}
+        with self.temporary_fs(snapshot) as fs:
+            self.assertIsNotNone(fs._mmap)
+            self.assertEquals(b'b content', fs.get_data('b'))
+            self.assertIsNone(fs._file_obj)
+
+    def test_zero_copy(self):
+        check_zero_copy(self, True)
+
 
 class ZipArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
 
+    compression = zipfile.ZIP_STORED
+
     def get_snapshot(self, fs):
         ret = {}
         for mi in fs._file_obj.infolist():
@@ -81,7 +182,8 @@ class ZipArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
                     makedirs(file_dir, exist_ok=True)
                     with open(file_path, 'wb') as f:
                         f.write(content)
-            with zipfile.ZipFile(archive_file, 'w') as fobj:
+            with zipfile.ZipFile(archive_file, 'w',
+                                 compression=self.compression) as fobj:
                 if snapshot:
                     def g(arcname, path):
                         for filename in os.listdir(path):
@@ -96,7 +198,10 @@ class ZipArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
                 yield fs
 
     def test_standard(self):
-        self.run_standard_checks(DataFSCapacity.READ_DATA)
+        self.run_standard_checks(
+            DataFSCapacity.READ_DATA | DataFSCapacity.QUICK_COUNT |
+            DataFSCapacity.RANDOM_SAMPLE
+        )
 
     def test_errors(self):
         with pytest.raises(IOError, match='Not a file'):
@@ -105,6 +210,14 @@ class ZipArchiveFSTestCase(unittest.TestCase, StandardFSChecks):
             with pytest.raises(IOError, match='Not a file'):
                 _ = ZipArchiveFS(tempdir)
 
+    def test_zero_copy(self):
+        check_zero_copy(self, self.compression == zipfile.ZIP_STORED)
+
+
+class DeflatedZipArchiveFSTestCase(ZipArchiveFSTestCase):
+
+    compression = zipfile.ZIP_DEFLATED
+
 
 if __name__ == '__main__':
     unittest.main()
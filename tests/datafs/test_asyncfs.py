@@ -0,0 +1,147 @@
+import threading
+import unittest
+
+import pytest
+import six
+
+from mlsnippet.datafs import *
+from mlsnippet.utils import TemporaryDirectory
+
+if not six.PY2:
+    import asyncio
+
+
+def _run(loop, awaitable):
+    return loop.run_until_complete(awaitable)
+
+
+def _collect(loop, it):
+    ret = []
+    while True:
+        try:
+            ret.append(_run(loop, it.__anext__()))
+        except StopAsyncIteration:
+            break
+    return ret
+
+
+@pytest.mark.skipif(six.PY2, reason='asyncio is not available in Python 2')
+class AsyncDataFSTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_props_and_errors(self):
+        with TemporaryDirectory() as tempdir:
+            fs = LocalFS(tempdir)
+            afs = AsyncDataFS(fs, num_workers=3, iter_batch_size=5)
+            self.assertIs(fs, afs.fs)
+            self.assertEquals(3, afs.num_workers)
+            self.assertEquals(5, afs.iter_batch_size)
+
+            with pytest.raises(ValueError,
+                               match='`num_workers` must be positive'):
+                _ = AsyncDataFS(fs, num_workers=0)
+            with pytest.raises(ValueError,
+                               match='`iter_batch_size` must be positive'):
+                _ = AsyncDataFS(fs, iter_batch_size=0)
+
+    def test_methods(self):
+        loop = self.loop
+        names = ['{}.txt'.format(i) for i in range(20)]
+        with TemporaryDirectory() as tempdir:
+            with AsyncDataFS(LocalFS(tempdir), num_workers=4) as afs:
+                # the requests should be executed concurrently
+                _run(loop, asyncio.gather(*[
+                    afs.put_data(n, n.encode('utf-8')) for n in names]))
+                self.assertEquals(20, _run(loop, afs.count()))
+                self.assertEquals(sorted(names),
+                                  sorted(_run(loop, afs.list_names())))
+                self.assertEquals(
+                    [n.encode('utf-8') for n in names],
+                    _run(loop, asyncio.gather(
+                        *[afs.get_data(n) for n in names]))
+                )
+                self.assertEquals((b'1.txt',),
+                                  _run(loop, afs.retrieve('1.txt', ())))
+                self.assertEquals(
+                    [b'1.txt', None],
+                    _run(loop, afs.batch_retrieve(['1.txt', 'none']))
+                )
+                self.assertTrue(_run(loop, afs.isfile('1.txt')))
+                self.assertEquals(
+                    [True, False],
+                    _run(loop, afs.batch_isfile(['1.txt', 'none']))
+                )
+                self.assertEquals(3, len(_run(loop, afs.sample_names(3))))
+                self.assertEquals(3, len(_run(loop, afs.sample_files(3))))
+
+                # the errors should be propagated
+                with pytest.raises(DataFileNotExist):
+                    _run(loop, afs.get_data('none'))
+                with pytest.raises(UnsupportedOperation):
+                    _run(loop, afs.get_meta('1.txt', ['a']))
+
+                # test the asynchronous iterators
+                afs._iter_batch_size = 3
+                self.assertEquals(sorted(names),
+                                  sorted(_collect(loop, afs.iter_names())))
+                self.assertEquals(
+                    sorted((n, n.encode('utf-8')) for n in names),
+                    sorted(_collect(loop, afs.iter_files()))
+                )
+
+                # test to close the asynchronous iterator early
+                it = afs.iter_names()
+                self.assertIn(_run(loop, it.__anext__()), names)
+                _run(loop, it.aclose())
+                with pytest.raises(StopAsyncIteration):
+                    _run(loop, it.__anext__())
+
+    def test_async_context(self):
+        loop = self.loop
+        with TemporaryDirectory() as tempdir:
+            afs = AsyncDataFS(LocalFS(tempdir))
+            self.assertIs(afs, _run(loop, afs.__aenter__()))
+            self.assertIsNotNone(afs._pool._executor)
+            _run(loop, afs.__aexit__(None, None, None))
+            self.assertIsNone(afs._pool._executor)
+
+    def test_bounded_workers(self):
+        loop = self.loop
+        lock = threading.Lock()
+        running = [0, 0]
+
+        class _CountingFS(LocalFS):
+            def clone(self):
+                return _CountingFS(self.root_dir)
+
+            def get_data(self, filename):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running[0], running[1])
+                try:
+                    return super(_CountingFS, self).get_data(filename)
+                finally:
+                    with lock:
+                        running[0] -= 1
+
+        with TemporaryDirectory() as tempdir:
+            fs = _CountingFS(tempdir)
+            fs.put_data('a', b'a')
+            with AsyncDataFS(fs, num_workers=2) as afs:
+                self.assertEquals(
+                    [b'a'] * 100,
+                    _run(loop, asyncio.gather(
+                        *[afs.get_data('a') for _ in range(100)]))
+                )
+            self.assertLessEqual(running[1], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
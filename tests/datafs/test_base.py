@@ -129,6 +129,67 @@ class DataFSTestCase(unittest.TestCase):
         self.assertEquals(('a', 'b', 'c', 'd'), flow.meta_keys)
         self.assertTrue(flow.skip_incomplete)
 
+        # as_flow with sharding
+        flow = fs.as_flow(123, num_shards=2, shard_index=1, shard_by='hash')
+        self.assertIsInstance(flow, DataFSForwardFlow)
+        self.assertEquals((2, 1, 'hash'),
+                          (flow.num_shards, flow.shard_index, flow.shard_by))
+        flow = fs.as_flow(123, shuffle=True, num_shards=2, shard_index=1)
+        self.assertIsInstance(flow, DataFSIndexedFlow)
+        np.testing.assert_equal(fs.list_names()[1::2], flow.names)
+
+        # as_flow with meta filter
+        fs._files_meta['3']['z'] = fs._files_meta['7']['z'] = 'selected'
+        flow = fs.as_flow(123, meta_filter={'z': 'selected'})
+        self.assertIsInstance(flow, DataFSIndexedFlow)
+        np.testing.assert_equal(['3', '7'], flow.names)
+
+    def test_as_flow_block_shuffle(self):
+        fs = _DummyDataFS()
+        fs.clone = Mock(wraps=fs.clone)
+
+        # as_flow with block shuffling
+        flow = fs.as_flow(123, shuffle=True, seed=1, shuffle_block_size=4,
+                          shuffle_buffer_size=16)
+        self.assertIsInstance(flow, DataFSIndexedFlow)
+        self.assertIsNot(fs, flow.fs)
+        self.assertEquals(1, fs.clone.call_count)
+        self.assertTrue(flow.is_shuffled)
+        self.assertEquals(1, flow.seed)
+        self.assertEquals(4, flow.shuffle_block_size)
+        self.assertEquals(16, flow.shuffle_buffer_size)
+        np.testing.assert_equal(fs.list_names(), flow.names)
+
+    def test_query(self):
+        fs = _DummyDataFS()
+        fs._query_batch_size = 3
+        fs._files_meta['3']['z'] = fs._files_meta['7']['z'] = 'selected'
+        fs._files_meta['8']['z'] = None
+        fs.batch_get_meta = Mock(wraps=fs.batch_get_meta)
+
+        self.assertEquals(fs._names, list(fs.query_names()))
+        self.assertEquals(['1'], list(fs.query_names('1')))
+        self.assertEquals(['2', '3', '4'], list(fs.query_names('[2-4]$')))
+        self.assertEquals(0, fs.batch_get_meta.call_count)
+
+        # filter by meta values, in batches
+        self.assertEquals(['3', '7'],
+                          list(fs.query_names(meta_filter={'z': 'selected'})))
+        self.assertEquals(4, fs.batch_get_meta.call_count)
+        self.assertEquals(['7'], list(fs.query_names(
+            '[5-9]', meta_filter={'z': 'selected'})))
+        self.assertEquals(['8'], list(fs.query_names(meta_filter={'z': None})))
+        self.assertEquals(['7'], list(fs.query_names(
+            meta_filter={'7': 1, 'z': 'selected'})))
+
+        # query the files
+        self.assertEquals(
+            [('3', b'3', 'selected'), ('7', b'7', 'selected')],
+            list(fs.query_files(['z'], meta_filter={'z': 'selected'}))
+        )
+        self.assertEquals([('2', b'2'), ('3', b'3')],
+                          list(fs.query_files(names_pattern='[23]')))
+
     def test_sub_flow(self):
         fs = _DummyDataFS()
         fs.clone = Mock(wraps=fs.clone)
@@ -158,6 +219,28 @@ class DataFSTestCase(unittest.TestCase):
         self.assertEquals(('a', 'b', 'c', 'd'), flow.meta_keys)
         self.assertTrue(flow.skip_incomplete)
 
+        # sub_flow with worker threads
+        flow = fs.sub_flow(123, names, num_workers=4, prefetch=2)
+        self.assertIsInstance(flow, DataFSIndexedFlow)
+        self.assertEquals(4, flow.num_workers)
+        self.assertEquals(2, flow.prefetch)
+
+        # sub_flow with columnar output
+        flow = fs.sub_flow(123, names, meta_keys=['a'], columnar=True,
+                           meta_dtypes={'a': np.int32}, reuse_buffers=True)
+        self.assertTrue(flow.columnar)
+        self.assertEquals({'a': np.int32}, flow.meta_dtypes)
+        self.assertTrue(flow.reuse_buffers)
+
+        # sub_flow with shuffling seed
+        flow = fs.sub_flow(123, names, shuffle=True, seed=1234)
+        self.assertEquals(1234, flow.seed)
+
+        # sub_flow with sharding
+        flow = fs.sub_flow(123, names, num_shards=2, shard_index=1)
+        self.assertEquals((2, 1), (flow.num_shards, flow.shard_index))
+        np.testing.assert_equal(list('359'), flow.names)
+
     def test_random_flow(self):
         fs = _DummyDataFS()
         fs.clone = Mock(wraps=fs.clone)
@@ -182,6 +265,11 @@ class DataFSTestCase(unittest.TestCase):
         self.assertEquals(('a', 'b'), flow.meta_keys)
         self.assertTrue(flow.skip_incomplete)
 
+        # as_random_flow with sharding
+        flow = fs.random_flow(123, num_shards=2, shard_index=1)
+        self.assertEquals((2, 1, 'hash'),
+                          (flow.num_shards, flow.shard_index, flow.shard_by))
+
         # as_random_flow with capacity check
         fs._capacity = DataFSCapacity(
             DataFSCapacity.ALL & ~DataFSCapacity.RANDOM_SAMPLE)
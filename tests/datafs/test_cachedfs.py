@@ -0,0 +1,283 @@
+import os
+import unittest
+from contextlib import contextmanager
+
+import six
+from mock import Mock
+
+from mlsnippet.datafs import *
+from mlsnippet.utils import TemporaryDirectory, makedirs, iter_files
+from .standard_checks import StandardFSChecks
+from .test_dataflow import _DummyDataFS
+
+
+class CachedDataFSTestCase(unittest.TestCase, StandardFSChecks):
+
+    def get_snapshot(self, fs):
+        ret = {}
+        root_dir = fs.fs.root_dir
+        for name in iter_files(root_dir):
+            with open(os.path.join(root_dir, name), 'rb') as f:
+                cnt = f.read()
+            ret[name] = (cnt,)
+        return ret
+
+    @contextmanager
+    def temporary_fs(self, snapshot=None, **kwargs):
+        with TemporaryDirectory() as tempdir:
+            if snapshot:
+                for filename, payload in six.iteritems(snapshot):
+                    content = payload[0]
+                    file_path = os.path.join(tempdir, filename)
+                    file_dir = os.path.split(file_path)[0]
+                    makedirs(file_dir, exist_ok=True)
+                    with open(file_path, 'wb') as f:
+                        f.write(content)
+            with CachedDataFS(LocalFS(tempdir, **kwargs)) as fs:
+                yield fs
+
+    def test_standard(self):
+        self.run_standard_checks(
+            DataFSCapacity.READ_WRITE_DATA | DataFSCapacity.QUICK_COUNT |
+            DataFSCapacity.RANDOM_SAMPLE
+        )
+
+    def test_data_cache(self):
+        names = ['a/1.txt', 'a/2.txt', 'b/3.txt', 'c']
+        snapshot = {n: (n.encode('utf-8') * 10,) for n in names}
+        with self.temporary_fs(snapshot) as fs, \
+                TemporaryDirectory() as cache_dir:
+            local_fs = fs.fs
+            local_fs.batch_retrieve = Mock(wraps=local_fs.batch_retrieve)
+            fs = CachedDataFS(local_fs, memory_limit=150,
+                              disk_cache_dir=os.path.join(cache_dir, 'x'))
+            self.assertIs(local_fs, fs.fs)
+            self.assertEquals(150, fs.memory_limit)
+            self.assertEquals(os.path.join(cache_dir, 'x'), fs.disk_cache_dir)
+            self.assertTrue(os.path.isdir(fs.disk_cache_dir))
+
+            # the first read should fetch from the wrapped fs
+            self.assertEquals(snapshot['a/1.txt'][0], fs.get_data('a/1.txt'))
+            self.assertEquals(1, fs.misses)
+            self.assertEquals(70, fs.memory_size)
+            self.assertTrue(os.path.isfile(fs._disk_cache_path('a/1.txt')))
+            self.assertTrue(fs._disk_cache_path('a/1.txt').startswith(
+                os.path.join(cache_dir, 'x') + os.path.sep))
+
+            # the second read should hit the memory
+            self.assertEquals(snapshot['a/1.txt'][0], fs.get_data('a/1.txt'))
+            self.assertEquals((1, 1, 0),
+                              (fs.misses, fs.memory_hits, fs.disk_hits))
+            self.assertEquals(1, local_fs.batch_retrieve.call_count)
+
+            # the least recently used content should be evicted
+            self.assertEquals(
+                [snapshot[n][0] for n in names] + [None],
+                fs.batch_retrieve(names + ['none'])
+            )
+            self.assertEquals((5, 2, 0),
+                              (fs.misses, fs.memory_hits, fs.disk_hits))
+            self.assertEquals(['a/2.txt', 'b/3.txt', 'c'],
+                              list(fs._cache.data))
+            self.assertEquals(150, fs.memory_size)
+
+            # the evicted content should be served from the disk, and
+            # the clones should share the same cache
+            fs2 = fs.clone()
+            self.assertEquals(sorted((n, snapshot[n][0]) for n in names),
+                              sorted(fs2.iter_files()))
+            self.assertEquals((5, 5, 1),
+                              (fs.misses, fs.memory_hits, fs.disk_hits))
+            self.assertEquals(
+                sorted(snapshot[n] for n in names),
+                sorted(f[1:] for f in fs2.sample_files(len(names)))
+            )
+            self.assertEquals(
+                (5, 10), (fs.misses, fs.memory_hits + fs.disk_hits))
+            self.assertEquals(2, local_fs.batch_retrieve.call_count)
+            fs2.close()
+
+            # writing should invalidate the cache
+            fs.put_data('c', b'new c')
+            self.assertFalse(os.path.exists(fs._disk_cache_path('c')))
+            self.assertEquals(b'new c', fs.get_data('c'))
+            self.assertEquals(6, fs.misses)
+            with fs.open('c', 'w') as f:
+                f.write(b'new new c')
+            self.assertEquals(b'new new c', fs.get_data('c'))
+            fs.put_stream('c', [b'new new new c'])
+            self.assertEquals(b'new new new c', fs.get_data('c'))
+            self.assertEquals(8, fs.misses)
+
+            # content larger than the memory limit should not be cached
+            fs.put_data('d', b'd' * 151)
+            self.assertEquals(b'd' * 151, fs.get_data('d'))
+            self.assertNotIn('d', fs._cache.data)
+            disk_hits = fs.disk_hits
+            self.assertEquals(b'd' * 151, fs.get_data('d'))
+            self.assertEquals((9, disk_hits + 1), (fs.misses, fs.disk_hits))
+
+            # invalidate the whole cache
+            fs.invalidate()
+            self.assertEquals(0, fs.memory_size)
+            self.assertEquals([], list(iter_files(fs.disk_cache_dir)))
+            self.assertEquals(snapshot['a/1.txt'][0], fs.get_data('a/1.txt'))
+            self.assertEquals(10, fs.misses)
+            fs.close()
+
+    def test_disk_cache_names(self):
+        dummy_fs = _DummyDataFS()
+        with TemporaryDirectory() as tempdir:
+            cache_dir = os.path.join(tempdir, 'cache')
+            victim = os.path.join(tempdir, 'victim')
+            with open(victim, 'wb') as f:
+                f.write(b'victim')
+            names = [victim, '../victim', '../../x', 'a', 'a/b', 'a/b/c']
+            dummy_fs._names = names
+            dummy_fs._files_data = {n: n.encode('utf-8') for n in names}
+            dummy_fs.put_data = Mock()
+
+            fs = CachedDataFS(dummy_fs, memory_limit=0,
+                              disk_cache_dir=cache_dir)
+            for _ in range(2):
+                for name in names:
+                    self.assertEquals(name.encode('utf-8'),
+                                      fs.get_data(name))
+            self.assertEquals((len(names), len(names)),
+                              (fs.misses, fs.disk_hits))
+
+            # all the cached files should be inside the cache directory,
+            # and the files outside should not be touched
+            self.assertEquals(len(names), len(list(iter_files(cache_dir))))
+            self.assertEquals(['cache', 'victim'], sorted(os.listdir(tempdir)))
+            fs.put_data(victim, b'new')
+            fs.put_data('../victim', b'new')
+            with open(victim, 'rb') as f:
+                self.assertEquals(b'victim', f.read())
+            self.assertEquals(len(names) - 2,
+                              len(list(iter_files(cache_dir))))
+
+            # invalidating the whole cache should not remove the entries
+            # not created by the cache
+            others = ['0', 'abc', 'zz', 'ab.txt', 'x/ab']
+            for other in others:
+                path = os.path.join(cache_dir, other)
+                makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(b'other')
+            fs.invalidate()
+            self.assertEquals(sorted(others),
+                              sorted(iter_files(cache_dir)))
+
+            # errors of the disk tier should be regarded as cache misses
+            path = fs._disk_cache_path('a')
+            with open(os.path.dirname(path), 'wb') as f:
+                f.write(b'not a directory')
+            self.assertEquals(b'a', fs.get_data('a'))
+            self.assertEquals(b'a', fs.get_data('a'))
+            self.assertEquals(len(names) + 2, fs.misses)
+            self.assertFalse(os.path.exists(path))
+
+    def test_invalidate_after_write(self):
+        with self.temporary_fs({'a': (b'old',)}) as fs:
+            fs2 = fs.clone()
+            local_fs = fs.fs
+            put_data = local_fs.put_data
+
+            # a clone reading the file during writing should not
+            # leave the old content in the cache
+            def racing_put_data(filename, data):
+                self.assertEquals(b'old', fs2.get_data(filename))
+                put_data(filename, data)
+
+            local_fs.put_data = racing_put_data
+            fs.put_data('a', b'new')
+            self.assertEquals(b'new', fs2.get_data('a'))
+
+            with fs.open('a', 'w') as f:
+                f.write(b'newer')
+                self.assertEquals(b'new', fs2.get_data('a'))
+            self.assertEquals(b'newer', fs2.get_data('a'))
+
+        # a clone which has fetched the old content before the writing
+        # should not put it into the cache after the writing
+        with self.temporary_fs({'a': (b'old',)}) as local_fs, \
+                TemporaryDirectory() as cache_dir:
+            local_fs = local_fs.fs
+            fs = CachedDataFS(local_fs, disk_cache_dir=cache_dir)
+            fs2 = fs.clone()
+            batch_retrieve = fs2.fs.batch_retrieve
+
+            def racing_batch_retrieve(filenames, meta_keys=None):
+                ret = batch_retrieve(filenames, meta_keys)
+                fs.put_data('a', b'new')
+                return ret
+
+            fs2.fs.batch_retrieve = racing_batch_retrieve
+            self.assertEquals(b'old', fs2.get_data('a'))
+            fs2.fs.batch_retrieve = batch_retrieve
+            self.assertEquals(0, fs.memory_size)
+            self.assertEquals([], list(iter_files(cache_dir)))
+            self.assertEquals(b'new', fs2.get_data('a'))
+            self.assertEquals(b'new', fs.get_data('a'))
+            self.assertEquals((2, 1), (fs.misses, fs.memory_hits))
+
+        dummy_fs = _DummyDataFS()
+        fs = CachedDataFS(dummy_fs)
+        batch_get_meta = dummy_fs.batch_get_meta
+
+        def racing_batch_get_meta(filenames, meta_keys):
+            ret = batch_get_meta(filenames, meta_keys)
+            fs.put_meta('2', {'z': 'new'})
+            return ret
+
+        dummy_fs.put_meta = lambda filename, meta_dict: \
+            dummy_fs._files_meta[filename].update(meta_dict)
+        dummy_fs.batch_get_meta = racing_batch_get_meta
+        self.assertEquals(('2 z',), fs.get_meta('2', ['z']))
+        dummy_fs.batch_get_meta = batch_get_meta
+        self.assertEquals(('new',), fs.get_meta('2', ['z']))
+
+        dummy_fs = _DummyDataFS()
+        fs = CachedDataFS(dummy_fs)
+
+        def racing_put_meta(filename, meta_dict):
+            self.assertEquals(('1 z',), fs.get_meta(filename, ['z']))
+            dummy_fs._files_meta[filename].update(meta_dict)
+
+        dummy_fs.put_meta = racing_put_meta
+        fs.put_meta('1', {'z': 'new'})
+        self.assertEquals(('new',), fs.get_meta('1', ['z']))
+
+    def test_meta_cache(self):
+        dummy_fs = _DummyDataFS()
+        dummy_fs.batch_get_meta = Mock(wraps=dummy_fs.batch_get_meta)
+        dummy_fs.put_meta = Mock()
+        dummy_fs.batch_put_meta = Mock()
+        dummy_fs.clear_meta = Mock()
+        dummy_fs.clear_and_put_meta = Mock()
+        fs = CachedDataFS(dummy_fs)
+        self.assertEquals(dummy_fs.capacity, fs.capacity)
+
+        self.assertEquals(('1 z', 1), fs.get_meta('1', ['z', '1']))
+        self.assertEquals((b'1', '1 z'), fs.retrieve('1', ['z']))
+        self.assertEquals([('1 z',), ('2 z',)],
+                          fs.batch_get_meta(['1', '2'], ['z']))
+        self.assertEquals(2, dummy_fs.batch_get_meta.call_count)
+        self.assertEquals(['2'], dummy_fs.batch_get_meta.call_args[0][0])
+
+        # writing the meta should invalidate the cache
+        for method, args in [('put_meta', ({'z': 1},)),
+                             ('clear_meta', ()),
+                             ('clear_and_put_meta', ({'z': 1},))]:
+            getattr(fs, method)('1', *args)
+            self.assertTrue(getattr(dummy_fs, method).called)
+            self.assertNotIn('1', fs._cache.meta)
+            self.assertEquals(('1 z',), fs.get_meta('1', ['z']))
+        fs.batch_put_meta([('1', {'z': 1}), ('2', {'z': 2})])
+        self.assertTrue(dummy_fs.batch_put_meta.called)
+        self.assertEquals({}, fs._cache.meta)
+
+
+if __name__ == '__main__':
+    unittest.main()
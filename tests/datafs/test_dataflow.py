@@ -52,6 +52,14 @@ class _DummyDataFS(DataFS):
         pass
 
 
+def _raise(error):
+    raise error
+
+
+def _decode_cont(cont):
+    return np.asarray([int(cont)] * 2, dtype=np.int32)
+
+
 class DataFlowCommonChecks(object):
 
     def check_common_props_and_methods(self, factory):
@@ -84,6 +92,70 @@ class DataFlowCommonChecks(object):
         self.assertTrue(fake_fs.init.called)
         self.assertTrue(fake_fs.close.called)
 
+        # test decode args
+        flow = factory(fs=fake_fs, batch_size=256)
+        self.assertIsNone(flow.decode_fn)
+        self.assertIsNone(flow.decode_workers)
+        flow = factory(fs=fake_fs, batch_size=256, decode_fn=_decode_cont,
+                       decode_workers=2)
+        self.assertIs(_decode_cont, flow.decode_fn)
+        self.assertEquals(2, flow.decode_workers)
+        with pytest.raises(ValueError, match='`decode_workers` is specified, '
+                                             'but `decode_fn` is not'):
+            _ = factory(fs=fake_fs, batch_size=256, decode_workers=2)
+        with pytest.raises(ValueError,
+                           match='`decode_workers` must be positive'):
+            _ = factory(fs=fake_fs, batch_size=256, decode_fn=_decode_cont,
+                        decode_workers=0)
+
+        # test columnar args
+        flow = factory(fs=fake_fs, batch_size=256)
+        self.assertFalse(flow.columnar)
+        self.assertIsNone(flow.meta_dtypes)
+        flow = factory(fs=fake_fs, batch_size=256, meta_keys=['a', 'b'],
+                       columnar=True, meta_dtypes={'a': np.int32})
+        self.assertTrue(flow.columnar)
+        self.assertEquals({'a': np.int32}, flow.meta_dtypes)
+        self.assertFalse(flow.reuse_buffers)
+        flow = factory(fs=fake_fs, batch_size=256, columnar=True,
+                       reuse_buffers=True)
+        self.assertTrue(flow.reuse_buffers)
+        with pytest.raises(ValueError, match='`reuse_buffers` requires '
+                                             '`columnar = True`'):
+            _ = factory(fs=fake_fs, batch_size=256, reuse_buffers=True)
+        with pytest.raises(ValueError, match='`columnar` and `decode_fn` '
+                                             'cannot be both specified'):
+            _ = factory(fs=fake_fs, batch_size=256, columnar=True,
+                        decode_fn=_decode_cont)
+        with pytest.raises(ValueError, match='The dtype of meta key \'c\' '
+                                             'is specified, but the key is '
+                                             'not included in `meta_keys`'):
+            _ = factory(fs=fake_fs, batch_size=256, meta_keys=['a', 'b'],
+                        meta_dtypes={'c': np.int32})
+
+        # test shard args
+        flow = factory(fs=fake_fs, batch_size=256)
+        self.assertIsNone(flow.num_shards)
+        self.assertIsNone(flow.shard_index)
+        flow = factory(fs=fake_fs, batch_size=256, num_shards=3,
+                       shard_index=2)
+        self.assertEquals((3, 2), (flow.num_shards, flow.shard_index))
+        with pytest.raises(ValueError, match='`num_shards` and `shard_index` '
+                                             'must be both specified, or '
+                                             'both not'):
+            _ = factory(fs=fake_fs, batch_size=256, num_shards=3)
+        with pytest.raises(ValueError, match='`num_shards` must be positive'):
+            _ = factory(fs=fake_fs, batch_size=256, num_shards=0,
+                        shard_index=0)
+        with pytest.raises(ValueError, match='`shard_index` must be in the '
+                                             'range'):
+            _ = factory(fs=fake_fs, batch_size=256, num_shards=3,
+                        shard_index=3)
+
+
+def _shards_of_flows(flows):
+    return [sorted(n for b in flow for n in b[0]) for flow in flows]
+
 
 class DataFSForwardFlowTestCase(unittest.TestCase, DataFlowCommonChecks):
 
@@ -155,6 +227,189 @@ class DataFSForwardFlowTestCase(unittest.TestCase, DataFlowCommonChecks):
                 )
 
 
+    def test_decode(self):
+        fs = _DummyDataFS()
+        for decode_workers in (None, 2):
+            with DataFSForwardFlow(fs, 4, meta_keys=['z'],
+                                   decode_fn=_decode_cont,
+                                   decode_workers=decode_workers) as flow:
+                batches = list(flow)
+                self.assertEquals(3, len(batches))
+                for i, batch in enumerate(batches):
+                    self.assertEquals(3, len(batch))
+                    indices = [i * 4 + j for j in range(4 if i < 2 else 2)]
+                    np.testing.assert_equal([str(k) for k in indices],
+                                            batch[0])
+                    self.assertEquals(np.int32, batch[1].dtype)
+                    np.testing.assert_equal([[k, k] for k in indices],
+                                            batch[1])
+                    np.testing.assert_equal([str(k) + ' z' for k in indices],
+                                            batch[2])
+            self.assertIsNone(flow._decode_pool)
+
+    def test_columnar(self):
+        fs = _DummyDataFS()
+        fs._files_data['3'] = b''
+        fs._files_data['4'] = b'4' * 100
+        expected = [fs._files_data[str(i)] for i in range(10)]
+
+        for columnar in (False, True):
+            flow = DataFSForwardFlow(fs, 4, meta_keys=['z', '1'],
+                                     columnar=columnar,
+                                     meta_dtypes={'z': 'U8', '1': np.float32})
+            batches = []
+            for batch in flow:
+                names = batch[0]
+                if columnar:
+                    self.assertEquals(5, len(batch))
+                    buffer, offsets = batch[1:3]
+                    self.assertEquals(np.uint8, buffer.dtype)
+                    self.assertEquals(np.int64, offsets.dtype)
+                    self.assertEquals(len(names) + 1, len(offsets))
+                    contents = [buffer[offsets[j]: offsets[j + 1]].tobytes()
+                                for j in range(len(names))]
+                else:
+                    self.assertEquals(4, len(batch))
+                    contents = list(batch[1])
+                z, m = batch[-2:]
+                self.assertEquals(np.dtype('U8'), z.dtype)
+                self.assertEquals(np.float32, m.dtype)
+                batches.append((list(names), contents, list(z), list(m)))
+
+            for i, (names, contents, z, m) in enumerate(batches):
+                indices = [i * 4 + j for j in range(4 if i < 2 else 2)]
+                self.assertEquals([str(k) for k in indices], names)
+                self.assertEquals([expected[k] for k in indices], contents)
+                self.assertEquals([str(k) + ' z' for k in indices], z)
+                np.testing.assert_equal(
+                    [1. if k == 1 else np.nan for k in indices], m)
+
+    def test_background(self):
+        fake_fs = Mock(spec=DataFS, init=Mock(), close=Mock())
+        flow = DataFSForwardFlow(fake_fs, 4)
+        self.assertFalse(flow.background)
+        self.assertIsNone(flow.prefetch)
+        flow = DataFSForwardFlow(fake_fs, 4, background=True)
+        self.assertTrue(flow.background)
+        self.assertEquals(2, flow.prefetch)
+        flow = DataFSForwardFlow(fake_fs, 4, background=True, prefetch=3)
+        self.assertEquals(3, flow.prefetch)
+        with pytest.raises(ValueError, match='`prefetch` must be positive'):
+            _ = DataFSForwardFlow(fake_fs, 4, background=True, prefetch=0)
+
+        fs = _DummyDataFS()
+        for skip_incomplete in (False, True):
+            expected = list(DataFSForwardFlow(
+                fs, 4, meta_keys=['z'], skip_incomplete=skip_incomplete))
+            with DataFSForwardFlow(fs, 4, meta_keys=['z'],
+                                   skip_incomplete=skip_incomplete,
+                                   background=True) as flow:
+                for _ in range(2):
+                    batches = list(flow)
+                    self.assertEquals(len(expected), len(batches))
+                    for a, b in zip(expected, batches):
+                        for x, y in zip(a, b):
+                            np.testing.assert_equal(x, y)
+                    self.assertIsNone(flow._background_iterator)
+
+        # test the error in the background thread
+        fs = _DummyDataFS()
+        fs._files_data['5'] = None
+        fs.get_data = Mock(side_effect=lambda n: fs._files_data[n] or
+                           _raise(IOError('cannot read {}'.format(n))))
+        flow = DataFSForwardFlow(fs, 4, background=True)
+        with pytest.raises(IOError, match='cannot read 5'):
+            _ = list(flow)
+
+        # test closing the flow during iteration
+        fs = _DummyDataFS()
+        flow = DataFSForwardFlow(fs, 2, background=True)
+        with flow:
+            it = iter(flow)
+            _ = next(it)
+            background_iterator = flow._background_iterator
+            self.assertIsNotNone(background_iterator)
+        self.assertIsNone(flow._background_iterator)
+        self.assertIsNone(background_iterator._thread)
+
+    def test_sharding(self):
+        fake_fs = Mock(spec=DataFS, init=Mock(), close=Mock())
+        self.assertEquals('position', DataFSForwardFlow(fake_fs, 4).shard_by)
+        with pytest.raises(ValueError, match='`shard_by` must be either '
+                                             '\'position\' or \'hash\''):
+            _ = DataFSForwardFlow(fake_fs, 4, num_shards=2, shard_index=0,
+                                  shard_by='name')
+
+        names = [str(i) for i in range(10)]
+        for shard_by in ('position', 'hash'):
+            for background in (False, True):
+                fs = _DummyDataFS()
+                fs.get_data = Mock(wraps=fs.get_data)
+                flows = [
+                    DataFSForwardFlow(fs, 2, meta_keys=['z'], num_shards=3,
+                                      shard_index=i, shard_by=shard_by,
+                                      background=background)
+                    for i in range(3)
+                ]
+                self.assertEquals(shard_by, flows[0].shard_by)
+                shards = _shards_of_flows(flows)
+                self.assertEquals(names, sorted(sum(shards, [])))
+                # only the files in the shard should be read
+                self.assertEquals(10, fs.get_data.call_count)
+                if shard_by == 'position':
+                    self.assertEquals(['0', '3', '6', '9'], shards[0])
+                for batch in flows[1]:
+                    np.testing.assert_equal(
+                        [_to_cont(int(n)) for n in batch[0]], batch[1])
+                    np.testing.assert_equal(
+                        [n + ' z' for n in batch[0]], batch[2])
+
+    def test_columnar_reuse_buffers(self):
+        from mlsnippet.datafs.dataflow import _BatchArrayGenerator
+        # new arrays should be allocated for each batch by default
+        g = _BatchArrayGenerator(3, False, ['a'], columnar=True,
+                                 meta_dtypes={'a': np.int64})
+        arrays = []
+        for d, a in [(b'12', 1), (b'3', 2)]:
+            g.add(None, d, (a,))
+            arrays.append(g.to_arrays())
+            g.clear_all()
+        for x, y in zip(*arrays):
+            self.assertFalse(np.shares_memory(x, y))
+        np.testing.assert_equal(list(b'12'), arrays[0][0])
+        np.testing.assert_equal([0, 2], arrays[0][1])
+        np.testing.assert_equal([1], arrays[0][2])
+
+        g = _BatchArrayGenerator(3, False, ['a'], columnar=True,
+                                 meta_dtypes={'a': np.int64},
+                                 reuse_buffers=True)
+        for d, a in [(b'12', 1), (b'345', 2), (b'6', 3)]:
+            g.add(None, d, (a,))
+        buffer, offsets, a = g.to_arrays()
+        np.testing.assert_equal(list(b'123456'), buffer)
+        np.testing.assert_equal([0, 2, 5, 6], offsets)
+        np.testing.assert_equal([1, 2, 3], a)
+        g.clear_all()
+
+        # smaller batch should reuse the buffers
+        g.add(None, b'78', (4,))
+        buffer2, offsets2, a2 = g.to_arrays()
+        np.testing.assert_equal(list(b'78'), buffer2)
+        np.testing.assert_equal([0, 2], offsets2)
+        np.testing.assert_equal([4], a2)
+        self.assertTrue(np.shares_memory(buffer, buffer2))
+        self.assertTrue(np.shares_memory(offsets, offsets2))
+        self.assertTrue(np.shares_memory(a, a2))
+        g.clear_all()
+
+        # larger content should grow the buffer
+        g.add(None, b'9' * 20, (5,))
+        buffer3, offsets3, _ = g.to_arrays()
+        np.testing.assert_equal([57] * 20, buffer3)
+        np.testing.assert_equal([0, 20], offsets3)
+        self.assertFalse(np.shares_memory(buffer, buffer3))
+
+
 class DataFSIndexedFlowTestCase(unittest.TestCase, DataFlowCommonChecks):
 
     def test_common_props_and_methods(self):
@@ -266,6 +521,194 @@ class DataFSIndexedFlowTestCase(unittest.TestCase, DataFlowCommonChecks):
         self.assertEquals(4, sum(meet.values()))
         self.assertEquals(0, sum([v > 1 for v in meet.values()]))
 
+    def test_resumable_iterator(self):
+        fs = _DummyDataFS()
+        names = list('0123456789')
+
+        def flatten(batches):
+            return [list(b[0]) for b in batches]
+
+        # test the seed
+        self.assertIsNone(DataFSIndexedFlow(fs, 3, names).seed)
+        flow = DataFSIndexedFlow(fs, 3, names, shuffle=True,
+                                 random_state=np.random.RandomState(1234))
+        self.assertEquals(
+            np.random.RandomState(1234).randint(0, 2 ** 31 - 1), flow.seed)
+
+        # the epochs are determined by the seed
+        flow = DataFSIndexedFlow(fs, 3, names, shuffle=True, seed=1234)
+        self.assertEquals({'seed': 1234, 'epoch': 0, 'step': 0},
+                          flow.get_state())
+        epochs = [flatten(flow) for _ in range(3)]
+        self.assertEquals((3, 0), (flow.epoch, flow.step))
+        self.assertNotEquals(epochs[0], epochs[1])
+        flow2 = DataFSIndexedFlow(fs, 3, names, shuffle=True, seed=1234)
+        self.assertEquals(epochs, [flatten(flow2) for _ in range(3)])
+
+        # interrupt an epoch, and resume it in another flow
+        flow = DataFSIndexedFlow(fs, 3, names, shuffle=True, seed=1234,
+                                 num_workers=2)
+        _ = flatten(flow)
+        it = iter(flow)
+        self.assertEquals(epochs[1][:2], [list(next(it)[0]) for _ in range(2)])
+        state = flow.get_state()
+        self.assertEquals({'seed': 1234, 'epoch': 1, 'step': 2}, state)
+        it.close()
+
+        fs.get_data = Mock(wraps=fs.get_data)
+        flow2 = DataFSIndexedFlow(fs, 3, names, shuffle=True)
+        flow2.set_state(state)
+        self.assertEquals(epochs[1][2:], flatten(flow2))
+        self.assertEquals(4, fs.get_data.call_count)
+        self.assertEquals(epochs[2], flatten(flow2))
+
+        # an interrupted epoch without restoring the state is not resumed
+        flow = DataFSIndexedFlow(fs, 3, names)
+        it = iter(flow)
+        _ = next(it)
+        it.close()
+        self.assertEquals({'seed': None, 'epoch': 0, 'step': 1},
+                          flow.get_state())
+        self.assertEquals([names[:3], names[3:6], names[6:9], names[9:]],
+                          flatten(flow))
+        self.assertEquals((2, 0), (flow.epoch, flow.step))
+
+        # test the errors
+        with pytest.raises(ValueError, match='`epoch` and `step` must '
+                                             'not be negative'):
+            flow.set_state({'seed': None, 'epoch': 0, 'step': -1})
+        flow = DataFSIndexedFlow(fs, 3, names, shuffle=True)
+        with pytest.raises(ValueError, match='`seed` is required by a '
+                                             'shuffled flow'):
+            flow.set_state({'seed': None, 'epoch': 0, 'step': 0})
+
+    def test_block_shuffle_iterator(self):
+        fs = _DummyDataFS()
+        names = list('0123456789')
+
+        def flatten(batches):
+            return sum((list(b[0]) for b in batches), [])
+
+        with pytest.raises(ValueError, match='`shuffle_block_size` and '
+                                             '`shuffle_buffer_size` require '
+                                             '`shuffle = True`'):
+            _ = DataFSIndexedFlow(fs, 3, names, shuffle_block_size=2)
+        with pytest.raises(ValueError,
+                           match='`shuffle_block_size` must be positive'):
+            _ = DataFSIndexedFlow(fs, 3, names, shuffle=True,
+                                  shuffle_block_size=0)
+        with pytest.raises(ValueError,
+                           match='`shuffle_buffer_size` must be positive'):
+            _ = DataFSIndexedFlow(fs, 3, names, shuffle=True,
+                                  shuffle_buffer_size=0)
+
+        flow = DataFSIndexedFlow(fs, 3, names)
+        self.assertIsNone(flow.shuffle_block_size)
+        self.assertIsNone(flow.shuffle_buffer_size)
+
+        # shuffle the blocks only
+        flow = DataFSIndexedFlow(fs, 3, names, shuffle=True, seed=1,
+                                 shuffle_block_size=4)
+        self.assertEquals(4, flow.shuffle_block_size)
+        orders = [flatten(flow) for _ in range(5)]
+        blocks = [names[:4], names[4:8], names[8:]]
+        for order in orders:
+            self.assertEquals(sorted(names), sorted(order))
+            chunks = []
+            while order:
+                size = 2 if order[0] == '8' else 4
+                chunks.append(order[:size])
+                order = order[size:]
+            self.assertEquals(sorted(blocks), sorted(chunks))
+        self.assertGreater(len(set(tuple(o) for o in orders)), 1)
+
+        # shuffle the blocks, then shuffle within windows
+        for num_workers in (None, 2):
+            fs = _DummyDataFS()
+            fs.get_data = Mock(wraps=fs.get_data)
+            flow = DataFSIndexedFlow(fs, 3, names, shuffle=True, seed=1,
+                                     shuffle_block_size=2,
+                                     shuffle_buffer_size=4,
+                                     num_workers=num_workers)
+            self.assertEquals(4, flow.shuffle_buffer_size)
+            with flow:
+                batches = list(flow)
+            order = flatten(batches)
+            self.assertEquals(sorted(names), sorted(order))
+            self.assertEquals([3, 3, 3, 1], [len(b[0]) for b in batches])
+            for b in batches:
+                np.testing.assert_equal([_to_cont(n) for n in b[0]], b[1])
+            windows = [order[:4], order[4:8], order[8:]]
+            for w in windows:
+                # each window consists of two shuffled blocks
+                pairs = sorted(w)
+                self.assertEquals(
+                    [int(pairs[i]) // 2 for i in range(0, len(pairs), 2)],
+                    [int(pairs[i]) // 2 for i in range(1, len(pairs), 2)]
+                )
+            if num_workers is None:
+                # the files of each window are read in sorted order
+                self.assertEquals(
+                    sum((sorted(w) for w in windows), []),
+                    [c[0][0] for c in fs.get_data.call_args_list]
+                )
+
+        # resume the buffered iterator
+        flow = DataFSIndexedFlow(fs, 3, names, shuffle=True, seed=1,
+                                 shuffle_block_size=2, shuffle_buffer_size=4)
+        expected = flatten(flow)
+        flow.set_state({'seed': 1, 'epoch': 0, 'step': 2})
+        fs.get_data = Mock(wraps=_DummyDataFS().get_data)
+        self.assertEquals(expected[6:], flatten(flow))
+        self.assertEquals(4, fs.get_data.call_count)
+
+    def test_sharding(self):
+        fs = _DummyDataFS()
+        names = list('0123456789')
+        for shard_by in ('position', 'hash'):
+            flows = [DataFSIndexedFlow(fs, 3, names, shuffle=True,
+                                       num_shards=4, shard_index=i,
+                                       shard_by=shard_by)
+                     for i in range(4)]
+            shards = _shards_of_flows(flows)
+            self.assertEquals(names, sorted(sum(shards, [])))
+            for flow, shard in zip(flows, shards):
+                self.assertEquals(shard, sorted(flow.names))
+            if shard_by == 'position':
+                self.assertEquals([['0', '4', '8'], ['1', '5', '9'],
+                                   ['2', '6'], ['3', '7']], shards)
+
+    def test_worker_pool_iterator(self):
+        fs = _DummyDataFS()
+        names = list('0345789')
+        meta_keys = ['z', '3']
+
+        with pytest.raises(ValueError, match='`prefetch` must be positive'):
+            _ = DataFSIndexedFlow(fs, 2, names, num_workers=2, prefetch=0)
+
+        flow = DataFSIndexedFlow(fs, 2, names)
+        self.assertIsNone(flow.num_workers)
+        self.assertIsNone(flow.prefetch)
+        expected = list(flow)
+
+        for prefetch in (None, 1, 5):
+            flow = DataFSIndexedFlow(fs, 2, names, meta_keys=meta_keys,
+                                     num_workers=3, prefetch=prefetch)
+            self.assertEquals(3, flow.num_workers)
+            self.assertEquals(prefetch or 3, flow.prefetch)
+            with flow:
+                for repeated in range(2):
+                    batches = list(flow)
+                    self.assertEquals(4, len(batches))
+                    for b, e in zip(batches, expected):
+                        np.testing.assert_equal(e[0], b[0])
+                        np.testing.assert_equal(e[1], b[1])
+                        np.testing.assert_equal(
+                            [n + ' z' for n in e[0]], b[2])
+                        np.testing.assert_equal(
+                            [1 if n == '3' else None for n in e[0]], b[3])
+            self.assertFalse(flow._worker_pool._initialized)
+
 
 class DataFSRandomFlowTestCase(unittest.TestCase, DataFlowCommonChecks):
 
@@ -283,6 +726,52 @@ class DataFSRandomFlowTestCase(unittest.TestCase, DataFlowCommonChecks):
         with pytest.raises(ValueError, match='`batch_count` must be positive'):
             _ = DataFSRandomFlow(fake_fs, 256, batch_count=-1)
 
+    def test_sharding(self):
+        from mlsnippet.datafs.dataflow import _name_shard
+        fs = _DummyDataFS()
+        fs.get_data = Mock(wraps=fs.get_data)
+        flow = DataFSRandomFlow(fs, 3, meta_keys=['z'], batch_count=20,
+                                num_shards=3, shard_index=1)
+        self.assertEquals('hash', flow.shard_by)
+        batches = list(flow)
+        self.assertEquals(20, len(batches))
+        for batch in batches:
+            self.assertEquals(3, len(batch[0]))
+            for n in batch[0]:
+                self.assertEquals(1, _name_shard(n, 3))
+            np.testing.assert_equal([n + ' z' for n in batch[0]], batch[2])
+        self.assertEquals(60, fs.get_data.call_count)
+
+        # the shard has fewer files than the batch size
+        fs = _DummyDataFS()
+        shard = [n for n in fs._names if _name_shard(n, 3) == 1]
+        fs.sample_names = lambda n_samples: \
+            fs._names[:min(n_samples, len(fs._names))]
+        flow = DataFSRandomFlow(fs, 20, batch_count=2, num_shards=3,
+                                shard_index=1)
+        for batch in flow:
+            self.assertEquals(shard, list(batch[0]))
+
+        # the names sampled in different rounds should not be duplicated
+        fs = _DummyDataFS()
+        fs.sample_names = Mock(wraps=fs.sample_names)
+        flow = DataFSRandomFlow(fs, 3, batch_count=10, num_shards=3,
+                                shard_index=0)
+        for batch in flow:
+            self.assertLessEqual(len(batch[0]), 2)
+            self.assertEquals(len(batch[0]), len(set(batch[0])))
+            self.assertTrue(set(batch[0]).issubset(['7', '9']))
+        self.assertLessEqual(fs.sample_names.call_count, 160)
+
+        # the shard is empty
+        fs = _DummyDataFS()
+        fs._names = [str(i) for i in range(40) if _name_shard(str(i), 8) != 3]
+        flow = DataFSRandomFlow(fs, 4, batch_count=2, num_shards=8,
+                                shard_index=3)
+        with pytest.raises(ValueError, match='No file can be sampled from '
+                                             'the shard 3 of 8 shards'):
+            _ = list(flow)
+
     def test_iterator(self):
         fs = _DummyDataFS()
         names = '0123456789'
@@ -1,11 +1,14 @@
 import os
+import time
 import unittest
 from contextlib import contextmanager
 
 import pytest
 import six
+import mock
 
-from mlsnippet.utils import TemporaryDirectory, makedirs, iter_files
+from mlsnippet.utils import (TemporaryDirectory, makedirs, iter_files,
+                              scan_dir)
 from mlsnippet.datafs import *
 from .standard_checks import StandardFSChecks
 
@@ -35,7 +38,245 @@ class LocalFSTestCase(unittest.TestCase, StandardFSChecks):
                 yield fs
 
     def test_standard(self):
-        self.run_standard_checks(DataFSCapacity.READ_WRITE_DATA)
+        self.run_standard_checks(
+            DataFSCapacity.READ_WRITE_DATA | DataFSCapacity.QUICK_COUNT |
+            DataFSCapacity.RANDOM_SAMPLE
+        )
+
+    def test_names_cache(self):
+        snapshot = {'a/1.txt': (b'a/1.txt content',), 'b': (b'b content',)}
+
+        # the names should be collected at each call if not cached
+        with self.temporary_fs(snapshot, cache_names=False) as fs:
+            self.assertFalse(fs.cache_names)
+            self.assertFalse(fs.clone().cache_names)
+            self.assertEquals(
+                DataFSCapacity(DataFSCapacity.READ_WRITE_DATA), fs.capacity)
+            self.assertTrue(LocalFS(fs.root_dir, cache_names=False,
+                                    manifest_file=os.path.join(
+                                        fs.root_dir, 'manifest.json'))
+                            .capacity.can_random_sample())
+            self.assertEquals(2, fs.count())
+            self.assertIsNone(fs._names)
+            with open(os.path.join(fs.root_dir, 'c'), 'wb') as f:
+                f.write(b'c content')
+            self.assertEquals(3, fs.count())
+            self.assertEquals(['a/1.txt', 'b', 'c'], sorted(fs.list_names()))
+            with pytest.raises(UnsupportedOperation):
+                _ = fs.sample_names(1)
+
+        with self.temporary_fs(snapshot) as fs:
+            self.assertTrue(fs.cache_names)
+            self.assertTrue(fs.clone().cache_names)
+            self.assertIsNone(fs._names)
+            self.assertEquals(['a/1.txt', 'b'], sorted(fs.iter_names()))
+            self.assertIsNone(fs._names)
+            self.assertEquals(2, fs.count())
+            self.assertIsNotNone(fs._names)
+
+            # the cached names should be used
+            with open(os.path.join(fs.root_dir, 'c'), 'wb') as f:
+                f.write(b'c content')
+            self.assertEquals(2, fs.count())
+            self.assertEquals(['a/1.txt', 'b'], sorted(fs.iter_names()))
+            self.assertEquals(['a/1.txt', 'b'], sorted(fs.sample_names(3)))
+
+            # writing through the fs should invalidate the cache
+            fs.put_data('d', b'd content')
+            self.assertIsNone(fs._names)
+            self.assertEquals(['a/1.txt', 'b', 'c', 'd'],
+                              sorted(fs.list_names()))
+            self.assertEquals(4, fs.count())
+
+            # refreshing the names should invalidate the cache
+            with open(os.path.join(fs.root_dir, 'e'), 'wb') as f:
+                f.write(b'e content')
+            self.assertEquals(4, fs.count())
+            fs.refresh_names()
+            self.assertIsNone(fs._names)
+            self.assertEquals(5, fs.count())
+
+            # closing the fs should also invalidate the cache
+            fs.close()
+            self.assertIsNone(fs._names)
+
+    def test_manifest(self):
+        t = time.time() - 100
+
+        def set_old_mtime(root_dir):
+            for path in [root_dir, os.path.join(root_dir, 'a'),
+                         os.path.join(root_dir, 'a/b'),
+                         os.path.join(root_dir, 'c')]:
+                if os.path.isdir(path):
+                    os.utime(path, (t, t))
+
+        def list_names(fs):
+            with mock.patch('mlsnippet.datafs.localfs.scan_dir',
+                            wraps=scan_dir) as m:
+                fs = fs.clone()
+                try:
+                    names = fs.list_names()
+                finally:
+                    fs.close()
+            return names, sorted(c[0][0] for c in m.call_args_list)
+
+        snapshot = {'a/1.txt': (b'a/1.txt content',),
+                    'a/b/2.txt': (b'a/b/2.txt content',),
+                    'c/3.txt': (b'c/3.txt content',),
+                    'd': (b'd content',)}
+        with self.temporary_fs(snapshot) as fs, \
+                TemporaryDirectory() as tempdir:
+            root = fs.root_dir
+            manifest_file = os.path.join(tempdir, 'cache/manifest.json')
+            fs = LocalFS(root, manifest_file=manifest_file)
+            self.assertEquals(manifest_file, fs.manifest_file)
+            self.assertEquals(manifest_file, fs.clone().manifest_file)
+            self.assertIsNone(LocalFS(root).manifest_file)
+            set_old_mtime(root)
+
+            # the first listing should scan all directories
+            names, scanned = list_names(fs)
+            self.assertEquals(['a/1.txt', 'a/b/2.txt', 'c/3.txt', 'd'],
+                              sorted(names))
+            self.assertEquals(4, len(scanned))
+            self.assertTrue(os.path.isfile(manifest_file))
+
+            # the second listing should not scan any directory
+            names, scanned = list_names(fs)
+            self.assertEquals(['a/1.txt', 'a/b/2.txt', 'c/3.txt', 'd'],
+                              sorted(names))
+            self.assertEquals([], scanned)
+
+            # only the modified directory should be scanned
+            with open(os.path.join(root, 'a/b/4.txt'), 'wb') as f:
+                f.write(b'a/b/4.txt content')
+            names, scanned = list_names(fs)
+            self.assertEquals(
+                ['a/1.txt', 'a/b/2.txt', 'a/b/4.txt', 'c/3.txt', 'd'],
+                sorted(names)
+            )
+            self.assertEquals([os.path.join(root, 'a', 'b')], scanned)
+
+            # recently modified directories should be scanned again
+            names, scanned = list_names(fs)
+            self.assertEquals([os.path.join(root, 'a', 'b')], scanned)
+            set_old_mtime(root)
+            list_names(fs)
+            names, scanned = list_names(fs)
+            self.assertEquals([], scanned)
+
+            # removed directories should be dropped
+            os.remove(os.path.join(root, 'c/3.txt'))
+            os.rmdir(os.path.join(root, 'c'))
+            os.utime(root, (t + 1, t + 1))
+            names, scanned = list_names(fs)
+            self.assertEquals(['a/1.txt', 'a/b/2.txt', 'a/b/4.txt', 'd'],
+                              sorted(names))
+            self.assertEquals([root], scanned)
+            self.assertEquals(
+                ['a/1.txt', 'a/b/2.txt', 'a/b/4.txt', 'd'],
+                sorted(LocalFS(root, manifest_file=manifest_file).iter_names())
+            )
+
+            # corrupted manifest should be ignored
+            with open(manifest_file, 'wb') as f:
+                f.write(b'not a json')
+            names, scanned = list_names(fs)
+            self.assertEquals(['a/1.txt', 'a/b/2.txt', 'a/b/4.txt', 'd'],
+                              sorted(names))
+            self.assertEquals(3, len(scanned))
+
+    def test_manifest_in_root_dir(self):
+        snapshot = {'a/1.txt': (b'a/1.txt content',), 'b': (b'b content',)}
+        with self.temporary_fs(snapshot) as fs:
+            manifest_file = os.path.join(fs.root_dir, '.manifest')
+            fs = LocalFS(fs.root_dir, manifest_file=manifest_file)
+            self.assertEquals(['a/1.txt', 'b'], sorted(fs.list_names()))
+            self.assertTrue(os.path.isfile(manifest_file))
+            fs.close()
+            self.assertEquals(['a/1.txt', 'b'], sorted(fs.list_names()))
+
+            # the directory of the manifest should be scanned every time
+            with open(os.path.join(fs.root_dir, 'c'), 'wb') as f:
+                f.write(b'c content')
+            fs.close()
+            self.assertEquals(['a/1.txt', 'b', 'c'], sorted(fs.list_names()))
+
+    def test_copy_to(self):
+        content = b'0123456789' * 10000
+        with self.temporary_fs({'a': (content,)}) as fs, \
+                TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'out')
+            with open(path, 'wb') as f:
+                f.write(b'head')
+                fs.copy_to('a', f)
+                f.write(b'tail')
+            with open(path, 'rb') as f:
+                self.assertEquals(b'head' + content + b'tail', f.read())
+
+            # test the fallback when sendfile is not applicable
+            with mock.patch('os.sendfile', side_effect=OSError(),
+                            create=True), open(path, 'wb') as f:
+                fs.copy_to('a', f)
+            with open(path, 'rb') as f:
+                self.assertEquals(content, f.read())
+
+    def test_copy_to_interleaved_with_writes(self):
+        with self.temporary_fs({'x': (b'x',)}) as fs, \
+                TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'out')
+            with open(path, 'wb') as f:
+                f.write(b'A')
+                fs.copy_to('x', f)
+                self.assertEquals(2, f.tell())
+                f.write(b'B')
+                self.assertEquals(3, f.tell())
+                fs.copy_to('x', f)
+                fs.copy_to('x', f)
+                f.write(b'C')
+            with open(path, 'rb') as f:
+                self.assertEquals(b'AxBxxC', f.read())
+
+            # the content should be copied to the position of `file_obj`
+            with open(path, 'wb') as f:
+                f.write(b'AAAA')
+            with open(path, 'r+b') as f:
+                f.seek(1)
+                fs.copy_to('x', f)
+                self.assertEquals(2, f.tell())
+                f.write(b'B')
+                self.assertEquals(3, f.tell())
+            with open(path, 'rb') as f:
+                self.assertEquals(b'AxBA', f.read())
+
+            # also after the buffered file object has read ahead
+            with open(path, 'r+b') as f:
+                self.assertEquals(b'A', f.read(1))
+                fs.copy_to('x', f)
+                self.assertEquals(2, f.tell())
+                self.assertEquals(b'BA', f.read())
+            with open(path, 'rb') as f:
+                self.assertEquals(b'AxBA', f.read())
+
+    def test_io_workers(self):
+        with TemporaryDirectory() as tempdir:
+            self.assertIsNone(LocalFS(tempdir).io_workers)
+            self.assertEquals(8, LocalFS(tempdir, io_workers=8).io_workers)
+            self.assertEquals(
+                8, LocalFS(tempdir, io_workers=8).clone().io_workers)
+            self.assertIsNone(LocalFS(tempdir, io_workers=1).io_workers)
+            self.assertIsNone(LocalFS(tempdir, io_workers=None).io_workers)
+
+            names = ['{}.txt'.format(i) for i in range(10)]
+            for name in names:
+                with open(os.path.join(tempdir, name), 'wb') as f:
+                    f.write(name.encode('utf-8'))
+            for io_workers in (None, 3):
+                with LocalFS(tempdir, io_workers=io_workers) as fs:
+                    self.assertListEqual(
+                        [n.encode('utf-8') for n in names] + [None],
+                        fs.batch_retrieve(names + ['invalid'])
+                    )
 
     def test_errors(self):
         with pytest.raises(IOError, match='Not a directory'):
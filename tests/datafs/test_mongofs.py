@@ -1,8 +1,12 @@
 import gc
+import re
+import time
 import unittest
 from contextlib import contextmanager
 from io import BytesIO
 
+import mock
+import pytest
 import six
 from gridfs import GridFS, GridFSBucket
 from pymongo import MongoClient
@@ -27,8 +31,11 @@ class MongoFSTestCase(unittest.TestCase, StandardFSChecks):
 
             for r in files_coll.find({}):
                 name = r['filename']
-                with maybe_close(gridfs.get(r['_id'])) as f:
-                    cnt = f.read()
+                if 'inlineData' in r:
+                    cnt = bytes(r['inlineData'])
+                else:
+                    with maybe_close(gridfs.get(r['_id'])) as f:
+                        cnt = f.read()
                 if 'metadata' in r:
                     ret[name] = (cnt, r['metadata'])
                 else:
@@ -76,6 +83,241 @@ class MongoFSTestCase(unittest.TestCase, StandardFSChecks):
             self.assertIsInstance(fs.clone().collection, Collection)
             gc.collect()  # cleanup cloned objects
 
+    def test_query(self):
+        snapshot = {
+            'a/1.txt': (b'a1', {'k': 1, 'z': 'x'}),
+            'a/2.txt': (b'a2', {'k': 2}),
+            'A/3.txt': (b'A3', {'k': 1}),
+            'b/4.txt': (b'b4',),
+        }
+        with self.temporary_fs(snapshot) as fs:
+            self.assertEquals(['a/1.txt', 'a/2.txt'],
+                              sorted(fs.query_names('a/')))
+            self.assertEquals(['A/3.txt', 'a/1.txt', 'a/2.txt'],
+                              sorted(fs.query_names(re.compile('a', re.I))))
+            self.assertEquals([], list(fs.query_names('1')))
+            self.assertEquals(['A/3.txt', 'a/1.txt'],
+                              sorted(fs.query_names(meta_filter={'k': 1})))
+            self.assertEquals(['a/2.txt', 'b/4.txt'], sorted(fs.query_names(
+                meta_filter={'z': None, 'k': {'$ne': 1}})))
+            self.assertEquals(['a/1.txt'], list(fs.query_names(
+                'a/', meta_filter={'k': 1},
+                hint=[('filename', 1), ('uploadDate', 1)]
+            )))
+            self.assertEquals(
+                [('A/3.txt', b'A3', 1, None), ('a/1.txt', b'a1', 1, 'x')],
+                sorted(fs.query_files(['k', 'z'], meta_filter={'k': 1}))
+            )
+            self.assertEquals(
+                [('A/3.txt', b'A3')],
+                list(fs.query_files(names_pattern='[A-Z]'))
+            )
+
+    def test_inline_data(self):
+        with self.temporary_fs({'old.txt': (b'old',)},
+                               inline_threshold=8) as fs:
+            self.assertEquals(8, fs.inline_threshold)
+            self.assertEquals(8, fs.clone().inline_threshold)
+            fs.put_data('small.txt', b'small')
+            fs.put_data('large.txt', b'large content')
+            fs.put_data('old.txt', b'new')
+            fs.put_meta('small.txt', {'a': 1})
+
+            files = fs.collection.files
+            self.assertEquals(b'small', bytes(
+                files.find_one({'filename': 'small.txt'})['inlineData']))
+            self.assertNotIn('inlineData',
+                             files.find_one({'filename': 'large.txt'}))
+            self.assertEquals(3, len(list(files.find({}))))
+            self.assertEquals(1, len(list(fs.collection.chunks.find({}))))
+
+            # read the inline contents by all the methods
+            self.assertEquals(b'small', fs.get_data('small.txt'))
+            self.assertEquals((b'small', 1), fs.retrieve('small.txt', ['a']))
+            self.assertEquals(
+                [b'small', None, b'large content', b'new'],
+                fs.batch_retrieve(['small.txt', 'none', 'large.txt',
+                                   'old.txt'])
+            )
+            self.assertEquals(
+                [('large.txt', b'large content', None),
+                 ('old.txt', b'new', None), ('small.txt', b'small', 1)],
+                sorted(fs.iter_files(['a']))
+            )
+            self.assertEquals(
+                [('large.txt', b'large content'), ('old.txt', b'new'),
+                 ('small.txt', b'small')],
+                sorted(fs.sample_files(3))
+            )
+            with fs.open('small.txt', 'r') as f:
+                self.assertEquals(b'small', f.read())
+            self.assertEquals([b'small'], list(fs.iter_chunks('small.txt')))
+            self.assertEquals([b'sm', b'al', b'l'],
+                              list(fs.iter_chunks('small.txt', 2)))
+
+        with pytest.raises(ValueError, match='`inline_threshold` must not '
+                                             'be negative'):
+            _ = MongoFS('mongodb://localhost', 'admin', 'test',
+                        inline_threshold=-1)
+
+    def test_iter_files_in_batches(self):
+        snapshot = {'{}.txt'.format(i): (str(i).encode('utf-8'), {'a': i})
+                    for i in range(5)}
+        # a file of multiple chunks
+        snapshot['big.bin'] = (b'x' * 600000, {'a': -1})
+        with self.temporary_fs(snapshot) as fs, \
+                mock.patch('mlsnippet.datafs.mongofs.ITER_BATCH_SIZE', 2):
+            fs._read_blobs = mock.Mock(wraps=fs._read_blobs)
+            expected = sorted((n, v[0], v[1]['a'])
+                              for n, v in six.iteritems(snapshot))
+            self.assertEquals(expected, sorted(fs.iter_files(['a'])))
+            self.assertEquals(3, fs._read_blobs.call_count)
+
+            # the batch should also be bounded by the total bytes
+            fs._read_blobs.reset_mock()
+            with mock.patch('mlsnippet.datafs.mongofs.ITER_BATCH_BYTES', 1):
+                self.assertEquals(expected, sorted(fs.iter_files(['a'])))
+            self.assertEquals(6, fs._read_blobs.call_count)
+
+    def test_batch_put_data(self):
+        with self.temporary_fs({'0.txt': (b'old', {'a': 1})},
+                               inline_threshold=4) as fs, \
+                mock.patch('mlsnippet.datafs.mongofs.BULK_WRITE_SIZE', 2):
+            fs.collection.files.insert_many = mock.Mock(
+                wraps=fs.collection.files.insert_many)
+            big = b'x' * 600000
+            fs.batch_put_data([('0.txt', b'0'), ('1.txt', b'1'),
+                               ('2.txt', big), ('3.txt', b'three')])
+            self.assertEquals(2, fs.collection.files.insert_many.call_count)
+            self.assertEquals(
+                {'0.txt': (b'0',), '1.txt': (b'1',), '2.txt': (big,),
+                 '3.txt': (b'three',)},
+                self.get_snapshot(fs)
+            )
+
+            # check the inline files, and the chunks of the other files
+            self.assertEquals(
+                ['0.txt', '1.txt'],
+                sorted(r['filename'] for r in fs.collection.files.find(
+                    {'inlineData': {'$exists': True}}))
+            )
+            self.assertEquals(4, len(list(fs.collection.chunks.find({}))))
+            self.assertEquals(big, fs.get_data('2.txt'))
+            self.assertEquals([big], [f[1] for f in fs.query_files(
+                names_pattern='2')])
+
+    def test_batch_put_data_buffer(self):
+        with self.temporary_fs() as fs, \
+                mock.patch('mlsnippet.datafs.mongofs.BULK_WRITE_BYTES', 10):
+            files = fs.collection.files
+            files.insert_many = mock.Mock(wraps=files.insert_many)
+            files.create_index = mock.Mock(wraps=files.create_index)
+
+            # the replaced content should not be counted into the buffer
+            fs.batch_put_data([('a', b'x' * 6), ('a', b'y' * 6),
+                               ('b', b'z' * 2)])
+            self.assertEquals(1, files.insert_many.call_count)
+            self.assertEquals({'a': (b'y' * 6,), 'b': (b'z' * 2,)},
+                              self.get_snapshot(fs))
+
+            # the indexes should be created only once
+            fs.batch_put_data([('c', b'c')])
+            self.assertEquals(1, files.create_index.call_count)
+
+            # and created again after the fs is re-opened
+            fs.close()
+            files = fs.collection.files
+            files.create_index = mock.Mock(wraps=files.create_index)
+            fs.batch_put_data([('d', b'd')])
+            self.assertEquals(1, files.create_index.call_count)
+
+    def test_count(self):
+        snapshot = {'{}.txt'.format(i): (b'',) for i in range(3)}
+        with self.temporary_fs(snapshot, count_ttl=10) as fs, \
+                mock.patch('time.time', return_value=100.):
+            files = fs.collection.files
+            files.estimated_document_count = mock.Mock(
+                wraps=files.estimated_document_count)
+            self.assertEquals(10., fs.count_ttl)
+            self.assertEquals(3, fs.count())
+            self.assertEquals(3, fs.count(exact=True))
+
+            # the count should be cached, and shared with the clones
+            fs2 = fs.clone()
+            files.insert_one({'filename': 'other.txt', 'length': 0})
+            self.assertEquals(3, fs.count())
+            self.assertEquals(3, fs2.count())
+            self.assertEquals(4, fs2.count(exact=True))
+            self.assertEquals(1, files.estimated_document_count.call_count)
+
+            # the cache should expire
+            time.time.return_value = 110.
+            self.assertEquals(4, fs.count())
+            self.assertEquals(2, files.estimated_document_count.call_count)
+
+            # the cache should be cleared by writing
+            fs2.put_data('4.txt', b'')
+            self.assertEquals(5, fs.count())
+            self.assertEquals(3, files.estimated_document_count.call_count)
+
+            # a count racing with a write should not be cached
+            def count_racing_with_write():
+                ret = files.count_documents({})
+                fs2.put_data('5.txt', b'')
+                return ret
+
+            time.time.return_value = 120.
+            files.estimated_document_count.side_effect = \
+                count_racing_with_write
+            self.assertEquals(5, fs.count())
+            files.estimated_document_count.side_effect = None
+            self.assertEquals(6, fs.count())
+            self.assertEquals(5, files.estimated_document_count.call_count)
+            self.assertEquals(6, fs.count())
+            self.assertEquals(5, files.estimated_document_count.call_count)
+
+        with pytest.raises(ValueError, match='`count_ttl` must not be '
+                                             'negative'):
+            _ = MongoFS('mongodb://localhost', 'admin', 'test', count_ttl=-1)
+
+    def test_batch_put_meta(self):
+        names = ['{}.txt'.format(i) for i in range(5)]
+        snapshot = {n: (n.encode('utf-8'), {'a': 1}) for n in names}
+        with self.temporary_fs(snapshot) as fs, \
+                mock.patch('mlsnippet.datafs.mongofs.BULK_WRITE_SIZE', 2):
+            items = [(n, {'b': i}) for i, n in enumerate(names)]
+            items.insert(3, ('none', {'b': -1}))
+            with pytest.raises(DataFileNotExist, match='none'):
+                fs.batch_put_meta(items)
+            self.assertDictEqual(
+                {n: (n.encode('utf-8'), {'a': 1, 'b': i})
+                 for i, n in enumerate(names)},
+                self.get_snapshot(fs)
+            )
+
+            # the missing file with empty meta dict should also be reported
+            with pytest.raises(DataFileNotExist, match='none'):
+                fs.batch_put_meta([('0.txt', {}), ('none', {})])
+
+    def test_put_meta_to_null_metadata(self):
+        names = ['{}.txt'.format(i) for i in range(3)]
+        with self.temporary_fs({n: (b'',) for n in names}) as fs, \
+                mock.patch('mlsnippet.datafs.mongofs.BULK_WRITE_SIZE', 2):
+            # files uploaded by other GridFS clients might have null metadata
+            fs.collection.files.update_many({}, {'$set': {'metadata': None}})
+            fs.put_meta('0.txt', {'a': 0})
+            fs.put_meta('0.txt', b=0)
+            fs.collection.files.update_one(
+                {'filename': '1.txt'}, {'$set': {'metadata': 'not a dict'}})
+            fs.batch_put_meta([('1.txt', {'a': 1}), ('2.txt', {'a': 2})])
+            self.assertDictEqual(
+                {'0.txt': (b'', {'a': 0, 'b': 0}), '1.txt': (b'', {'a': 1}),
+                 '2.txt': (b'', {'a': 2})},
+                self.get_snapshot(fs)
+            )
+            with pytest.raises(DataFileNotExist, match='none'):
+                fs.put_meta('none', {'a': 1})
+
 
 if __name__ == '__main__':
     unittest.main()
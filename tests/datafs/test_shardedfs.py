@@ -0,0 +1,245 @@
+import os
+import tarfile
+import unittest
+from contextlib import contextmanager
+
+import pytest
+import six
+from mock import Mock
+
+from mlsnippet.datafs import *
+from mlsnippet.utils import TemporaryDirectory, makedirs, iter_files
+from .standard_checks import StandardFSChecks
+from .test_dataflow import _DummyDataFS
+
+
+class ShardedDataFSTestCase(unittest.TestCase, StandardFSChecks):
+
+    def get_snapshot(self, fs):
+        ret = {}
+        for shard in fs.shards:
+            for name in iter_files(shard.root_dir):
+                with open(os.path.join(shard.root_dir, name), 'rb') as f:
+                    cnt = f.read()
+                ret[name] = (cnt,)
+        return ret
+
+    @contextmanager
+    def temporary_fs(self, snapshot=None, **kwargs):
+        with TemporaryDirectory() as tempdir:
+            shard_dirs = [os.path.join(tempdir, str(i)) for i in range(3)]
+            for shard_dir in shard_dirs:
+                makedirs(shard_dir)
+            if snapshot:
+                for i, filename in enumerate(sorted(snapshot)):
+                    content = snapshot[filename][0]
+                    file_path = os.path.join(shard_dirs[i % 3], filename)
+                    file_dir = os.path.split(file_path)[0]
+                    makedirs(file_dir, exist_ok=True)
+                    with open(file_path, 'wb') as f:
+                        f.write(content)
+            shards = [LocalFS(d, **kwargs) for d in shard_dirs]
+            with ShardedDataFS(shards, num_parallel=2, **kwargs) as fs:
+                yield fs
+
+    def test_standard(self):
+        self.run_standard_checks(
+            DataFSCapacity.READ_DATA | DataFSCapacity.QUICK_COUNT |
+            DataFSCapacity.RANDOM_SAMPLE
+        )
+
+    def test_props_and_errors(self):
+        shards = [_DummyDataFS(), _DummyDataFS()]
+        fs = ShardedDataFS(shards, num_parallel=3, prefetch=5)
+        self.assertEquals(shards, fs.shards)
+        self.assertEquals(3, fs.num_parallel)
+        self.assertEquals(5, fs.prefetch)
+        self.assertEquals(
+            DataFSCapacity(DataFSCapacity.READ_DATA |
+                           DataFSCapacity.READ_META |
+                           DataFSCapacity.RANDOM_SAMPLE),
+            fs.capacity
+        )
+
+        with pytest.raises(ValueError, match='`shards` must not be empty'):
+            _ = ShardedDataFS([])
+        with pytest.raises(ValueError, match='`num_parallel` must be positive'):
+            _ = ShardedDataFS(shards, num_parallel=0)
+        with pytest.raises(ValueError, match='`prefetch` must be positive'):
+            _ = ShardedDataFS(shards, prefetch=0)
+        with pytest.raises(UnsupportedOperation):
+            fs.put_meta('1', {'z': 1})
+        with pytest.raises(UnsupportedOperation):
+            fs.clear_meta('1')
+
+    def test_merged_names_and_meta(self):
+        shard1 = _DummyDataFS()
+        shard2 = _DummyDataFS()
+        shard2._names = ['1', '10', '11']
+        shard2._files_data.update({'1': b'shadowed', '10': b'10',
+                                   '11': b'11'})
+        shard2._files_meta.update({'10': {'z': '10 z'}, '11': {}})
+        shard2.list_names = Mock(wraps=shard2.list_names)
+        shard2.batch_retrieve = Mock(wraps=shard2.batch_retrieve)
+
+        with ShardedDataFS([shard1, shard2]) as fs:
+            names = [str(i) for i in range(12)]
+            self.assertEquals(names, fs.list_names())
+            self.assertEquals(12, fs.count())
+            self.assertEquals(1, shard2.list_names.call_count)
+
+            # the names should be routed to the shards
+            self.assertEquals(b'1', fs.get_data('1'))
+            self.assertEquals((b'10', '10 z'), fs.retrieve('10', ['z']))
+            self.assertEquals(
+                [(b'11', None), None, (b'3', '3 z'), (b'10', '10 z')],
+                fs.batch_retrieve(['11', 'none', '3', '10'], ['z'])
+            )
+            self.assertEquals(1, shard2.batch_retrieve.call_count)
+            self.assertEquals(
+                [('9 z',), ('10 z',), None],
+                fs.batch_get_meta(['9', '10', 'none'], ['z'])
+            )
+            self.assertEquals([True, False, True],
+                              fs.batch_isfile(['11', '12', '0']))
+            with pytest.raises(DataFileNotExist):
+                _ = fs.get_data('none')
+
+            # the name index should be shared with the clone
+            fs2 = fs.clone()
+            self.assertIsNot(fs.shards[0], fs2.shards[0])
+            self.assertEquals(names, fs2.list_names())
+            self.assertEquals(1, shard2.list_names.call_count)
+
+        # the name index should be rebuilt after closed
+        self.assertEquals(names, fs.list_names())
+        self.assertEquals(2, shard2.list_names.call_count)
+
+    def test_shadowed_names(self):
+        shard1 = _DummyDataFS()
+        shard2 = _DummyDataFS()
+        shard2._names = ['1', '10', '1', '11']
+        shard2._files_data.update({'1': b'shadowed', '10': b'10',
+                                   '11': b'11'})
+        shard2.clone = lambda: shard2
+        names = [str(i) for i in range(12)]
+
+        # the shadowed files should be excluded by all methods, whether
+        # or not the name index has been built
+        with ShardedDataFS([shard1, shard2]) as fs:
+            self.assertEquals(12, fs.count())
+            self.assertEquals(names, sorted(fs.iter_names(), key=int))
+        with ShardedDataFS([shard1, shard2]) as fs:
+            files = sorted(fs.iter_files(), key=lambda f: int(f[0]))
+            self.assertEquals(names, [f[0] for f in files])
+            self.assertEquals(b'1', files[1][1])
+            self.assertEquals(12, fs.count())
+
+    def test_iter_files(self):
+        shards = []
+        for i in range(5):
+            shard = _DummyDataFS()
+            shard._names = ['{}-{}'.format(i, j) for j in range(i)]
+            shard._files_data = {n: n.encode('utf-8') for n in shard._names}
+            shard._files_meta = {n: {'z': n + ' z'} for n in shard._names}
+            shard.clone = (lambda s: lambda: s)(shard)
+            shards.append(shard)
+
+        for num_parallel in (1, 2, 10):
+            fs = ShardedDataFS(shards, num_parallel=num_parallel, prefetch=1)
+            files = list(fs.iter_files(['z']))
+            self.assertEquals(
+                sorted((n, n.encode('utf-8'), n + ' z')
+                       for s in shards for n in s._names),
+                sorted(files)
+            )
+            # the files of each shard should be yielded in order, and
+            # the shards should be interleaved
+            for s in shards:
+                self.assertEquals(s._names,
+                                  [f[0] for f in files if f[0] in s._names])
+            if num_parallel == 1:
+                self.assertEquals(sum((s._names for s in shards), []),
+                                  [f[0] for f in files])
+            elif num_parallel == 2:
+                self.assertEquals(['1-0', '2-0', '2-1', '3-0', '3-1'],
+                                  [f[0] for f in files[:5]])
+            else:
+                self.assertEquals(['1-0', '2-0', '3-0', '4-0', '2-1'],
+                                  [f[0] for f in files[:5]])
+
+        # test error in a shard
+        shards[3].get_data = Mock(side_effect=IOError('cannot read'))
+        fs = ShardedDataFS(shards)
+        with pytest.raises(IOError, match='cannot read'):
+            _ = list(fs.iter_files())
+
+    def test_for_worker(self):
+        shards = [_DummyDataFS() for _ in range(5)]
+        fs = ShardedDataFS(shards, num_parallel=3, prefetch=5)
+        fs2 = fs.for_worker(2, 1)
+        self.assertEquals(2, len(fs2.shards))
+        self.assertEquals((3, 5), (fs2.num_parallel, fs2.prefetch))
+        for s in fs2.shards:
+            self.assertNotIn(s, shards)
+
+        with pytest.raises(ValueError, match='`num_workers` must be positive'):
+            _ = fs.for_worker(0, 0)
+        with pytest.raises(ValueError, match='`worker_index` must be in the '
+                                             'range'):
+            _ = fs.for_worker(2, 2)
+        with pytest.raises(ValueError, match='Cannot assign 5 shards to 6 '
+                                             'workers'):
+            _ = fs.for_worker(6, 0)
+
+    def test_from_glob(self):
+        with TemporaryDirectory() as tempdir:
+            for i in range(3):
+                with tarfile.open(os.path.join(
+                        tempdir, 'shard-{}.tar'.format(i)), 'w') as tf:
+                    ti = tarfile.TarInfo(str(i))
+                    ti.size = 1
+                    tf.addfile(ti, six.BytesIO(str(i).encode('utf-8')))
+
+            with ShardedDataFS.from_glob(os.path.join(tempdir, 'shard-*.tar'),
+                                         num_parallel=2) as fs:
+                self.assertEquals(2, fs.num_parallel)
+                self.assertEquals(3, len(fs.shards))
+                for shard in fs.shards:
+                    self.assertIsInstance(shard, TarArchiveFS)
+                self.assertEquals(['0', '1', '2'], fs.list_names())
+                self.assertEquals(b'2', fs.get_data('2'))
+
+            # the side-car index files should be ignored the second time
+            self.assertEquals(
+                ['shard-{}.tar{}'.format(i, ext)
+                 for i in range(3) for ext in ('', '.index')],
+                sorted(os.listdir(tempdir))
+            )
+            with ShardedDataFS.from_glob(
+                    os.path.join(tempdir, 'shard-*')) as fs:
+                self.assertEquals(3, len(fs.shards))
+                self.assertEquals(['0', '1', '2'], fs.list_names())
+
+            # directories should be opened as LocalFS, other files ignored
+            makedirs(os.path.join(tempdir, 'shard-3'))
+            with open(os.path.join(tempdir, 'shard-3', '3'), 'wb') as f:
+                f.write(b'3')
+            with open(os.path.join(tempdir, 'shard-4'), 'wb') as f:
+                f.write(b'4')
+            with ShardedDataFS.from_glob(
+                    os.path.join(tempdir, 'shard-*')) as fs:
+                self.assertEquals(4, len(fs.shards))
+                self.assertIsInstance(fs.shards[-1], LocalFS)
+                self.assertEquals(['0', '1', '2', '3'], fs.list_names())
+
+            with pytest.raises(IOError, match='No file matches'):
+                _ = ShardedDataFS.from_glob(os.path.join(tempdir, '*.zip'))
+            with pytest.raises(IOError, match='No file matches'):
+                _ = ShardedDataFS.from_glob(os.path.join(tempdir, '*.index'))
+            self.assertFalse(os.path.isdir(
+                os.path.join(tempdir, 'shard-0.tar.index')))
+
+
+if __name__ == '__main__':
+    unittest.main()
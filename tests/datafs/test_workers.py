@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+import pytest
+from mock import Mock
+
+from mlsnippet.datafs import *
+from .test_dataflow import _DummyDataFS
+
+
+class DataFSWorkerPoolTestCase(unittest.TestCase):
+
+    def test_props_and_errors(self):
+        fs = _DummyDataFS()
+        pool = DataFSWorkerPool(fs, 3)
+        self.assertIs(fs, pool.fs)
+        self.assertEquals(3, pool.num_workers)
+
+        with pytest.raises(ValueError, match='`num_workers` must be positive'):
+            _ = DataFSWorkerPool(fs, 0)
+
+    def test_submit(self):
+        fs = _DummyDataFS()
+        clones = []
+
+        def clone():
+            c = _DummyDataFS()
+            c.close = Mock(wraps=c.close)
+            clones.append(c)
+            return c
+
+        fs.clone = clone
+        barrier = threading.Event()
+        used = []
+
+        def job(c, name):
+            used.append(c)
+            barrier.wait()
+            return c.get_data(name)
+
+        with DataFSWorkerPool(fs, 2) as pool:
+            self.assertEquals(2, len(clones))
+            futures = [pool.submit(job, str(i)) for i in range(4)]
+            barrier.set()
+            self.assertEquals([str(i).encode('utf-8') for i in range(4)],
+                              [f.result() for f in futures])
+            for c in used:
+                self.assertIn(c, clones)
+                self.assertIsNot(fs, c)
+
+        for c in clones:
+            self.assertTrue(c.close.called)
+
+
+class BackgroundIteratorTestCase(unittest.TestCase):
+
+    def test_iterate(self):
+        with pytest.raises(ValueError, match='`max_pending` must be positive'):
+            _ = BackgroundIterator(lambda: range(5), max_pending=0)
+
+        it = BackgroundIterator(lambda: range(5), max_pending=3)
+        self.assertEquals(3, it.max_pending)
+        self.assertEquals([0, 1, 2, 3, 4], list(it))
+        with pytest.raises(StopIteration):
+            _ = next(it)
+        it.close()
+
+    def test_error(self):
+        def g():
+            yield 1
+            raise RuntimeError('error in background')
+
+        with BackgroundIterator(g) as it:
+            self.assertEquals(1, next(it))
+            with pytest.raises(RuntimeError, match='error in background'):
+                _ = next(it)
+            with pytest.raises(StopIteration):
+                _ = next(it)
+
+    def test_close(self):
+        produced = []
+        stopped = threading.Event()
+
+        def g():
+            try:
+                for i in range(100):
+                    produced.append(i)
+                    yield i
+            finally:
+                stopped.set()
+
+        with BackgroundIterator(g, max_pending=2) as it:
+            self.assertEquals(0, next(it))
+            # at most `max_pending` items are kept in the queue, plus one
+            # item blocked in the background thread
+            self.assertLessEqual(len(produced), 4)
+        self.assertIsNone(it._thread)
+        self.assertLess(len(produced), 100)
+        with pytest.raises(StopIteration):
+            _ = next(it)
+
+
+if __name__ == '__main__':
+    unittest.main()
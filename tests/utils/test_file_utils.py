@@ -87,6 +87,62 @@ class IterFilesTestCase(unittest.TestCase):
 
             self.assertListEqual(names, sorted(iter_files(tempdir)))
             self.assertListEqual(names, sorted(iter_files(tempdir + '/a/../')))
+            self.assertListEqual(
+                ['1.txt', '2.txt', 'b/1.txt', 'b/2.txt'],
+                sorted(iter_files(os.path.join(tempdir, 'a')))
+            )
+            self.assertListEqual(
+                [n.replace('/', '\\') for n in names],
+                sorted(iter_files(tempdir, sep='\\'))
+            )
+
+            # test sorted output, in which the files of a directory should
+            # be yielded before its sub-directories
+            sorted_names = ['c.txt', 'a/1.txt', 'a/2.txt', 'a/b/1.txt',
+                            'a/b/2.txt', 'b/1.txt', 'b/2.txt']
+            self.assertListEqual(sorted_names,
+                                 list(iter_files(tempdir, sort=True)))
+
+            # test scanning with worker threads
+            for num_workers in (1, 2, 8):
+                self.assertListEqual(
+                    names, sorted(iter_files(tempdir, num_workers=num_workers)))
+                self.assertListEqual(
+                    sorted_names,
+                    list(iter_files(tempdir, num_workers=num_workers,
+                                    sort=True))
+                )
+
+            # test closing the iterator before exhausted
+            it = iter_files(tempdir, num_workers=2, sort=True)
+            self.assertEquals('c.txt', next(it))
+            it.close()
+
+    def test_scan_dir(self):
+        with TemporaryDirectory() as tempdir:
+            for name in ['b.txt', 'a.txt', 'd/1.txt', 'c/1.txt']:
+                f_path = os.path.join(tempdir, name)
+                makedirs(os.path.split(f_path)[0], exist_ok=True)
+                with open(f_path, 'wb') as f:
+                    f.write(b'')
+            self.assertEquals((['a.txt', 'b.txt'], ['c', 'd']),
+                              scan_dir(tempdir, sort=True))
+            files, dirs = scan_dir(tempdir)
+            self.assertEquals((['a.txt', 'b.txt'], ['c', 'd']),
+                              (sorted(files), sorted(dirs)))
+
+    def test_iter_files_symlink(self):
+        with TemporaryDirectory() as tempdir:
+            f_dir = os.path.join(tempdir, 'a')
+            makedirs(f_dir)
+            with open(os.path.join(f_dir, '1.txt'), 'wb') as f:
+                f.write(b'')
+            try:
+                os.symlink(f_dir, os.path.join(tempdir, 'b'))
+            except (AttributeError, NotImplementedError, OSError):
+                return  # symbolic links not supported
+            self.assertListEqual(['a/1.txt', 'b/1.txt'],
+                                 list(iter_files(tempdir, sort=True)))
 
 
 class MaybeCloseTestCase(unittest.TestCase):
@@ -1,11 +1,13 @@
 import unittest
 
+import mock
 from gridfs import GridFS, GridFSBucket
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database
 
 from mlsnippet.utils import *
+from mlsnippet.utils.mongo_binder import _MongoClientRegistry
 from ..helper import temporary_mongodb
 
 
@@ -32,6 +34,39 @@ class MongoBinderTestCase(unittest.TestCase):
             self.assertIsInstance(binder.client, MongoClient)
             self.assertIsNot(client, binder.client)
 
+            # test the client to be shared with other binders
+            with MongoBinder(conn_str, 'test2', 'fs') as binder2:
+                self.assertIs(binder.client, binder2.client)
+            self.assertIsNotNone(binder.client.server_info())
+            binder.close()
+
+    def test_client_registry(self):
+        with mock.patch('mlsnippet.utils.mongo_binder.MongoClient',
+                        side_effect=lambda s: mock.Mock(conn_str=s)):
+            registry = _MongoClientRegistry()
+
+            # the clients should be shared and reference counted
+            c1 = registry.acquire('mongodb://a')
+            self.assertIs(c1, registry.acquire('mongodb://a'))
+            c2 = registry.acquire('mongodb://b')
+            self.assertIsNot(c1, c2)
+            self.assertEquals('mongodb://b', c2.conn_str)
+            registry.release('mongodb://a', c1)
+            self.assertFalse(c1.close.called)
+            registry.release('mongodb://a', c1)
+            self.assertTrue(c1.close.called)
+            self.assertIsNot(c1, registry.acquire('mongodb://a'))
+
+            # the clients of the parent process should be discarded
+            # in a forked child process, without being closed
+            with mock.patch('os.getpid', return_value=-1):
+                c3 = registry.acquire('mongodb://b')
+                self.assertIsNot(c2, c3)
+                registry.release('mongodb://b', c2)
+                self.assertFalse(c2.close.called)
+                registry.release('mongodb://b', c3)
+                self.assertTrue(c3.close.called)
+
 
 if __name__ == '__main__':
     unittest.main()